@@ -0,0 +1,84 @@
+from __future__ import print_function
+"""
+Compare sources.File reading into a bufferpool.BufferPool with reading a new
+bytes object per chunk, over a long ingest: the same file read again and
+again, raw and through Gunzip. Each run is a separate process, so its peak
+RSS is its own. Usage::
+
+    python benchmarks/buffer_pool.py [size in MiB, default 256] [passes, 8]
+
+Set $CHUNK_SIZE to read in chunks other than 1MiB.
+"""
+import gc
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from tubing import bufferpool, sources, tubes, sinks
+
+CHUNK_SIZE = int(os.environ.get("CHUNK_SIZE", 2**20))
+
+
+def make_gzip(path, size):
+    """
+    Write about $size bytes of gzip at path.
+    """
+    comp = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    block = os.urandom(2**15) * 4
+    with open(path, "wb") as f:
+        while f.tell() < size:
+            f.write(comp.compress(block + os.urandom(2**16)))
+        f.write(comp.flush())
+
+
+def run(path, passes, pipeline, pooled):
+    pool = bufferpool.BufferPool(CHUNK_SIZE) if pooled else None
+    collections = []
+    gc.callbacks.append(
+        lambda phase, info: phase == "stop" and collections.append(info)
+    )
+    count = 0
+    start = time.time()
+    for _ in range(passes):
+        source = sources.File(path, pool=pool, chunk_size=CHUNK_SIZE)
+        if pipeline == "gunzip":
+            source = source | tubes.Gunzip()
+        count += (source | sinks.Counter()).result
+    elapsed = time.time() - start
+    # ru_maxrss is KiB on linux
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 2**10
+    print("%-6s %-6s %8.2fs %8.1f MiB/s %6d MiB peak RSS %5d gcs %s" % (
+        pipeline, "pool" if pooled else "bytes", elapsed,
+        count / elapsed / 2**20, rss, len(collections),
+        "%d buffers" % pool.allocated if pooled else ""
+    ))
+
+
+def main():
+    if sys.argv[1:2] == ["--run"]:
+        path, passes, pipeline, pooled = sys.argv[2:]
+        return run(path, int(passes), pipeline, pooled == "pool")
+
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    passes = sys.argv[2] if len(sys.argv) > 2 else "8"
+    fd, path = tempfile.mkstemp(suffix=".gz")
+    os.close(fd)
+    try:
+        make_gzip(path, size * 2**20)
+        print("input: %d MiB gzip, %s passes" %
+              (os.path.getsize(path) // 2**20, passes))
+        for pipeline in ("raw", "gunzip"):
+            for pooled in ("bytes", "pool"):
+                subprocess.check_call([
+                    sys.executable, __file__, "--run", path, passes,
+                    pipeline, pooled
+                ])
+    finally:
+        os.unlink(path)
+
+
+if __name__ == "__main__":
+    main()
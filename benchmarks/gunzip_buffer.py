@@ -0,0 +1,72 @@
+from __future__ import print_function
+"""
+Compare the TransformerTubeWorker byte buffer with the old concatenating
+buffer on gzip decompression. Highly compressible input inflates many times
+over, which is the worst case for the old buffer. Usage::
+
+    python benchmarks/gunzip_buffer.py [size in MiB, default 256]
+
+Pass 4096 or more for a multi-GB run.
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+import zlib
+from tubing import sources, tubes, sinks
+
+
+def make_gzip(path, size):
+    """
+    Write $size bytes of JSON-ish lines to a gzip file at path.
+    """
+    rnd = random.Random(0)
+    lines = [
+        ('{"id": %d, "name": "user%d", "ok": true}\n' %
+         (i, rnd.randint(0, 100))).encode('utf-8') for i in range(4096)
+    ]
+    block = b"".join(lines)
+    comp = zlib.compressobj(1, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    with open(path, "wb") as f:
+        written = 0
+        while written < size:
+            f.write(comp.compress(block))
+            written += len(block)
+        f.write(comp.flush())
+    return written
+
+
+def run(path):
+    start = time.time()
+    apparatus = sources.File(path, "rb") | tubes.Gunzip() | sinks.Counter()
+    return apparatus.result, time.time() - start
+
+
+def main():
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    fd, path = tempfile.mkstemp(suffix=".gz")
+    os.close(fd)
+    try:
+        total = make_gzip(path, size * 2**20)
+        print("input: %d MiB gzip, %d MiB inflated" %
+              (os.path.getsize(path) // 2**20, total // 2**20))
+
+        count, elapsed = run(path)
+        print("ByteBuffer:     %8.2fs %8.1f MiB/s" %
+              (elapsed, count / elapsed / 2**20))
+
+        make_buffer = tubes.make_buffer
+        tubes.make_buffer = lambda chunk, chunk_size: tubes.SequenceBuffer()
+        try:
+            count, elapsed = run(path)
+        finally:
+            tubes.make_buffer = make_buffer
+        print("SequenceBuffer: %8.2fs %8.1f MiB/s" %
+              (elapsed, count / elapsed / 2**20))
+    finally:
+        os.unlink(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -91,5 +91,8 @@ setup(
         "ujson": [
             "ujson",
         ],
+        "orjson": [
+            "orjson",
+        ],
     },
 )
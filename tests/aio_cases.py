@@ -0,0 +1,103 @@
+import asyncio
+import logging
+import unittest2 as unittest
+from tubing import aio, sinks, sources, tubes
+
+SOURCE_DATA = [
+    dict(
+        name="Bob",
+        age=38
+    ),
+    dict(
+        name="Carrie",
+        age=38
+    ),
+    dict(
+        name="Devyn",
+        age=18
+    ),
+    dict(
+        name="Calvin",
+        age=13
+    ),
+]
+
+logger = logging.getLogger("tubing.test_aio")
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+@tubes.TransformerTubeFactory(tubes.OBJ_CHUNK_SIZE)
+class Sleepy(object):
+
+    async def transform(self, chunk):
+        await asyncio.sleep(0.01)
+        return chunk
+
+
+class AioTestCase(unittest.TestCase):
+
+    def testPipe(self):
+        source = aio.from_sync(sources.Objects(SOURCE_DATA))
+        apparatus = source | tubes.JSONDumps() \
+                      | tubes.Joined(by=b"\n") \
+                      | tubes.Gzip() \
+                      | tubes.Gunzip() \
+                      | tubes.Split(on=b"\n") \
+                      | aio.Inline(tubes.JSONLoads()) \
+                      | Sleepy() \
+                      | sinks.Objects()
+        self.assertEqual(run(apparatus), SOURCE_DATA)
+
+    def testThreaded(self):
+        with self.assertRaises(ValueError):
+            aio.Stream(None, threaded=True)
+
+    def testStreams(self):
+
+        async def pipe(data):
+            reader = asyncio.StreamReader()
+            reader.feed_data(data)
+            reader.feed_eof()
+            return await (aio.Stream(reader, chunk_size=3)
+                          | tubes.Split()
+                          | tubes.Map(lambda line: line.upper())
+                          | sinks.Objects())
+
+        async def many():
+            return await asyncio.gather(*[
+                pipe(b"a\nb\nc%d" % (i)) for i in range(100)
+            ])
+
+        results = run(many())
+        self.assertEqual(len(results), 100)
+        self.assertEqual(results[7], [b"A", b"B", b"C7"])
+
+    def testFailure(self):
+        aborted = []
+
+        def fail(obj):
+            raise ValueError("Meant to fail")
+
+        class AbortWriter(object):
+
+            async def write(self, chunk):
+                pass
+
+            async def abort(self):
+                aborted.append("sink")
+
+        apparatus = aio.from_sync(sources.Objects(SOURCE_DATA)) \
+                  | tubes.Map(fail) \
+                  | tubes.Map(lambda x: x,
+                              abort_fn=lambda: aborted.append("map")) \
+                  | aio.MakeSinkFactory(AbortWriter)()
+        with self.assertRaises(ValueError):
+            run(apparatus)
+        self.assertEqual(aborted, ["map", "sink"])
@@ -0,0 +1,10 @@
+"""
+The asyncio tests live in aio_cases, since `async def` is a syntax error
+before python 3.5, and they're only collected from here on 3.5 and up.
+"""
+import sys
+
+__all__ = ["AioTestCase"]
+
+if sys.version_info >= (3, 5):
+    from aio_cases import AioTestCase
@@ -1,6 +1,12 @@
+import io
 import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest2 as unittest
-from tubing import sinks, sources, tubes, apparatus
+from tubing import sinks, sources, tubes, apparatus, kernelcopy
 
 SOURCE_DATA = [
     dict(
@@ -42,3 +48,232 @@ class PipeTestCase(unittest.TestCase):
         self.assertEqual(result[1], SOURCE_DATA[1])
         self.assertEqual(result[2], SOURCE_DATA[2])
         self.assertEqual(result[3], SOURCE_DATA[3])
+
+    def testFusion(self):
+        app = apparatus.Apparatus(sources.Objects(SOURCE_DATA))
+        app.connect(tubes.JSONDumps())
+        app.connect(tubes.Tee(sinks.Objects()))
+        app.connect(tubes.ChunkMap(lambda chunk: chunk))
+        app.connect(tubes.JSONLoads())
+        app.connect(tubes.Filter(lambda obj: obj["age"] > 18))
+        app.connect(sinks.Objects())
+
+        self.assertEqual(len(app.tubes), 5)
+        self.assertIsInstance(app.tubes[1].transformer, tubes.FusedTransformer)
+        self.assertIsInstance(app.tubes[4].transformer, tubes.FusedTransformer)
+        self.assertEqual(len(app.tubes[4].transformer.stages), 2)
+        self.assertIs(app.tubes[4].source, app.tubes[2])
+        self.assertEqual(len(app.tubes[1].result), 4)
+        self.assertEqual(app.result, SOURCE_DATA[:2])
+
+    def testFusedAbort(self):
+        aborted = []
+
+        def fail(obj):
+            raise ValueError("Meant to fail")
+
+        def abort(name):
+            return lambda: aborted.append(name)
+
+        app = apparatus.Apparatus(sources.Objects(SOURCE_DATA))
+        app.connect(tubes.Map(lambda obj: obj, abort_fn=abort("first")))
+        app.connect(tubes.Filter(fail))
+        app.connect(tubes.Map(lambda obj: obj, abort_fn=abort("last")))
+        with self.assertRaises(ValueError):
+            app.connect(sinks.Objects())
+        self.assertEqual(aborted, ["last"])
+
+    def testNoFusion(self):
+        app = apparatus.Apparatus(sources.Objects(SOURCE_DATA), fuse=False)
+        app.connect(tubes.JSONDumps())
+        app.connect(tubes.JSONLoads())
+        app.connect(sinks.Objects())
+        self.assertIs(app.tubes[1].source, app.tubes[0])
+        self.assertEqual(app.result, SOURCE_DATA)
+
+    def testThreaded(self):
+        threads = set()
+
+        def fn(obj):
+            threads.add(threading.current_thread().name)
+            return obj
+
+        app = apparatus.Apparatus(
+            sources.Objects(SOURCE_DATA), threaded=True, queue_size=1
+        )
+        app.connect(tubes.JSONDumps())
+        app.connect(tubes.Joined(by=b"\n"))
+        app.connect(tubes.Gzip())
+        app.connect(tubes.Gunzip())
+        app.connect(tubes.Split(on=b"\n"))
+        app.connect(tubes.JSONLoads())
+        app.connect(tubes.Map(fn))
+        app.connect(sinks.Objects())
+
+        self.assertEqual(app.result, SOURCE_DATA)
+        self.assertEqual(len(threads), 1)
+        self.assertNotEqual(threads.pop(), threading.current_thread().name)
+
+    def testThreadedFailure(self):
+        aborted = []
+
+        def fail(obj):
+            raise ValueError("Meant to fail")
+
+        class AbortSink(object):
+
+            def write(self, chunk):
+                pass
+
+            def abort(self):
+                aborted.append("sink")
+
+        source = sources.Objects(SOURCE_DATA, threaded=True)
+        with self.assertRaises(ValueError):
+            source \
+                | tubes.Filter(fail) \
+                | tubes.Map(lambda x: x, abort_fn=lambda: aborted.append("map")) \
+                | sinks.MakeSinkFactory(AbortSink)()
+        self.assertEqual(aborted, ["map", "sink"])
+        self.assertTrue(source.app.stopped.is_set())
+
+    def testThreadedSinkFailure(self):
+        aborted = []
+        failures = []
+
+        class Slow(object):
+
+            def read(self, amt):
+                time.sleep(0.01)
+                return [1] * amt, False
+
+        class FailSink(object):
+
+            def write(self, chunk):
+                raise ValueError("Meant to fail")
+
+            def abort(self):
+                aborted.append("sink")
+
+        class Failures(logging.Handler):
+
+            def emit(self, record):
+                failures.append(record)
+
+        handler = Failures()
+        logging.getLogger('tubing.tubes').addHandler(handler)
+        self.addCleanup(logging.getLogger('tubing.tubes').removeHandler,
+                        handler)
+
+        source = sources.Source(Slow(), 1, True)
+        with self.assertRaises(ValueError):
+            source \
+                | tubes.Map(lambda x: x, chunk_size=1,
+                            abort_fn=lambda: aborted.append("map")) \
+                | sinks.MakeSinkFactory(FailSink)()
+        for thread in threading.enumerate():
+            if thread.name.startswith("tubing"):
+                thread.join(5)
+        self.assertEqual(aborted, ["sink"])
+        self.assertEqual(failures, [])
+
+    def testFusedLazyFailure(self):
+
+        def fail(obj):
+            raise ValueError("Meant to fail")
+
+        for fuse in (False, True):
+            aborted = []
+
+            class Eager(object):
+
+                fusible = True
+
+                def transform(self, chunk):
+                    return [obj for obj in chunk]
+
+                def abort(self):
+                    aborted.append("eager")
+
+            class AbortSink(object):
+
+                def write(self, chunk):
+                    pass
+
+                def abort(self):
+                    aborted.append("sink")
+
+            app = apparatus.Apparatus(sources.Objects(SOURCE_DATA), fuse=fuse)
+            app.connect(
+                tubes.Map(fail, abort_fn=lambda: aborted.append("map"))
+            )
+            app.connect(tubes.MakeTransformerTubeFactory(Eager)())
+            self.assertEqual(len(set(app.tubes)), 2)
+            if fuse:
+                self.assertIsInstance(
+                    app.tubes[-1].transformer, tubes.FusedTransformer
+                )
+            with self.assertRaises(ValueError):
+                app.connect(sinks.MakeSinkFactory(AbortSink)())
+            self.assertEqual(aborted, ["map", "eager", "sink"])
+
+    def testKernelCopy(self):
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        data = b"".join(("line %d\n" % i).encode() for i in range(100000))
+        src = os.path.join(tmp, "src")
+        dst = os.path.join(tmp, "dst")
+        with open(src, "wb") as f:
+            f.write(data)
+
+        copies = []
+        copy = kernelcopy.copy
+
+        def record(*args):
+            copies.append(copy(*args))
+            return copies[-1]
+
+        kernelcopy.copy = record
+        self.addCleanup(setattr, kernelcopy, "copy", copy)
+
+        def read(path):
+            with open(path, "rb") as f:
+                return f.read()
+
+        sources.File(src) | tubes.Noop(chunk_size=777) | sinks.File(dst, "wb")
+        self.assertEqual(read(dst), data)
+        self.assertEqual(copies, [(len(data), True)])
+
+        # appending can't always be done in the kernel, but still works
+        sources.File(src) | sinks.File(dst, "ab")
+        self.assertEqual(read(dst), data + data)
+        self.assertEqual(len(copies), 2)
+
+        # a pipe, through splice if there is one
+        r, w = os.pipe()
+        writer = threading.Thread(target=lambda: (os.write(w, data),
+                                                  os.close(w)))
+        writer.start()
+        sources.IO(io.FileIO(r, "rb")) | sinks.File(dst, "wb")
+        writer.join()
+        self.assertEqual(read(dst), data)
+        self.assertEqual(len(copies), 3)
+
+        sources.File(src) | tubes.Gzip() | tubes.Gunzip() \
+            | sinks.File(dst, "wb")
+        self.assertEqual(read(dst), data)
+        self.assertEqual(len(copies), 3)
+
+        # subclasses that read or write for themselves aren't skipped
+        reads = []
+
+        class Counted(sources.File.reader_cls):
+
+            def read(self, amt=None):
+                reads.append(amt)
+                return super(Counted, self).read(amt)
+
+        sources.MakeSourceFactory(Counted)(src) | sinks.File(dst, "wb")
+        self.assertEqual(read(dst), data)
+        self.assertEqual(len(copies), 3)
+        self.assertGreater(len(reads), 1)
@@ -0,0 +1,85 @@
+import gzip
+import hashlib
+import io
+import os
+import shutil
+import tempfile
+import unittest2 as unittest
+from tubing import bufferpool, sinks, sources, tubes
+
+
+def gzipped(data):
+    """
+    gzipped is gzip.compress, which python 2 doesn't have.
+    """
+    out = io.BytesIO()
+    f = gzip.GzipFile(fileobj=out, mode="wb")
+    f.write(data)
+    f.close()
+    return out.getvalue()
+
+
+class Unbuffered(object):
+
+    def __init__(self, byts):
+        self.io = io.BytesIO(byts)
+
+    def read(self, amt):
+        return self.io.read(amt)
+
+
+class BufferPoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.data = b"".join(("line %d\n" % i).encode() for i in range(20000))
+        self.path = os.path.join(self.tmp, "data")
+        with open(self.path, "wb") as f:
+            f.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def testAcquire(self):
+        pool = bufferpool.BufferPool(size=16, max_buffers=2)
+        view = pool.read(io.BytesIO(b"abc"), 8)
+        self.assertEqual(view, b"abc")
+        # still being looked at
+        other = pool.acquire()
+        self.assertIsNot(other, view.obj)
+        del other
+        view.release()
+        self.assertEqual(len(pool.acquire(32)), 32)
+        self.assertEqual((pool.allocated, pool.reused), (2, 1))
+
+        # full pools allocate without keeping
+        held = [memoryview(pool.acquire()) for _ in range(3)]
+        self.assertEqual(len(pool.buffers), 2)
+        self.assertIsNot(held[0].obj, held[2].obj)
+
+    def testFile(self):
+        pool = bufferpool.BufferPool(size=1000)
+        apparatus = sources.File(self.path, pool=pool, chunk_size=1000) \
+                  | tubes.Split() \
+                  | sinks.Objects()
+        self.assertEqual(apparatus.result, self.data.split(b"\n"))
+        self.assertLess(pool.allocated, 4)
+        self.assertGreater(pool.reused, 100)
+
+        # views held in a rebuffering tube keep their buffers
+        apparatus = sources.File(self.path, pool=pool, chunk_size=1000) \
+                  | tubes.Noop(chunk_size=4321) \
+                  | sinks.Bytes()
+        self.assertEqual(apparatus.result, self.data)
+
+        with self.assertRaises(ValueError):
+            sources.File(self.path, "r", pool=True)
+
+    def testIO(self):
+        compressed = gzipped(self.data)
+        for stream in (io.BytesIO(compressed), Unbuffered(compressed)):
+            apparatus = sources.IO(stream, pool=True, chunk_size=512) \
+                      | tubes.Gunzip() \
+                      | sinks.Hash("md5")
+            self.assertEqual(apparatus.result.digest(),
+                             hashlib.md5(self.data).digest())
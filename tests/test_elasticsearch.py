@@ -0,0 +1,388 @@
+import json
+import logging
+import threading
+import time
+import unittest2 as unittest
+import zlib
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # pragma: no cover
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+from tubing import jsoncodec, sessions, sinks, sources, tubes
+from tubing.ext import elasticsearch
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    """
+    Server is a stand-in for elasticsearch. Its _bulk endpoint answers each
+    update with whatever status statuses[_id] pops next, 200 if nothing.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), Handler)
+        self.statuses = {}
+        self.reject = []
+        self.bulks = []
+        self.indexed = {}
+        self.docs = 0
+        self.page_delay = 0
+        self.searching = 0
+        self.max_searching = 0
+        self.searches = []
+        self.cleared = []
+        self.fail_slice = None
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d" % self.server_address[1]
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body):
+        body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def do_GET(self):
+        """
+        GET searches self.server.docs numbered documents, scrolling through
+        the ones in the requested slice, if any, $size at a time.
+        """
+        server = self.server
+        body = self.body()
+        path, _, qs = self.path.partition("?")
+        with server.lock:
+            server.searching += 1
+            server.max_searching = max(server.max_searching, server.searching)
+        if path == "/_search/scroll":
+            slice_id, slices, size, offset = map(
+                int, body["scroll_id"].split(":")
+            )
+        else:
+            params = dict(p.split("=") for p in qs.split("&"))
+            size, offset = int(params["size"]), 0
+            s = body.get("slice", dict(id=0, max=1))
+            slice_id, slices = s["id"], s["max"]
+            with server.lock:
+                server.searches.append(body)
+        time.sleep(server.page_delay)
+        if slice_id == server.fail_slice and offset:
+            with server.lock:
+                server.searching -= 1
+            return self.reply(500, dict(error="failed"))
+        hits = [
+            dict(_id=str(n), _source=dict(n=n))
+            for n in range(slice_id, server.docs, slices)[offset:offset + size]
+        ]
+        scroll_id = "%d:%d:%d:%d" % (slice_id, slices, size, offset + size)
+        with server.lock:
+            server.searching -= 1
+        self.reply(200, dict(_scroll_id=scroll_id, hits=dict(hits=hits)))
+
+    def do_DELETE(self):
+        with self.server.lock:
+            self.server.cleared.extend(self.body()["scroll_id"])
+        self.reply(200, dict(succeeded=True))
+
+    def do_POST(self):
+        server = self.server
+        data = self.rfile.read(int(self.headers["Content-Length"]))
+        if self.headers.get("Content-Encoding") == "gzip":
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        lines = data.splitlines()
+        actions = [json.loads(line) for line in lines[::2]]
+        docs = [json.loads(line) for line in lines[1::2]]
+        with server.lock:
+            server.bulks.append(len(actions))
+            if server.reject:
+                return self.reply(server.reject.pop(), {"error": "busy"})
+            items = []
+            for action, doc in zip(actions, docs):
+                esid = action["update"]["_id"]
+                status = server.statuses.get(esid, [200])
+                status = status.pop(0) if len(status) > 1 else status[0]
+                item = dict(_id=esid, status=status)
+                if status == 200:
+                    server.indexed[esid] = doc["doc"]
+                else:
+                    item["error"] = dict(type="error %d" % status)
+                items.append(dict(update=item))
+        self.reply(200, dict(
+            took=1,
+            errors=any(i["update"]["status"] != 200 for i in items),
+            items=items,
+        ))
+
+
+class BulkUpdateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        logger = logging.getLogger('tubing.ext.elasticsearch')
+        logger.setLevel(logging.CRITICAL)
+        self.server = Server()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.session = sessions.new()
+        self.docs = [
+            elasticsearch.DocUpdate(dict(n=i), "doc", esid=str(i))
+            for i in range(1000)
+        ]
+
+    def tearDown(self):
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def index(self, **kwargs):
+        kwargs.setdefault("backoff", 0.001)
+        source = sources.Objects(self.docs) | \
+            elasticsearch.PrepareBulkUpdate(chunk_size=8)
+        return (source | elasticsearch.BulkUpdate(
+            self.server.url, "idx", session=self.session, **kwargs
+        )).result
+
+    def testBatchesByBytes(self):
+        stats = self.index(max_bytes=2**12)
+        self.assertEqual(len(self.server.indexed), 1000)
+        self.assertEqual(stats.docs, 1000)
+        self.assertEqual(stats.bytes, sum(
+            len(action) for action in
+            elasticsearch.BulkSerializer().serialize_many(self.docs)
+        ))
+        self.assertEqual(stats.posts, len(self.server.bulks))
+        self.assertGreater(stats.posts, 10)
+        self.assertLess(max(self.server.bulks), 2**12 // 40)
+        self.assertEqual(stats.retries, 0)
+        self.assertGreater(stats.docs_per_sec, 0)
+
+    def testChunksPerPost(self):
+        self.index(chunks_per_post=25)
+        self.assertEqual(self.server.bulks, [200] * 5)
+
+    def testRetriesRejectedItems(self):
+        self.server.statuses = {
+            "3": [429, 429, 200],
+            "500": [503, 200],
+            "999": [429, 200],
+        }
+        stats = self.index(chunks_per_post=25)
+        self.assertEqual(len(self.server.indexed), 1000)
+        self.assertEqual(stats.retries, 4)
+        self.assertEqual(stats.failed, 0)
+        # only the rejected items were sent again
+        self.assertEqual(
+            self.server.bulks, [200, 1, 1, 200, 200, 1, 200, 200, 1]
+        )
+
+    def testRetriesRejectedBulk(self):
+        self.server.reject = [429, 503]
+        stats = self.index()
+        self.assertEqual(len(self.server.indexed), 1000)
+        self.assertEqual(stats.retries, 2000)
+        self.assertEqual(stats.posts, 3)
+
+    def testFailure(self):
+        self.server.statuses = {"7": [400]}
+        with self.assertRaises(elasticsearch.ElasticSearchError):
+            self.index()
+
+        self.server.indexed.clear()
+        self.server.statuses = {"7": [400], "8": [429]}
+        stats = self.index(fail_on_error=False, max_retries=2)
+        self.assertEqual(stats.failed, 2)
+        self.assertEqual(stats.retries, 2)
+        self.assertEqual(len(self.server.indexed), 998)
+
+    def testInFlight(self):
+        self.server.statuses = {"42": [429, 200]}
+        stats = self.index(max_bytes=2**12, max_in_flight=4, gzip=True)
+        self.assertEqual(len(self.server.indexed), 1000)
+        self.assertEqual(stats.docs, 1000)
+        self.assertEqual(stats.retries, 1)
+
+    def testSerialized(self):
+        self.server.statuses = {"3": [429, 200]}
+        data = b''.join(
+            elasticsearch.BulkSerializer().serialize_many(self.docs)
+        )
+        # no trailing newline, and chunks that cut lines anywhere
+        stats = (sources.Bytes(data[:-1], chunk_size=1000) | elasticsearch.
+                 BulkUpdate(self.server.url, "idx", session=self.session,
+                            backoff=0.001)).result
+        self.assertEqual(len(self.server.indexed), 1000)
+        self.assertEqual(stats.docs, 1000)
+        self.assertEqual(stats.bytes, len(data))
+        self.assertEqual(stats.retries, 1)
+
+        self.server.indexed.clear()
+        sources.Objects(self.docs) | \
+            elasticsearch.PrepareBulkUpdate(chunk_size=8) | \
+            tubes.Joined(vectored=True) | \
+            elasticsearch.BulkUpdate(
+                self.server.url, "idx", session=self.session
+            )
+        self.assertEqual(len(self.server.indexed), 1000)
+
+        # an update without its document
+        truncated = data.rsplit(b'\n', 2)[0]
+        with self.assertRaises(elasticsearch.ElasticSearchError):
+            sources.Bytes(truncated) | elasticsearch.BulkUpdate(
+                self.server.url, "idx", session=self.session
+            )
+
+
+class Custom(object):
+
+    def serialize(self, encoding):
+        return b'{"delete":{"_id":"x"}}\n'
+
+
+class BulkSerializerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        DocUpdate = elasticsearch.DocUpdate
+        self.updates = [
+            DocUpdate(dict(n=1, s=u"h\xe9llo \u2603"), "doc", esid="a"),
+            DocUpdate(dict(n=2), "doc", esid=7, parent_esid="p1"),
+            DocUpdate(dict(n=3), "doc", esid="c", parent_esid="p1"),
+            DocUpdate(dict(n=4), "other", doc_as_upsert=False),
+            DocUpdate(dict(n=5), "doc", esid='"quoted"', parent_esid="p2"),
+            DocUpdate(dict(n=6), "doc", esid="d", doc_as_upsert=0),
+            Custom(),
+        ]
+
+    def lines(self, actions):
+        return [
+            json.loads(line)
+            for action in actions for line in action.splitlines()
+        ]
+
+    def testSameAsDocUpdate(self):
+        for codec in jsoncodec.available():
+            serializer = elasticsearch.BulkSerializer(codec)
+            actions = serializer.serialize_many(self.updates)
+            self.assertEqual(len(actions), len(self.updates))
+            self.assertEqual(self.lines(actions), self.lines(
+                u.serialize('utf-8') for u in self.updates
+            ))
+            # the action lines are cached by doc_type and parent
+            self.assertEqual(len(serializer.shapes), 4)
+
+    def testShapesBounded(self):
+        serializer = elasticsearch.BulkSerializer()
+        serializer.max_shapes = 10
+        serializer.serialize_many([
+            elasticsearch.DocUpdate({}, "doc", esid=i, parent_esid=i)
+            for i in range(25)
+        ])
+        self.assertLessEqual(len(serializer.shapes), 10)
+
+    def testPrepareBulkUpdate(self):
+        for encoding in ('utf-8', 'utf-16'):
+            data = (
+                sources.Objects(self.updates) |
+                elasticsearch.PrepareBulkUpdate(encoding=encoding) |
+                sinks.Objects()
+            ).result
+            self.assertEqual(len(data), len(self.updates))
+            if encoding == 'utf-8':
+                self.assertEqual(self.lines(data), self.lines(
+                    u.serialize('utf-8') for u in self.updates
+                ))
+
+
+class ScrollingSearchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server()
+        self.server.docs = 2500
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.session = sessions.new()
+
+    def tearDown(self):
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def search(self, **kwargs):
+        source = elasticsearch.ScrollingSearch(
+            self.server.url + "/", "idx", "doc", dict(query={}),
+            session=self.session, **kwargs
+        )
+        return (source | sinks.Objects()).result
+
+    def testScroll(self):
+        hits = self.search(size=300)
+        self.assertEqual([h["_source"]["n"] for h in hits], list(range(2500)))
+        self.assertEqual(len(self.server.searches), 1)
+        self.assertEqual(self.server.cleared, ["0:1:300:3000"])
+
+    def testSlices(self):
+        self.server.page_delay = 0.02
+        hits = self.search(slices=4, size=100, chunk_size=50)
+        self.assertEqual(
+            sorted(h["_source"]["n"] for h in hits), list(range(2500))
+        )
+        self.assertEqual(
+            sorted(s["slice"]["id"] for s in self.server.searches),
+            [0, 1, 2, 3]
+        )
+        self.assertEqual(len(self.server.cleared), 4)
+        self.assertGreater(self.server.max_searching, 1)
+
+    def testNoPrefetch(self):
+        hits = self.search(size=1000, prefetch=False)
+        self.assertEqual(len(hits), 2500)
+
+    def testSliceFailure(self):
+        self.server.fail_slice = 2
+        with self.assertRaises(ValueError):
+            self.search(slices=4, size=100)
+        # every slice's scroll is cleared, the failed one's too
+        self.assertEqual(
+            sorted(int(i.split(":")[0]) for i in self.server.cleared),
+            [0, 1, 2, 3]
+        )
+
+    def testAbort(self):
+
+        class FailSink(object):
+
+            def write(self, chunk):
+                raise IOError("Meant to fail")
+
+        source = elasticsearch.ScrollingSearch(
+            self.server.url + "/", "idx", "doc", dict(query={}),
+            session=self.session, slices=4, size=100
+        )
+        with self.assertRaises(IOError):
+            source | sinks.MakeSinkFactory(FailSink)()
+        self.assertEqual(
+            sorted(int(i.split(":")[0]) for i in self.server.cleared),
+            [0, 1, 2, 3]
+        )
+        self.assertTrue(source.reader.workers._shutdown)
+
+    def testEmpty(self):
+        self.server.docs = 0
+        self.assertEqual(self.search(slices=2), [])
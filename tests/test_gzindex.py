@@ -0,0 +1,117 @@
+import gzip
+import io
+import os
+import random
+import shutil
+import tempfile
+import unittest2 as unittest
+from tubing import gzindex, sinks, sources, tubes
+
+
+def gzipped(data):
+    """
+    gzipped is gzip.compress, which python 2 doesn't have.
+    """
+    out = io.BytesIO()
+    f = gzip.GzipFile(fileobj=out, mode="wb")
+    f.write(data)
+    f.close()
+    return out.getvalue()
+
+
+def make_data(lines):
+    rand = random.Random(lines)
+    return b"".join(
+        ("%d %x\n" % (i, rand.getrandbits(64))).encode() for i in range(lines)
+    )
+
+
+class GzIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.data = make_data(100000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, byts):
+        path = os.path.join(self.tmp, name)
+        with open(path, "wb") as f:
+            f.write(byts)
+        return path
+
+    def gzrange(self, path, start, end, index=None):
+        apparatus = sources.GzipRange(path, start, end, index=index) \
+                  | tubes.ChunkMap(lambda chunk: [chunk]) \
+                  | sinks.Objects()
+        return b"".join(apparatus.result)
+
+    def checkRanges(self, path, index):
+        n = len(self.data)
+        self.assertEqual(index.length, n)
+        for start, end in [(0, 10), (n // 3, n // 2), (n - 5, n),
+                           (n // 2, None)]:
+            self.assertEqual(self.gzrange(path, start, end),
+                             self.data[start:end])
+        shards = index.shards(4)
+        self.assertEqual(shards[0][0], 0)
+        self.assertEqual(shards[-1][1], n)
+        self.assertEqual(
+            b"".join(self.gzrange(path, s, e) for s, e in shards), self.data
+        )
+
+    def testSyncFlush(self):
+        apparatus = sources.Bytes(self.data) \
+                  | tubes.ParallelGzip(block_size=2**14, workers=2) \
+                  | tubes.ChunkMap(lambda chunk: [chunk]) \
+                  | sinks.Objects()
+        path = self.write("sync.gz", b"".join(apparatus.result))
+
+        index = gzindex.build(path, span=2**16)
+        self.assertGreater(len(index.checkpoints), 10)
+        self.assertFalse(index.checkpoints[1].member)
+        self.assertEqual(len(index.checkpoints[1].window), gzindex.WINDOW)
+        self.assertEqual(len(index.shards(4)), 4)
+        self.checkRanges(path, index)
+
+        loaded = gzindex.GzipIndex.load(path + gzindex.SUFFIX)
+        self.assertEqual(loaded.offsets, index.offsets)
+        self.assertEqual(loaded.checkpoints[-1].window,
+                         index.checkpoints[-1].window)
+
+    def testMembers(self):
+        step = 2**16
+        path = self.write("members.gz", b"".join(
+            gzipped(self.data[i:i + step])
+            for i in range(0, len(self.data), step)
+        ))
+        index = gzindex.build(path, span=2**17)
+        self.assertGreater(len(index.checkpoints), 5)
+        self.assertTrue(all(c.member for c in index.checkpoints))
+        self.checkRanges(path, index)
+
+    def testUnalignedMembers(self):
+        # members end partway through a read, with the next one's header in
+        # the same read
+        step = 300000
+        path = self.write("unaligned.gz", b"".join(
+            gzipped(self.data[i:i + step])
+            for i in range(0, len(self.data), step)
+        ))
+        n = len(self.data)
+        self.assertEqual(self.gzrange(path, 0, None), self.data)
+        self.assertEqual(self.gzrange(path, n // 2, None),
+                         self.data[n // 2:])
+        index = gzindex.build(path, span=2**17)
+        self.checkRanges(path, index)
+
+    def testNoCheckpoints(self):
+        path = self.write("plain.gz", gzipped(self.data))
+        index_path = os.path.join(self.tmp, "plain.idx")
+        index = gzindex.build(path, span=2**16, index_path=index_path)
+        self.assertEqual(len(index.checkpoints), 1)
+        self.assertEqual(self.gzrange(path, 1000, 2000, index=index_path),
+                         self.data[1000:2000])
+        # no sidecar at all still works, from the top
+        self.assertEqual(self.gzrange(path, 1000, 2000), self.data[1000:2000])
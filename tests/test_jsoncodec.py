@@ -0,0 +1,58 @@
+import json
+import unittest2 as unittest
+from tubing import jsoncodec, sinks, sources, tubes
+
+DOCS = [
+    dict(name=u"Bob", age=38, tags=[u"a", u"é"]),
+    dict(name=u"Carrie", age=38, nested=dict(x=None, y=1.5)),
+]
+
+
+class JSONCodecTestCase(unittest.TestCase):
+
+    def roundtrip(self, codec, encoding="utf-8", **kwargs):
+        apparatus = sources.Objects(DOCS) \
+                  | tubes.JSONDumps(codec=codec, encoding=encoding, **kwargs) \
+                  | tubes.JSONLoads(codec=codec, encoding=encoding) \
+                  | sinks.Objects()
+        return apparatus.result
+
+    def testRoundtrip(self):
+        self.assertIn("json", jsoncodec.available())
+        for name in jsoncodec.available():
+            codec = jsoncodec.get(name)
+            self.assertEqual(codec.name, name)
+            self.assertEqual(self.roundtrip(name), DOCS)
+            self.assertEqual(self.roundtrip(name, sort_keys=True), DOCS)
+            self.assertEqual(self.roundtrip(name, encoding="utf-16"), DOCS)
+            raws = codec.dumps_many(DOCS)
+            self.assertTrue(all(isinstance(raw, bytes) for raw in raws))
+            self.assertEqual(codec.loads_many(raws), DOCS)
+
+    def testSelection(self):
+        self.assertEqual(jsoncodec.get().name, jsoncodec.available()[0])
+        codec = jsoncodec.get("json")
+        self.assertIs(jsoncodec.get(codec), codec)
+        # only the standard library understands separators
+        codec = jsoncodec.get(separators=(",", ":"))
+        self.assertEqual(codec.name, "json")
+        self.assertEqual(codec.dumps({"a": 1}), b'{"a":1}')
+        self.assertRaises(ValueError, jsoncodec.get, "nope")
+        self.assertEqual(jsoncodec.get(compatible=True).name, "json")
+        # a named codec wins
+        fastest = jsoncodec.available()[0]
+        self.assertEqual(jsoncodec.get(fastest, compatible=True).name, fastest)
+
+    def testDumpsDefault(self):
+        apparatus = sources.Objects(DOCS) | tubes.JSONDumps() | sinks.Objects()
+        # the same bytes as json.dumps, whatever else is installed
+        self.assertEqual(apparatus.result, [
+            json.dumps(doc).encode("utf-8") for doc in DOCS
+        ])
+        for name in jsoncodec.available():
+            apparatus = sources.Objects(DOCS) \
+                      | tubes.JSONDumps(codec=name) \
+                      | sinks.Objects()
+            self.assertEqual(
+                [json.loads(raw) for raw in apparatus.result], DOCS
+            )
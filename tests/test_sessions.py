@@ -0,0 +1,236 @@
+import threading
+import time
+import unittest2 as unittest
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # pragma: no cover
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+import zlib
+from tubing import sessions, sinks, sources
+
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, body, ranges=True):
+        HTTPServer.__init__(self, ("127.0.0.1", 0), Handler)
+        self.body = body
+        self.ranges = ranges
+        self.etag = '"v1"'
+        self.connections = 0
+        self.requested = []
+        self.posted = []
+        self.post_delay = 0
+        self.posting = 0
+        self.max_posting = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:%d/" % self.server_address[1]
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body, headers=()):
+        self.send_response(status)
+        for k, v in headers:
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Set-Cookie", "visited=1")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        body = self.server.body
+        spec = self.headers.get("Range")
+        with self.server.lock:
+            self.server.requested.append(spec)
+        if not spec or not self.server.ranges:
+            return self.reply(200, body)
+        if_match = self.headers.get("If-Match")
+        if if_match and (
+            if_match != self.server.etag or if_match.startswith("W/")
+        ):
+            return self.reply(412, b'')
+        if_range = self.headers.get("If-Range")
+        if if_range and (
+            if_range != self.server.etag or if_range.startswith("W/")
+        ):
+            return self.reply(200, body)
+        start, end = spec.split("=")[1].split("-")
+        start, end = int(start), min(int(end), len(body) - 1)
+        if start >= len(body):
+            return self.reply(416, b'')
+        self.reply(206, body[start:end + 1], [
+            ("Content-Range", "bytes %d-%d/%d" % (start, end, len(body))),
+            ("ETag", self.server.etag),
+        ])
+
+    def do_POST(self):
+        server = self.server
+        with server.lock:
+            server.posting += 1
+            server.max_posting = max(server.max_posting, server.posting)
+        data = []
+        if self.headers.get("Content-Length"):
+            data.append(self.rfile.read(int(self.headers["Content-Length"])))
+        else:
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                data.append(self.rfile.read(size))
+                self.rfile.readline()
+                if not size:
+                    break
+        data = b''.join(data)
+        if self.headers.get("Content-Encoding") == "gzip":
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        time.sleep(server.post_delay)
+        with server.lock:
+            server.posted.append(data)
+            server.posting -= 1
+        self.reply(200, data)
+
+
+class SessionsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.body = b"".join(("line %d\n" % i).encode() for i in range(20000))
+        self.server = Server(self.body)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.session = sessions.new()
+
+    def tearDown(self):
+        self.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def read(self, **kwargs):
+        source = sources.HTTP(
+            "GET", self.server.url, session=self.session, **kwargs
+        )
+        return (source | sinks.Bytes()).result
+
+    def testKeepAlive(self):
+        for _ in range(3):
+            self.assertEqual(self.read(), self.body)
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(len(self.session.cookies), 0)
+
+    def testShared(self):
+        self.assertIs(sessions.get(), sessions.get())
+        sessions.configure(pool_maxsize=4)
+        try:
+            s = sessions.get()
+            self.assertEqual(s.get_adapter(self.server.url)._pool_maxsize, 4)
+            s.get(self.server.url)
+            self.assertEqual(len(s.cookies), 0)
+        finally:
+            sessions.configure(pool_maxsize=sessions.POOL_MAXSIZE)
+
+    def testParallelRanges(self):
+        data = self.read(parallel_ranges=4, range_size=10000)
+        self.assertEqual(data, self.body)
+        ranges = len(self.body) // 10000 + 1
+        self.assertEqual(len(self.server.requested), ranges)
+        self.assertIn("bytes=%d-%d" % (
+            (ranges - 1) * 10000, len(self.body) - 1
+        ), self.server.requested)
+        self.assertLessEqual(self.server.connections, 4)
+
+    def testParallelRangesSmallChunks(self):
+        data = self.read(parallel_ranges=3, range_size=7777, chunk_size=1000)
+        self.assertEqual(data, self.body)
+
+    def testParallelRangesUnsupported(self):
+        self.server.ranges = False
+        self.assertEqual(self.read(parallel_ranges=4), self.body)
+        self.assertEqual(len(self.server.requested), 1)
+
+    def testParallelRangesEmpty(self):
+        self.server.body = b''
+        self.assertEqual(self.read(parallel_ranges=4), b'')
+
+    def testParallelRangesChanged(self):
+        source = sources.HTTP(
+            "GET", self.server.url, session=self.session,
+            parallel_ranges=2, range_size=10000
+        )
+        self.server.etag = '"v2"'
+        with self.assertRaises(IOError):
+            (source | sinks.Bytes()).result
+
+    def testParallelRangesWeakETag(self):
+        self.server.etag = 'W/"v1"'
+        data = self.read(parallel_ranges=2, range_size=10000)
+        self.assertEqual(data, self.body)
+        self.assertEqual(
+            len(self.server.requested), len(self.body) // 10000 + 1
+        )
+
+    def testParallelRangesStopped(self):
+        source = sources.HTTP(
+            "GET", self.server.url, session=self.session,
+            parallel_ranges=2, range_size=10000
+        )
+        self.server.etag = '"v2"'
+        with self.assertRaises(IOError):
+            (source | sinks.Bytes()).result
+        self.assertEqual(len(source.reader.pending), 0)
+        self.assertTrue(source.reader.workers._shutdown)
+
+    def testPost(self):
+        sink = sinks.HTTPPost(
+            self.server.url, chunks_per_post=4, session=self.session
+        )
+        sources.Bytes(self.body, chunk_size=2**12) | sink
+        self.assertEqual(b''.join(self.server.posted), self.body)
+        self.assertGreater(len(self.server.posted), 1)
+        self.assertEqual(self.server.connections, 1)
+
+    def testPostInFlight(self):
+        self.server.post_delay = 0.05
+        responses = []
+        sink = sinks.HTTPPost(
+            self.server.url, chunks_per_post=4, session=self.session,
+            max_in_flight=4, gzip=True,
+            response_handler=lambda r: responses.append(r.content),
+        )
+        sources.Bytes(self.body, chunk_size=2**12) | sink
+        self.assertEqual(b''.join(responses), self.body)
+        self.assertEqual(len(responses), len(self.server.posted))
+        self.assertGreater(self.server.max_posting, 1)
+        self.assertLessEqual(self.server.max_posting, 4)
+
+    def testPostGzipStreamed(self):
+        sink = sinks.HTTPPost(
+            self.server.url, chunks_per_post=4, session=self.session,
+            gzip=True,
+        )
+        sources.Bytes(self.body, chunk_size=2**12) | sink
+        self.assertEqual(b''.join(self.server.posted), self.body)
+
+    def testPostInFlightError(self):
+        def fail(r):
+            raise ValueError(r.status_code)
+
+        sink = sinks.HTTPPost(
+            self.server.url, chunks_per_post=4, session=self.session,
+            max_in_flight=4, response_handler=fail,
+        )
+        with self.assertRaises(ValueError):
+            sources.Bytes(self.body, chunk_size=2**12) | sink
@@ -1,4 +1,16 @@
+import gzip
+import io
+import hashlib
+import json
 import logging
+import os
+import re
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
 import unittest2 as unittest
 from tubing import sinks, sources, tubes
 
@@ -24,6 +36,17 @@ SOURCE_DATA = [
 logger = logging.getLogger("tubing.test_tube")
 
 
+def gzipped(data):
+    """
+    gzipped is gzip.compress, which python 2 doesn't have.
+    """
+    out = io.BytesIO()
+    f = gzip.GzipFile(fileobj=out, mode="wb")
+    f.write(data)
+    f.close()
+    return out.getvalue()
+
+
 class PipeTestCase(unittest.TestCase):
 
     def testPipe(self):
@@ -108,3 +131,472 @@ class PipeTestCase(unittest.TestCase):
         sources.Objects(SOURCE_DATA) | Succeed()
         self.assert_(not results['abort'])
         self.assert_(results['close'])
+
+    def testByteBuffer(self):
+        buff = tubes.ByteBuffer(4)
+        buff.append(b"abc")
+        buff.append(b"defgh")
+        self.assertEqual(len(buff), 8)
+        self.assertEqual(buff.shift(2), b"ab")
+        buff.append(bytearray(b"ij"))
+        self.assertEqual(buff.shift(5), b"cdefg")
+        buff.append(memoryview(b"klmnopqrstuv"))
+        self.assertEqual(buff.shift(), b"hijklmnopqrstuv")
+        self.assertEqual(len(buff), 0)
+
+    def testGunzipSmallChunks(self):
+        data = b"".join(("line %d\n" % i).encode() for i in range(10000))
+        apparatus = sources.Bytes(gzipped(data), chunk_size=7) \
+                  | tubes.Gunzip(chunk_size=1000) \
+                  | sinks.Hash("md5")
+        self.assertEqual(
+            apparatus.result.digest(), hashlib.md5(data).digest()
+        )
+
+    def testChunkBuffer(self):
+        calls = []
+
+        def fn(x):
+            calls.append(x)
+            return x * 2
+
+        buff = tubes.ChunkBuffer()
+        buff.append([1, 2, 3])
+        buff.append(map(fn, [4, 5, 6]))
+        self.assertTrue(buff.full(2))
+        self.assertEqual(calls, [])
+        self.assertEqual(buff.shift(2), [1, 2])
+        self.assertEqual(buff.shift(3), [3, 8, 10])
+        self.assertEqual(calls, [4, 5])
+        buff.append((7, 8))
+        self.assertEqual(len(buff), 3)
+        self.assertEqual(buff.shift(), [12, 7, 8])
+        self.assertFalse(buff.full(1))
+
+    def testMap(self):
+        apparatus = sources.Objects(list(range(100))) \
+                  | tubes.Map(lambda x: x + 1, chunk_size=7) \
+                  | tubes.Noop(chunk_size=3) \
+                  | sinks.Objects()
+        self.assertEqual(apparatus.result, list(range(1, 101)))
+
+    def testAutoChunkSize(self):
+        source = sources.Objects(list(range(5000)), chunk_size="auto")
+        apparatus = source \
+                  | tubes.Map(lambda x: x * 2, chunk_size="auto") \
+                  | sinks.Objects(chunk_size="auto")
+        self.assertEqual(apparatus.result, [x * 2 for x in range(5000)])
+        self.assertTrue(source.tuner.last_rate)
+        self.assertTrue(apparatus.tubes[-1].tuner.last_rate)
+
+    def testAutoChunkSizeCeiling(self):
+        tuner = tubes.AdaptiveChunkSize(2**10, memory=2**12, window=1)
+        # never turn around, whatever the timings
+        tuner.tolerance = float("inf")
+        for _ in range(10):
+            tuner.tick(b"x" * tuner.size)
+        self.assertEqual(tuner.size, 2**12)
+        tuner.tick([b"x" * 1000] * tuner.size)
+        self.assertTrue(tuner.size < 8)
+
+    def testParallelMap(self):
+        data = list(range(-500, 500))
+        apparatus = sources.Objects(data) \
+                  | tubes.ParallelMap(abs, workers=2) \
+                  | sinks.Objects()
+        self.assertEqual(apparatus.result, [abs(x) for x in data])
+
+        apparatus = sources.Objects(data) \
+                  | tubes.ParallelMap(lambda x: x * 2, workers=4,
+                                      ordered=False, executor="thread") \
+                  | sinks.Objects()
+        self.assertEqual(sorted(apparatus.result), [x * 2 for x in data])
+
+    def testParallelMapFailure(self):
+
+        def fail(x):
+            raise ValueError("Meant to fail")
+
+        with self.assertRaises(ValueError):
+            sources.Objects(SOURCE_DATA) \
+                | tubes.ParallelMap(fail, executor="thread") \
+                | sinks.Objects()
+
+    def testSplit(self):
+
+        def split(data, chunk_size, *args, **kwargs):
+            return sources.Bytes(data, chunk_size=chunk_size) \
+                 | tubes.Split(*args, **kwargs) \
+                 | sinks.Objects()
+
+        data = b"one\r\ntwo\r\n\r\nthree"
+        for size in (1, 2, 3, 5, 100):
+            self.assertEqual(
+                split(data, size, b"\r\n").result,
+                [b"one", b"two", b"", b"three"]
+            )
+            self.assertEqual(
+                split(data, size, b"\r\n", keep_delimiter=True).result,
+                [b"one\r\n", b"two\r\n", b"\r\n", b"three"]
+            )
+            self.assertEqual(
+                split(data, size, re.compile(b"(\r\n)+")).result,
+                [b"one", b"two", b"three"]
+            )
+            self.assertEqual(
+                split(data, size, re.compile(b"(\r\n)+"),
+                      keep_delimiter=True).result,
+                [b"one\r\n", b"two\r\n\r\n", b"three"]
+            )
+
+        self.assertEqual(
+            split(b"a\n" + b"b" * 10000 + b"\nc\n", 7).result,
+            [b"a", b"b" * 10000, b"c", b""]
+        )
+
+    def testParallelGzip(self):
+        data = b"".join(("line %d\n" % i).encode() for i in range(50000))
+        for block_size in (1000, 2**17):
+            apparatus = sources.Bytes(data) \
+                      | tubes.ParallelGzip(block_size=block_size, workers=3) \
+                      | tubes.ChunkMap(lambda chunk: [chunk]) \
+                      | sinks.Objects()
+            zipped = b"".join(apparatus.result)
+            self.assertEqual(gzip.decompress(zipped), data)
+
+            apparatus = sources.Bytes(zipped) \
+                      | tubes.Gunzip() \
+                      | sinks.Hash("md5")
+            self.assertEqual(
+                apparatus.result.digest(), hashlib.md5(data).digest()
+            )
+
+        apparatus = sources.Bytes(b"") \
+                  | tubes.ParallelGzip() \
+                  | tubes.ChunkMap(lambda chunk: [chunk]) \
+                  | sinks.Objects()
+        self.assertEqual(gzip.decompress(b"".join(apparatus.result)), b"")
+
+    def testJSONStream(self):
+        hits = [
+            dict(id=i, text=u"a [tricky] {\"str\\ing\"} é", n=[i, None])
+            for i in range(50)
+        ]
+        doc = dict(took=3, _shards=dict(x=[1, {"hits": 2}]), hits=dict(
+            total=50, hits=hits, tail="]"
+        ))
+        raw = json.dumps(doc, indent=1).encode("utf-8")
+
+        def stream(raw, path, chunk_size):
+            apparatus = sources.Bytes(raw, chunk_size=chunk_size) \
+                      | tubes.JSONStream(path) \
+                      | sinks.Objects()
+            return apparatus.result
+
+        for chunk_size in (1, 7, 2**16):
+            self.assertEqual(stream(raw, "hits.hits.item", chunk_size), hits)
+            self.assertEqual(stream(raw, "hits.total", chunk_size), [50])
+            self.assertEqual(stream(raw, "hits.hits.item.id", chunk_size),
+                             list(range(50)))
+            self.assertEqual(
+                stream(b'[1, "two", [3], {}, true, null] [4] 5', "item",
+                       chunk_size),
+                [1, "two", [3], {}, True, None, 4]
+            )
+            self.assertEqual(stream(b'{"a": 1}\n[]\n5', "", chunk_size),
+                             [{"a": 1}, [], 5])
+            self.assertEqual(stream(b'[]', "item", chunk_size), [])
+
+        self.assertRaises(ValueError, stream, raw[:-10], "hits.hits.item", 7)
+        self.assertRaises(ValueError, stream, b'[1, 2}', "item", 7)
+
+    def testJSONLoadsFieldsNestedShadow(self):
+        raws = [
+            b'{"meta": {"id": 7, "name": "inner"}, "other": 1}',
+            b'{"meta": {"id": 7, "name": "inner"}, "name": "outer", "id": 1}',
+            b'{"y": {"x": 1, "c": 2}}',
+            b'{"y": {"x": {"a": 3}, "c": 2}, "c": 4}',
+        ]
+        records = (
+            sources.Objects(raws)
+            | tubes.JSONLoads(fields=["id", "name", "c", "x.a"])
+            | sinks.Objects()
+        ).result
+        self.assertNotIn("name", records[0])
+        self.assertNotIn("id", records[0])
+        self.assertEqual(records[1]["name"], "outer")
+        self.assertEqual(records[1]["id"], 1)
+        self.assertNotIn("c", records[2])
+        self.assertEqual(records[3]["c"], 4)
+        self.assertEqual(records, [json.loads(raw) for raw in raws])
+
+    def testJSONLoadsFields(self):
+        docs = [
+            {"a": [1, {"id": -1}], "s": "\"id\": -2", "id": i,
+             "user": {"name": "u%d" % i, "age": i}, "z": None}
+            for i in range(20)
+        ]
+        raws = [json.dumps(doc).encode("utf-8") for doc in docs]
+        raws[3] = b'[1, 2]'
+        docs[3] = [1, 2]
+
+        def loads(fields):
+            apparatus = sources.Objects(raws) \
+                      | tubes.JSONLoads(fields=fields) \
+                      | sinks.Objects()
+            return apparatus.result
+
+        records = loads(["id", "user.name", "nope"])
+        self.assertEqual(records[3], [1, 2])
+        record = records[5]
+        self.assertIsInstance(record, tubes.LazyRecord)
+        self.assertEqual(record["id"], 5)
+        self.assertEqual(record["user"]["name"], "u5")
+        self.assertNotIn("nope", record)
+        self.assertEqual(record.get("nope"), None)
+        self.assertIsNone(record.obj)
+        self.assertIsNone(record["user"].obj)
+        self.assertEqual(record["user"]["age"], 5)
+        self.assertIsNotNone(record["user"].obj)
+        self.assertIsNone(record.obj)
+        self.assertEqual(record["z"], None)
+        self.assertEqual(record, docs[5])
+        self.assertEqual(records, docs)
+
+        apparatus = sources.Objects(records) \
+                  | tubes.JSONDumps() \
+                  | sinks.Objects()
+        # LazyRecords are passed through untouched
+        self.assertEqual(apparatus.result[4:], raws[4:])
+
+        apparatus = sources.Objects(records[4:]) \
+                  | tubes.Map(lambda r: {"user": r["user"]}) \
+                  | tubes.JSONDumps(sort_keys=True) \
+                  | tubes.JSONLoads() \
+                  | sinks.Objects()
+        self.assertEqual(apparatus.result[1], {"user": docs[5]["user"]})
+
+    def testMMapFile(self):
+        data = b"".join(("line %d\n" % i).encode() for i in range(10000))
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        paths = {}
+        for name, byts in (("plain", data), ("gz", gzipped(data)),
+                           ("empty", b"")):
+            paths[name] = os.path.join(tmp, name)
+            with open(paths[name], "wb") as f:
+                f.write(byts)
+
+        source = sources.MMapFile(paths["plain"], chunk_size=1000)
+        chunk, eof = source.read()
+        self.assertIsInstance(chunk, memoryview)
+        self.assertEqual(chunk, data[:1000])
+
+        apparatus = sources.MMapFile(paths["plain"], chunk_size=1000) \
+                  | tubes.Split() \
+                  | sinks.Objects()
+        self.assertEqual(apparatus.result, data.split(b"\n"))
+
+        apparatus = sources.MMapFile(paths["gz"], chunk_size=100) \
+                  | tubes.Gunzip() \
+                  | sinks.Hash("md5")
+        self.assertEqual(apparatus.result.digest(), hashlib.md5(data).digest())
+
+        # rebuffered views are only joined when a chunk spans two of them
+        apparatus = sources.MMapFile(paths["plain"], chunk_size=1000) \
+                  | tubes.Noop(chunk_size=777) \
+                  | sinks.Bytes()
+        self.assertEqual(apparatus.result, data)
+
+        apparatus = sources.MMapFile(paths["empty"]) | sinks.Bytes()
+        self.assertEqual(apparatus.result, b"")
+
+    def testSocket(self):
+        source = sources.Socket("127.0.0.1", 0, socket.AF_INET,
+                                socket.SOCK_DGRAM, rcvbuf=2**20,
+                                chunk_size=1000, separator=b"\n")
+        reader = source.reader
+        reader.timeout = 0.01
+        addr = reader.sock.getsockname()
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(client.close)
+
+        self.assertEqual(source.read(), (b"", False))
+        lines = [("line %d" % i).encode() for i in range(200)]
+        for i, line in enumerate(lines):
+            # the separator is only added where it's missing
+            client.sendto(line + b"\n" * (i % 2), addr)
+        chunks = []
+        while sum(map(len, chunks)) < len(b"\n".join(lines)) + 1:
+            chunk, eof = source.read()
+            self.assertFalse(eof)
+            chunks.append(chunk)
+        # batched, and none bigger than a datagram over the chunk size
+        self.assertLess(len(chunks), 20)
+        self.assertTrue(all(len(chunk) < 1000 + 10 for chunk in chunks))
+        self.assertEqual(b"".join(chunks).split(b"\n")[:-1], lines)
+
+        reader.interrupt()
+        self.assertEqual(source.read(), (b"", True))
+
+        # datagrams are concatenated by default
+        source = sources.Socket("127.0.0.1", 0, socket.AF_INET,
+                                socket.SOCK_DGRAM)
+        self.addCleanup(source.reader.sock.close)
+        client.sendto(b"ab", source.reader.sock.getsockname())
+        client.sendto(b"cd", source.reader.sock.getsockname())
+        data = b""
+        while len(data) < 4:
+            data += source.read()[0]
+        self.assertEqual(data, b"abcd")
+
+    def testTCPServer(self):
+
+        def collect(source, count):
+            records = []
+            while len(records) < count:
+                chunk, eof = source.read()
+                self.assertFalse(eof)
+                records.extend(chunk)
+            return records
+
+        def connect(source):
+            client = socket.create_connection(source.reader.address)
+            self.addCleanup(client.close)
+            return client
+
+        source = sources.TCPServer("127.0.0.1", 0, chunk_size=50)
+        source.reader.timeout = 0.01
+        self.assertEqual(source.read(), ([], False))
+        expected = []
+        for i in range(3):
+            client = connect(source)
+            data = b"".join(("%d:%d\n" % (i, j)).encode() for j in range(100))
+            expected.extend(data.split(b"\n"))
+            # records straddle sends, and the last has no delimiter
+            for k in range(0, len(data), 7):
+                client.sendall(data[k:k + 7])
+            client.sendall(("%d:end" % i).encode())
+            client.close()
+            expected[-1] = ("%d:end" % i).encode()
+        self.assertEqual(sorted(collect(source, len(expected))),
+                         sorted(expected))
+
+        # a record that's too big gets the client dropped
+        source.reader.max_record = 10
+        connect(source).sendall(b"x" * 100)
+        for _ in range(100):
+            self.assertEqual(source.read(), ([], False))
+            if not source.reader.connections:
+                break
+        self.assertFalse(source.reader.connections)
+
+        source.reader.interrupt()
+        self.assertEqual(source.read(), ([], True))
+
+        # length prefixed records, with backpressure
+        source = sources.TCPServer("127.0.0.1", 0, framing="length",
+                                   max_pending=2000, chunk_size=10)
+        source.reader.timeout = 0.01
+        records = [("record %d" % i).encode() * 10 for i in range(2000)]
+        client = connect(source)
+        sender = threading.Thread(target=client.sendall, args=(b"".join(
+            struct.pack("!I", len(record)) + record for record in records
+        ),))
+        sender.start()
+        got = []
+        paused = False
+        pending = 0
+        while len(got) < len(records):
+            chunk, eof = source.read()
+            got.extend(chunk)
+            for conn in source.reader.connections:
+                paused = paused or conn.paused
+                pending = max(pending, conn.pending)
+        sender.join()
+        self.assertTrue(paused)
+        self.assertLessEqual(pending, 2000)
+        self.assertEqual(got, records)
+        source.reader.interrupt()
+        source.read()
+
+    def testBatch(self):
+
+        class Chunks(list):
+
+            def write(self, chunk):
+                self.append(list(chunk))
+
+        apparatus = sources.Objects(list(range(25)), chunk_size=3) \
+                  | tubes.Map(lambda x: x * 2) \
+                  | tubes.Batch(max_items=10) \
+                  | sinks.MakeSinkFactory(Chunks)()
+        self.assertEqual([len(c) for c in apparatus.result], [10, 10, 5])
+        self.assertEqual(sum(apparatus.result, []), list(range(0, 50, 2)))
+
+        items = [b"abcd"] * 5 + [b"x" * 20] + [b"ab"] * 3
+        apparatus = sources.Objects(items) \
+                  | tubes.Batch(max_bytes=10) \
+                  | sinks.MakeSinkFactory(Chunks)()
+        self.assertEqual([len(c) for c in apparatus.result], [2, 2, 1, 1, 3])
+
+        # a partial batch is flushed long before the source's timeout
+        source = sources.Socket("127.0.0.1", 0, socket.AF_INET,
+                                socket.SOCK_DGRAM, timeout=5, separator=b"\n")
+        client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.addCleanup(client.close)
+        for line in (b"one", b"two", b"three"):
+            client.sendto(line, source.reader.sock.getsockname())
+        tube = source \
+             | tubes.Split() \
+             | tubes.Batch(max_items=100, max_latency_ms=50)
+        start = time.time()
+        self.assertEqual(tube.read(), ([b"one", b"two", b"three"], False))
+        self.assertLess(time.time() - start, 2)
+        source.reader.interrupt()
+
+    def testVectored(self):
+        lines = [("line %d" % i).encode() for i in range(10000)]
+        expected = b"\n".join(lines)
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp)
+        for chunk_size in (None, 1000):
+            path = os.path.join(tmp, "out")
+            sources.Objects(lines) \
+                | tubes.Joined(by=b"\n", vectored=True) \
+                | sinks.File(path, "wb", chunk_size=chunk_size)
+            with open(path, "rb") as f:
+                self.assertEqual(f.read(), expected)
+
+            apparatus = sources.Objects(lines) \
+                      | tubes.Joined(by=b"\n", vectored=True) \
+                      | sinks.Hash("md5", chunk_size=chunk_size)
+            self.assertEqual(apparatus.result.digest(),
+                             hashlib.md5(expected).digest())
+
+            apparatus = sources.Objects(lines) \
+                      | tubes.Joined(vectored=True) \
+                      | sinks.Bytes(chunk_size=chunk_size)
+            self.assertEqual(apparatus.result, b"".join(lines))
+
+        # big items are gathered rather than joined
+        big = [("%d" % i).encode() * 5000 for i in range(10)]
+        apparatus = sources.Objects(big) \
+                  | tubes.Joined(by=b"\n", vectored=True) \
+                  | sinks.Hash("md5", chunk_size=3)
+        self.assertEqual(apparatus.result.digest(),
+                         hashlib.md5(b"\n".join(big)).digest())
+
+        # the plain path still works, and Bytes keeps its result on close
+        apparatus = sources.Objects(lines) \
+                  | tubes.Joined(by=b"\n") \
+                  | sinks.Bytes()
+        self.assertEqual(apparatus.result, expected)
+
+        segments = tubes.Segments([b"abc", memoryview(b"defg"), b"h"])
+        self.assertEqual(len(segments), 8)
+        reader = segments.reader()
+        self.assertEqual(reader.read(2), b"ab")
+        self.assertEqual(reader.read(), b"cdefgh")
+        reader.seek(-3, io.SEEK_END)
+        self.assertEqual(reader.read(), b"fgh")
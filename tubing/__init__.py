@@ -184,6 +184,11 @@ and be a nice noble and set it to something sensible. In our own tests, using
 2**3 for string or object streams and 2**18 for bytes streams seemed to give
 the best trade off between speed and memory usage. YMMV.
 
+If your mileage does vary, pass chunk_size="auto" to a tube, source or sink.
+An AdaptiveChunkSize will then time each read cycle and grow or shrink the
+chunk size while throughput improves, without going over AUTO_CHUNK_MEMORY
+bytes (16MiB by default) per chunk.
+
 We've explained Tubes, very well I might add. And it's a good thing. They are
 the most complicated bit in tubing. All that's left is Sources and Sinks.
 
@@ -197,11 +202,17 @@ Sinks
 
 TODO
 
+Async
+=====
+
+tubing.aio has an asyncio flavour of all of the above. Sources, transformers
+and sinks may have coroutine read, transform and write methods, and regular
+tubes and sinks are run in an executor. Awaiting the apparatus runs it.
+
 Things You Can't do with Tubing
 ===============================
 
  - Tee to another apparatus
- - async programming
  - your laundry
 
 """
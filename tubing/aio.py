@@ -0,0 +1,357 @@
+"""
+Async tubing, for asyncio. An async apparatus looks just like a regular one,
+except that nothing runs until you await it::
+
+    from tubing import aio, tubes, sinks
+
+    async def copy(reader, writer):
+        return await (aio.Stream(reader)
+                      | tubes.Gunzip()
+                      | tubes.Split()
+                      | tubes.Joined(by=b"\\n")
+                      | aio.StreamWriter(writer))
+
+Since the event loop does the waiting, one process can run hundreds of
+these side by side with asyncio.gather, without a thread per apparatus.
+
+Async readers and writers have the same interface as their sync cousins,
+except that read(amt), write(chunk), close() and abort() may be coroutines.
+Wrap them with MakeSourceFactory and MakeSinkFactory from this module.
+Transformers may have an `async def transform`, and can be made into tubes
+with the regular tubes.TransformerTubeFactory.
+
+Regular tubes and sinks can be piped into an async apparatus too. Their
+transformers and writers are run in the loop's default executor, so they don't
+block the loop. For cheap tubes, the trip to the executor costs more than the
+work, so wrap them in Inline() to run them on the loop instead. Regular
+sources can be brought along with from_sync().
+"""
+import asyncio
+import functools
+import logging
+from tubing import sources, sinks, tubes
+
+logger = logging.getLogger('tubing.aio')
+
+
+async def call(fn, *args, inline=False):
+    """
+    call runs fn, awaiting it if it's a coroutine function, and otherwise
+    running it in the default executor, unless $inline.
+    """
+    if asyncio.iscoroutinefunction(fn):
+        return await fn(*args)
+    if inline:
+        return fn(*args)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, functools.partial(fn, *args))
+
+
+def eager(fn, chunk):
+    """
+    eager runs a regular transform and forces lazy output, like the map
+    objects Map returns, so the work happens wherever eager is called.
+    """
+    r = fn(chunk)
+    if r is not None and not hasattr(r, '__len__'):
+        r = list(r)
+    return r
+
+
+def adapt(other):
+    """
+    adapt turns regular tubes and sinks into their async equivalents.
+    """
+    if isinstance(other, tubes.TransformerTube):
+        return AsyncTransformerTube(other)
+    if isinstance(other, sinks.SinkWorker):
+        return AsyncSinkWorker(other.writer, other.chunk_size)
+    return other
+
+
+class AsyncApparatus(object):
+    """
+    AsyncApparatus is the async Apparatus. Awaiting it runs it, and returns
+    the sink's result.
+    """
+
+    def __init__(self, source):
+        self.source = source
+        self.source.app = self
+        self.tubes = []
+        self.sink = None
+        self.result = None
+
+    def tail(self):
+        if self.sink:
+            return self.sink
+
+        elif self.tubes:
+            return self.tubes[-1]
+
+        else:
+            return self.source
+
+    def connect(self, part):
+        self.tail().tube(part)
+        return self
+
+    async def run(self):
+        return await self.sink.run(self)
+
+    def __await__(self):
+        return self.run().__await__()
+
+
+class AsyncSource(object):
+    """
+    AsyncSource is a wrapper for async Readers that allows piping. Readers
+    with a plain read(amt) are run in the default executor. Async apparatus
+    run on the event loop, so they can't be threaded.
+    """
+
+    def __init__(self, reader, chunk_size, threaded=False):
+        if threaded:
+            raise ValueError("async apparatus can't be threaded")
+        self.reader = reader
+        self.tuner = None
+        if isinstance(chunk_size, tubes.AdaptiveChunkSize):
+            self.tuner = chunk_size
+            chunk_size = chunk_size.size
+        self.chunk_size = chunk_size
+        self.app = None
+
+    async def read(self):
+        logger.debug("[%s] Reading %s", self.reader, self.chunk_size)
+        r = await call(self.reader.read, self.chunk_size)
+        if self.tuner:
+            self.chunk_size = self.tuner.tick(r[0])
+        return r
+
+    def __or__(self, other):
+        return self.tube(other)
+
+    def tube(self, other):
+        if not self.app:
+            AsyncApparatus(self)
+        return adapt(other).receive(self.app)
+
+    def __str__(self):
+        return "<tubing.aio.AsyncSource(%s)>" % (self.reader)
+
+
+def MakeSourceFactory(reader_cls, default_chunk_size=2**16):
+    """
+    MakeSourceFactory takes an async reader class and returns a Source
+    factory.
+    """
+    return sources.MakeSourceFactory(
+        reader_cls, default_chunk_size, source_cls=AsyncSource
+    )
+
+
+def SourceFactory(default_chunk_size=2**16):
+
+    def wrapper(cls):
+        return MakeSourceFactory(cls, default_chunk_size)
+
+    return wrapper
+
+
+def from_sync(source):
+    """
+    from_sync turns a regular Source into an AsyncSource. Its reader is run
+    in the default executor.
+    """
+    return AsyncSource(source.reader, source.tuner or source.chunk_size)
+
+
+class AsyncTransformerTube(object):
+    """
+    AsyncTransformerTube wraps a TransformerTube, to run its transformer in
+    an async apparatus.
+    """
+
+    def __init__(self, tube, inline=False):
+        self.tube = tube
+        self.inline = inline
+
+    def receive(self, apparatus):
+        tube = self.tube
+        transformer = tube.transformer_cls(*tube.args, **tube.kwargs)
+        chunk_size = tube.chunk_size
+        if chunk_size == "auto":
+            chunk_size = tubes.AdaptiveChunkSize(tube.default_chunk_size)
+        return AsyncTransformerTubeWorker(
+            apparatus, chunk_size, transformer, self.inline
+        )
+
+
+def Inline(tube):
+    """
+    Inline runs a regular tube's transformer on the event loop, instead of in
+    the executor. Use it for tubes that are cheap and never block.
+    """
+    return AsyncTransformerTube(tube, inline=True)
+
+
+class AsyncTransformerTubeWorker(tubes.TransformerTubeWorker):
+    """
+    AsyncTransformerTubeWorker is TransformerTubeWorker with an async read().
+    """
+
+    def __init__(self, apparatus, chunk_size, transformer, inline=False):
+        super(AsyncTransformerTubeWorker, self).__init__(
+            apparatus, chunk_size, transformer
+        )
+        self.inline = inline
+
+    def tube(self, other):
+        return adapt(other).receive(self.apparatus)
+
+    def fusible(self):
+        return False
+
+    async def transform(self, chunk):
+        fn = self.transformer.transform
+        if asyncio.iscoroutinefunction(fn):
+            return await fn(chunk)
+        return await call(eager, fn, chunk, inline=self.inline)
+
+    async def read(self):
+        logger.debug("[%s] Reading %s", self.transformer, self.chunk_size)
+        transformer = self.transformer
+        try:
+            while not self.read_complete():
+                inchunk, self.eof = await self.source.read()
+                if inchunk:
+                    outchunk = await self.transform(inchunk)
+                    if outchunk:
+                        self.append(outchunk)
+                if self.eof and hasattr(transformer, 'close'):
+                    # close() may depend on every item having been transformed
+                    self.buffer_len()
+                    c = await call(transformer.close, inline=self.inline)
+                    if c:
+                        self.append(c)
+                    if hasattr(transformer, 'result'):
+                        self.result = transformer.result
+
+            return self.output()
+        except:
+            logger.exception("Tube failed")
+            if hasattr(transformer, 'abort'):
+                await call(transformer.abort, inline=self.inline)
+            raise
+
+    def read_iterator(self):
+        raise TypeError("use `async for` with aiter()")
+
+    async def aiter(self):
+        while True:
+            r, eof = await self.read()
+            yield r
+            if eof:
+                return
+
+    gen = aiter
+
+
+class AsyncSinkWorker(object):
+    """
+    AsyncSinkWorker writes to an async writer, or runs a regular writer in the
+    default executor.
+    """
+
+    def __init__(self, writer, chunk_size=None):
+        self.writer = writer
+        self.chunk_size = chunk_size
+        self.source = None
+
+    def receive(self, apparatus):
+        if self.chunk_size:
+            apparatus.connect(tubes.Noop(chunk_size=self.chunk_size))
+        self.source = apparatus.tail()
+        apparatus.sink = self
+        return apparatus
+
+    async def run(self, apparatus):
+        writer = self.writer
+        try:
+            logger.debug("reading %s", self.source)
+            eof = False
+            while not eof:
+                chunk, eof = await self.source.read()
+                await call(writer.write, chunk)
+            if hasattr(writer, 'close'):
+                await call(writer.close)
+            apparatus.result = self.result()
+            return apparatus.result
+        except:
+            logger.exception("Pipe failed")
+            if hasattr(writer, 'abort'):
+                await call(writer.abort)
+            raise
+
+    def result(self):
+        if hasattr(self.writer, 'result'):
+            return self.writer.result()
+        return self.writer
+
+
+def Sink(writer_cls, *args, **kwargs):
+    chunk_size = kwargs.pop("chunk_size", None)
+    writer = writer_cls(*args, **kwargs)
+    return AsyncSinkWorker(writer, chunk_size)
+
+
+def MakeSinkFactory(writer_cls):
+    return functools.partial(Sink, writer_cls)
+
+
+def SinkFactory():
+
+    def wrapper(cls):
+        return MakeSinkFactory(cls)
+
+    return wrapper
+
+
+@SourceFactory()
+class Stream(object):
+    """
+    Stream reads bytes from an asyncio.StreamReader.
+    """
+
+    def __init__(self, reader):
+        self.reader = reader
+
+    async def read(self, amt=None):
+        r = await self.reader.read(amt or -1)
+        if r:
+            return r, False
+        else:
+            return b'', True
+
+
+@SinkFactory()
+class StreamWriter(object):
+    """
+    StreamWriter writes bytes to an asyncio.StreamWriter, waiting for it to
+    drain after every chunk. The writer is closed at EOF.
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    async def write(self, chunk):
+        self.writer.write(chunk)
+        await self.writer.drain()
+
+    async def close(self):
+        self.writer.close()
+        if hasattr(self.writer, 'wait_closed'):
+            await self.writer.wait_closed()
+
+    async def abort(self):
+        self.writer.close()
@@ -1,13 +1,113 @@
+import os
+import logging
+import threading
+try:
+    import queue
+except ImportError:  # pragma: no cover
+    import Queue as queue
+
+logger = logging.getLogger('tubing.apparatus')
+
+FUSE_TUBES = os.environ.get("FUSE_TUBES", "1") != "0"
+THREAD_QUEUE_SIZE = int(os.environ.get("THREAD_QUEUE_SIZE", 4))
+
+
+class Stopped(Exception):
+    """
+    Stopped is raised in stages that are still waiting on upstream after a
+    threaded apparatus has failed.
+    """
+    pass
+
+
+class ThreadedReader(object):
+    """
+    ThreadedReader calls read() on a stage in its own thread and hands the
+    results over through a bounded queue. The thread blocks when the queue is
+    full, so a slow consumer holds back everything upstream of it.
+
+    Exceptions are queued too, and raised again from our read(), so they
+    travel downstream through the usual abort() chain.
+    """
+
+    def __init__(self, stage, stopped, queue_size=THREAD_QUEUE_SIZE):
+        self.stage = stage
+        self.stopped = stopped
+        self.queue = queue.Queue(queue_size)
+        self.thread = threading.Thread(
+            target=self.run, name="tubing %s" % (stage,)
+        )
+        self.thread.daemon = True
+        self.started = False
+
+    def run(self):
+        try:
+            eof = False
+            while not eof and not self.stopped.is_set():
+                chunk, eof = self.stage.read()
+                self.put((chunk, eof, None))
+        except Exception as e:
+            self.put((None, True, e))
+
+    def put(self, item):
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def read(self):
+        if not self.started:
+            self.started = True
+            self.thread.start()
+        while True:
+            try:
+                chunk, eof, error = self.queue.get(timeout=0.1)
+                break
+            except queue.Empty:
+                if self.stopped.is_set():
+                    raise Stopped()
+        if error:
+            raise error
+        return chunk, eof
+
+
 class Apparatus(object):
     """
     Apparatus represents a tubing setup, from source to sink.
+
+    When fuse is True, adjacent tubes whose transformers are marked fusible
+    are collapsed into a single TransformerTubeWorker as they're connected.
+    Their results are still set on their own entries in tubes. Set
+    FUSE_TUBES=0 in the environment to turn it off by default.
+
+    When threaded is True, the source and every tube read in their own
+    thread, and pass chunks downstream through queues of queue_size chunks.
+    zlib, hashlib and file and socket I/O release the GIL, so stages really
+    do overlap. If any stage fails, the error is raised in the stages below
+    it, which abort as usual, and the stages above it are stopped. Fusion
+    would put stages back in the same thread, so unless fuse is given it's
+    off for threaded apparatus.
     """
 
-    def __init__(self, source):
+    def __init__(
+        self,
+        source,
+        fuse=None,
+        threaded=False,
+        queue_size=THREAD_QUEUE_SIZE,
+    ):
         self.source = source
         self.source.app = self
         self.tubes = []
         self.sink = None
+        if fuse is None:
+            fuse = FUSE_TUBES and not threaded
+        self.fuse = fuse
+        self.threaded = threaded
+        self.queue_size = queue_size
+        self.stopped = threading.Event()
 
     def tail(self):
         """
@@ -28,3 +128,37 @@ class Apparatus(object):
         """
         self.tail().tube(part)
         return self
+
+    def passthrough(self):
+        """
+        passthrough tells if every tube passes chunks along untouched, like
+        Noop, so the sink would write exactly what the source reads.
+        """
+        return all(
+            getattr(getattr(tube, 'transformer', None), 'transparent', False)
+            for tube in self.tubes
+        )
+
+    def start(self):
+        """
+        start returns what the sink should read from. That's the tail, unless
+        we're threaded, in which case every stage from the tail up to the
+        source is put behind a ThreadedReader.
+        """
+        tail = self.tail()
+        if not self.threaded:
+            return tail
+
+        stage = tail
+        while hasattr(stage, 'source'):
+            stage.source = ThreadedReader(
+                stage.source, self.stopped, self.queue_size
+            )
+            stage = stage.source.stage
+        return ThreadedReader(tail, self.stopped, self.queue_size)
+
+    def stop(self):
+        """
+        stop tells any threads still running to give up.
+        """
+        self.stopped.set()
@@ -0,0 +1,91 @@
+"""
+bufferpool lets sources read into preallocated buffers, instead of allocating
+a new bytes object for every chunk. File, IO, HTTP and the S3 source take a
+pool argument, and then output memoryviews of pooled bytearrays::
+
+    pool = bufferpool.BufferPool(size=2**20)
+    sources.File("huge.gz", pool=pool) | tubes.Gunzip() | sinks.File("huge")
+
+pool=True gives a source a pool of its own.
+
+A buffer goes back into the pool once nothing has a view of it anymore, so a
+chunk is never overwritten while a tube is still holding on to it. Tubes that
+hold on to data for long, like sinks.Objects, should copy it with bytes(), or
+the pool will run dry and allocate unpooled buffers like a source without a
+pool would.
+"""
+import collections
+
+
+def in_use(buf):
+    """
+    in_use tells if anything has a view of buf. A bytearray can't be resized
+    while it's exported.
+    """
+    try:
+        buf.append(0)
+    except BufferError:
+        return True
+    del buf[-1]
+    return False
+
+
+class BufferPool(object):
+    """
+    BufferPool keeps up to max_buffers bytearrays of at least size bytes.
+    """
+
+    def __init__(self, size=2**16, max_buffers=16):
+        self.size = size
+        self.max_buffers = max_buffers
+        self.buffers = collections.deque()
+        self.allocated = 0
+        self.reused = 0
+
+    def acquire(self, amt=None):
+        """
+        acquire returns a buffer of at least $amt bytes that nothing has a
+        view of. It stays out of the pool as long as there's a view of it.
+        Buffers are checked oldest first, since chunks are mostly finished
+        with in the order they were read.
+        """
+        amt = amt or self.size
+        buffers = self.buffers
+        for _ in range(len(buffers)):
+            buf = buffers[0]
+            buffers.rotate(-1)
+            if not in_use(buf):
+                if len(buf) < amt:
+                    buf.extend(bytearray(amt - len(buf)))
+                self.reused += 1
+                return buf
+
+        buf = bytearray(max(amt, self.size))
+        self.allocated += 1
+        if len(buffers) < self.max_buffers:
+            buffers.append(buf)
+        return buf
+
+    def read(self, stream, amt=None):
+        """
+        read reads up to $amt bytes from stream into a pooled buffer, and
+        returns a memoryview of them. Streams without readinto are read as
+        usual.
+        """
+        readinto = getattr(stream, 'readinto', None)
+        if readinto is None:
+            return stream.read(amt)
+        amt = amt or self.size
+        view = memoryview(self.acquire(amt))[:amt]
+        n = readinto(view)
+        # non-blocking streams return None when there's nothing to read
+        return view[:n or 0]
+
+
+def get(pool):
+    """
+    get returns pool, or a new BufferPool if pool is True.
+    """
+    if pool is True:
+        return BufferPool()
+    return pool or None
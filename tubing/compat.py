@@ -3,7 +3,27 @@ compat provides tools to make code compatible across python versions.
 """
 import sys
 
+__all__ = [
+    "PY2", "text_type", "Mapping", "release", "python_2_unicode_compatible"
+]
+
 PY2 = sys.version_info[0] == 2
+text_type = type(u"")
+
+try:
+    from collections.abc import Mapping
+except ImportError:  # pragma: no cover
+    from collections import Mapping
+
+
+def release(view):
+    """
+    release releases a memoryview's buffer now, where python has
+    memoryview.release, 3.2 and up, and leaves it to the garbage collector
+    otherwise.
+    """
+    if hasattr(view, 'release'):
+        view.release()
 
 
 def python_2_unicode_compatible(klass):
@@ -2,10 +2,15 @@ from __future__ import print_function
 """
 Elasticsearch Extension.
 """
+import collections
 import json
-import requests
 import logging
-from tubing import sources, sinks, tubes
+import time
+try:
+    from concurrent import futures
+except ImportError:  # pragma: no cover
+    futures = None
+from tubing import sources, sinks, tubes, sessions, jsoncodec
 
 logger = logging.getLogger('tubing.ext.elasticsearch')
 
@@ -65,23 +70,360 @@ class ElasticSearchError(Exception):
     pass
 
 
-@tubes.TransformerTubeFactory(2**3)
+class BulkSerializer(object):
+    """
+    BulkSerializer serializes a chunk of DocUpdates for _bulk at once. All
+    the updates with the same doc_type and parent have the same action line
+    but for the _id, so the rest of it is encoded once and the _id spliced
+    in. The docs are serialized in one pass, with the jsoncodec codec, the
+    fastest one installed by default. Anything else with a serialize method
+    serializes itself.
+
+    Output is the same JSON as DocUpdate.serialize's, though spaced
+    differently, and UTF-8 rather than escaped ASCII.
+    """
+
+    # parent ids are often unique, so there may be as many shapes as updates
+    max_shapes = 2**12
+
+    def __init__(self, codec=None):
+        self.codec = jsoncodec.get(codec)
+        self.shapes = {}
+        dumps = self.codec.dumps
+        self.upserts = {
+            flag: b'{"doc_as_upsert":' + dumps(flag) + b',"doc":'
+            for flag in (True, False)
+        }
+
+    def shape(self, doc_type, parent_esid):
+        """
+        shape returns the encoded end of an action line, everything after
+        the _id.
+        """
+        key = (doc_type, parent_esid)
+        r = self.shapes.get(key)
+        if r is None:
+            if len(self.shapes) >= self.max_shapes:
+                self.shapes.clear()
+            dumps = self.codec.dumps
+            r = b',"_type":' + dumps(doc_type)
+            if parent_esid:
+                r += b',"parent":' + dumps(parent_esid)
+            r = self.shapes[key] = r + b'}}\n'
+        return r
+
+    def serialize_many(self, updates, encoding='utf-8'):
+        dumps = self.codec.dumps
+        bodies = iter(self.codec.dumps_many(
+            [u.doc for u in updates if type(u) is DocUpdate]
+        ))
+        r = []
+        for u in updates:
+            if type(u) is not DocUpdate:
+                r.append(u.serialize(encoding))
+                continue
+            rest = self.shape(u.doc_type, u.parent_esid)
+            if u.esid:
+                action = b'{"update":{"_id":' + dumps(u.esid) + rest
+            else:
+                action = b'{"update":{' + rest[1:]
+            if type(u.doc_as_upsert) is bool:
+                upsert = self.upserts[u.doc_as_upsert]
+            else:
+                upsert = b'{"doc_as_upsert":' + dumps(u.doc_as_upsert) + \
+                    b',"doc":'
+            r.append(b''.join((action, upsert, next(bodies), b'}\n')))
+        return r
+
+
+@tubes.TransformerTubeFactory(2**10)
 class PrepareBulkUpdate(object):
     """
-    BulkSinkWriter writes bulk updates to Elastic Search. If username or
-    password is None, then auth will be skipped.
+    PrepareBulkUpdate serializes DocUpdates for BulkUpdate, a chunk at a time
+    with a BulkSerializer. codec picks its JSON library, see jsoncodec.
+    Encodings other than UTF-8 go through DocUpdate.serialize.
     """
 
-    def __init__(self, encoding='utf-8'):
+    def __init__(self, encoding='utf-8', codec=None):
         self.encoding = encoding
+        self.serializer = None
+        if jsoncodec.is_utf8(encoding):
+            self.serializer = BulkSerializer(codec)
 
     def transform(self, chunk):
+        if self.serializer is not None:
+            return self.serializer.serialize_many(chunk, self.encoding)
         data = []
         for update in chunk:
             data.append(update.serialize(self.encoding))
         return data
 
 
+# statuses that mean try again later, for a whole bulk request or one item
+RETRY_STATUSES = frozenset([429, 502, 503, 504])
+
+
+class BulkStats(object):
+    """
+    BulkStats counts what a BulkWriter has done. docs and bytes count each
+    action once, retries every time one is sent again.
+    """
+
+    def __init__(self):
+        self.docs = 0
+        self.bytes = 0
+        self.posts = 0
+        self.retries = 0
+        self.failed = 0
+        self.started = time.time()
+        self.finished = None
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def docs_per_sec(self):
+        return self.docs / (self.elapsed or 1e-9)
+
+    @property
+    def bytes_per_sec(self):
+        return self.bytes / (self.elapsed or 1e-9)
+
+    def __repr__(self):
+        return (
+            "<BulkStats %d docs, %d bytes in %d posts, %d retries, %d failed, "
+            "%.0f docs/s, %.0f bytes/s>" % (
+                self.docs, self.bytes, self.posts, self.retries, self.failed,
+                self.docs_per_sec, self.bytes_per_sec
+            )
+        )
+
+
+@sinks.SinkFactory()
+class BulkWriter(object):
+    """
+    BulkWriter posts PrepareBulkUpdate's output, one serialized action per
+    item, to an elasticsearch _bulk url, in batches of about max_bytes and at
+    most chunks_per_post chunks. It also takes pre-serialized NDJSON, as
+    bytes or Segments cut anywhere, like a file of bulk requests, and splits
+    it back into actions.
+
+    Actions the server turns away with a 429 or 50x, like when its write
+    queue is full, are sent again on their own, after backoff seconds,
+    doubling up to max_backoff, at most max_retries times. Anything else that
+    fails, or still fails after that, raises ElasticSearchError if
+    fail_on_error, and is logged and counted otherwise.
+
+    session, max_in_flight and gzip are like sinks.HTTPPost's. The result is
+    a BulkStats.
+    """
+
+    def __init__(
+        self,
+        url,
+        auth=None,
+        max_bytes=2**23,
+        chunks_per_post=512,
+        max_retries=5,
+        backoff=0.5,
+        max_backoff=30,
+        fail_on_error=True,
+        session=None,
+        max_in_flight=1,
+        gzip=False,
+    ):
+        self.url = url
+        self.auth = auth
+        self.max_bytes = max_bytes
+        self.chunks_per_post = chunks_per_post
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.fail_on_error = fail_on_error
+        self.session = session or sessions.get()
+        self.gzip = 6 if gzip is True else gzip
+        self.headers = {"Content-Type": "application/x-ndjson"}
+        if self.gzip:
+            self.headers["Content-Encoding"] = "gzip"
+        self.codec = jsoncodec.get()
+        self.max_in_flight = max_in_flight
+        self.workers = None
+        if max_in_flight > 1:
+            if futures is None:  # pragma: no cover
+                raise ImportError("max_in_flight needs concurrent.futures")
+            self.workers = futures.ThreadPoolExecutor(max_in_flight)
+        self.pending = collections.deque()
+        self.stats = BulkStats()
+        self.batch = []
+        self.size = 0
+        self.chunks = 0
+        self.tail = b''
+
+    def write(self, chunk):
+        if isinstance(chunk, tubes.Segments):
+            chunk = chunk.tobytes()
+        if isinstance(chunk, (bytes, bytearray, memoryview)):
+            chunk = self.split(bytes(chunk))
+        for action in chunk:
+            self.batch.append(action)
+            self.size += len(action)
+            if self.size >= self.max_bytes:
+                self.flush()
+        self.chunks += 1
+        if self.chunks >= self.chunks_per_post:
+            self.flush()
+
+    def split(self, data):
+        """
+        split returns the whole actions in data, an action line and, unless
+        it's a delete, its document line. What's left is kept for the next
+        chunk.
+        """
+        lines = (self.tail + data).split(b'\n')
+        tail = lines.pop()
+        actions = []
+        i = 0
+        while i < len(lines):
+            if not lines[i].strip():
+                i += 1
+                continue
+            n = 1 if 'delete' in self.codec.loads(lines[i]) else 2
+            if i + n > len(lines):
+                break
+            actions.append(b'\n'.join(lines[i:i + n]) + b'\n')
+            i += n
+        self.tail = b'\n'.join(lines[i:] + [tail])
+        return actions
+
+    def flush(self):
+        batch = self.batch
+        self.batch, self.size, self.chunks = [], 0, 0
+        if not batch:
+            return
+        if self.workers is None:
+            return self.collect(self.send(batch))
+        self.pending.append(self.workers.submit(self.send, batch))
+        while self.pending and (
+            len(self.pending) >= self.max_in_flight or self.pending[0].done()
+        ):
+            self.collect(self.pending.popleft().result())
+
+    def post(self, actions):
+        body = b''.join(actions)
+        if self.gzip:
+            body = b''.join(sinks.gzipped((body,), self.gzip))
+        return self.session.post(
+            self.url, data=body, auth=self.auth, headers=self.headers
+        )
+
+    def rejected(self, actions, resp, errors):
+        """
+        rejected returns (action, error) for each action to send again, and
+        adds the errors of those that failed for good to errors.
+        """
+        if resp.status_code in RETRY_STATUSES:
+            error = dict(status=resp.status_code, error=resp.text)
+            return [(action, error) for action in actions]
+        try:
+            body = self.codec.loads(resp.content)
+        except ValueError:
+            raise ElasticSearchError("invalid response: '%s'" % (resp.text))
+        if resp.status_code >= 300:
+            raise ElasticSearchError(
+                "HTTP %d: '%s'" % (resp.status_code, resp.text)
+            )
+        if not body.get('errors'):
+            return []
+
+        items = body.get('items') or []
+        if len(items) != len(actions):
+            raise ElasticSearchError(
+                "%d items in response to %d actions" %
+                (len(items), len(actions))
+            )
+        retry = []
+        for action, item in zip(actions, items):
+            # {"update": {"_id": ..., "status": ..., "error": ...}}
+            result = next(iter(item.values()))
+            status = result.get('status', 500)
+            if status in RETRY_STATUSES:
+                retry.append((action, result))
+            elif status >= 300:
+                errors.append(result)
+        return retry
+
+    def send(self, actions):
+        """
+        send posts a batch, and sends again whatever is rejected until it
+        gets through or runs out of retries. It returns the batch's counts
+        and errors for collect(), and may run on a worker thread.
+        """
+        docs = len(actions)
+        size = sum(len(action) for action in actions)
+        posts = retries = 0
+        errors = []
+        delay = self.backoff
+        for attempt in range(self.max_retries + 1):
+            retry = self.rejected(actions, self.post(actions), errors)
+            posts += 1
+            if not retry:
+                break
+            if attempt == self.max_retries:
+                errors.extend(error for _, error in retry)
+                break
+            logger.warning(
+                "%s rejected %d of %d actions, retrying in %.2fs", self.url,
+                len(retry), len(actions), delay
+            )
+            time.sleep(delay)
+            delay = min(delay * 2, self.max_backoff)
+            actions = [action for action, _ in retry]
+            retries += len(actions)
+        return docs, size, posts, retries, errors
+
+    def collect(self, result):
+        docs, size, posts, retries, errors = result
+        stats = self.stats
+        stats.docs += docs
+        stats.bytes += size
+        stats.posts += posts
+        stats.retries += retries
+        stats.failed += len(errors)
+        if errors:
+            msg = "%d of %d actions failed, the first with: %s" % (
+                len(errors), docs, json.dumps(errors[0])
+            )
+            if self.fail_on_error:
+                raise ElasticSearchError(msg)
+            logger.error(msg)
+
+    def close(self):
+        if self.tail.strip():
+            self.write(b'\n')
+            if self.tail.strip():
+                raise ElasticSearchError(
+                    "incomplete action at the end: '%s'" %
+                    self.tail.decode('utf-8', 'replace')
+                )
+        self.flush()
+        while self.pending:
+            self.collect(self.pending.popleft().result())
+        if self.workers is not None:
+            self.workers.shutdown(wait=True)
+        self.stats.finished = time.time()
+        logger.info("%s: %r", self.url, self.stats)
+
+    def abort(self):
+        for future in self.pending:
+            future.cancel()
+        if self.workers is not None:
+            self.workers.shutdown(wait=False)
+
+    def result(self):
+        return self.stats
+
+
 def BulkUpdate(
     base_url,
     index,
@@ -89,76 +431,132 @@ def BulkUpdate(
     password=None,
     chunks_per_post=512,
     fail_on_error=True,
+    session=None,
+    max_in_flight=1,
+    gzip=False,
+    max_bytes=2**23,
+    max_retries=5,
+    backoff=0.5,
 ):
     """
-    Docs per post is source.chunk_size * chunks_per_post.
+    BulkUpdate returns a BulkWriter sink for base_url/index/_bulk. If username
+    is None, auth is skipped.
     """
     url = "%s/%s/_bulk" % (base_url, index)
-
-    def response_handler(resp):
-        try:
-            try:
-                resp_obj = json.loads(resp.text)
-            except ValueError:
-                raise ElasticSearchError("invalid response: '%s'" % (resp.text))
-            logger.debug(resp_obj)
-
-            if resp_obj.get('errors'):
-                raise ElasticSearchError(
-                    "errors in response: '%s'" % (resp.text)
-                )
-        except:
-            logger.exception("%s %s", resp, resp.text)
-            if fail_on_error:
-                raise
-
-    return sinks.HTTPPost(
-        url=url,
-        username=username,
-        password=password,
+    return BulkWriter(
+        url,
+        auth=(username, password) if username else None,
+        max_bytes=max_bytes,
         chunks_per_post=chunks_per_post,
-        response_handler=response_handler,
+        max_retries=max_retries,
+        backoff=backoff,
+        fail_on_error=fail_on_error,
+        session=session,
+        max_in_flight=max_in_flight,
+        gzip=gzip,
     )
 
 
-@sources.SourceFactory()
+@sources.SourceFactory(1000)
 class ScrollingSearch(object):
+    """
+    ScrollingSearch outputs the hits of a scrolled search, fetched size at a
+    time. With slices=N it's a sliced scroll: N slices are scrolled at once,
+    and their hits come out in whatever order the pages arrive. Every slice
+    fetches its next page in the background while the last one is read,
+    unless prefetch=False. The other arguments are Scroller's.
+
+    If a slice fails, or the apparatus does, the other slices are stopped and
+    every scroll is cleared.
+    """
 
-    def __init__(self, chunk_size, *args, **kwargs):
-        self.chunk_size = chunk_size
-        self.es = Scroller(*args, **kwargs)
-        self.buffer = []
-        self.finished = False
-
-    def can_fill_read(self):
-        return self.chunk_size <= len(self.buffer)
-
-    def shift(self):
-        s = self.chunk_size
-        r, self.buffer = self.buffer[:s], self.buffer[s:]
-        return r
-
-    def scroll(self):
-        hits = self.es.get_hits()
-        if hits:
-            self.buffer.extend(hits)
+    def __init__(
+        self,
+        base_url,
+        index,
+        typ,
+        query,
+        slices=1,
+        size=1000,
+        prefetch=True,
+        **kwargs
+    ):
+        if futures is None:  # pragma: no cover
+            raise ImportError("ScrollingSearch needs concurrent.futures")
+        if slices > 1:
+            self.scrollers = [
+                Scroller(
+                    base_url, index, typ, query, size=size, slice_id=i,
+                    slices=slices, **kwargs
+                ) for i in range(slices)
+            ]
         else:
-            self.finished = True
-
-    def is_eof(self):
-        return len(self.buffer) == 0 and self.finished
-
-    def read(self):
-        if self.is_eof():
-            return [], True
+            self.scrollers = [
+                Scroller(base_url, index, typ, query, size=size, **kwargs)
+            ]
+        self.size = size
+        self.prefetch = prefetch
+        self.workers = futures.ThreadPoolExecutor(len(self.scrollers))
+        self.buffer = collections.deque()
+        self.pending = {}
+        # scrollers that have more to give, but no page on the way
+        self.idle = list(self.scrollers)
 
-        while not self.can_fill_read() and not self.finished:
-            self.scroll()
-
-        return self.shift(), self.is_eof()
+    def scroll(self):
+        for scroller in self.idle:
+            self.pending[self.workers.submit(scroller.get_hits)] = scroller
+        self.idle = []
+
+    def receive(self, done):
+        for future in done:
+            scroller = self.pending.pop(future)
+            hits = future.result()
+            if hits:
+                self.buffer.extend(hits)
+                self.idle.append(scroller)
+            else:
+                scroller.clear()
+
+    def read(self, amt=None):
+        amt = amt or self.size
+        try:
+            while len(self.buffer) < amt:
+                self.scroll()
+                if not self.pending:
+                    break
+                done, _ = futures.wait(
+                    list(self.pending), return_when=futures.FIRST_COMPLETED
+                )
+                self.receive(done)
+            if self.prefetch:
+                self.scroll()
+        except BaseException:
+            self.abort()
+            raise
+
+        popleft = self.buffer.popleft
+        r = [popleft() for _ in range(min(amt, len(self.buffer)))]
+        eof = not (self.buffer or self.pending or self.idle)
+        if eof:
+            self.workers.shutdown(wait=False)
+        return r, eof
+
+    def abort(self):
+        for future in self.pending:
+            future.cancel()
+        # pages already on the way bring scroll ids that need clearing too
+        self.workers.shutdown(wait=True)
+        self.pending.clear()
+        self.idle = []
+        for scroller in self.scrollers:
+            scroller.clear()
 
 
 class Scroller(object):
+    """
+    Scroller fetches the pages of a scrolled search, or of one slice of a
+    sliced scroll if it's given a slice_id and the number of slices.
+    """
 
     def __init__(
         self,
@@ -170,13 +568,22 @@ class Scroller(object):
         scroll_id=None,
         username=None,
         password=None,
+        session=None,
+        size=1000,
+        slice_id=None,
+        slices=None,
     ):
         self.base_url = base_url
+        self.session = session or sessions.get()
+        self.codec = jsoncodec.get()
         self.init_endpoint = "{}/{}/_search".format(index, typ)
         self.scroll_endpoint = "/_search/scroll"
         self.timeout = timeout
         self.scroll_id = scroll_id
+        self.size = size
         self.query = query
+        if slices:
+            self.query = dict(query, slice=dict(id=slice_id, max=slices))
         if username:
             self.auth = (username, password)
         else:
@@ -184,18 +591,36 @@ class Scroller(object):
 
     def get_hits(self):
         if not self.scroll_id:
-            endpoint = "{}{}?scroll={}&size=1000".format(
-                self.base_url, self.init_endpoint, self.timeout
+            endpoint = "{}{}?scroll={}&size={}".format(
+                self.base_url, self.init_endpoint, self.timeout, self.size
             )
-            resp = requests.get(endpoint, json=self.query, auth=self.auth)
+            resp = self.session.get(endpoint, json=self.query, auth=self.auth)
         else:
             endpoint = "{}{}".format(self.base_url, self.scroll_endpoint)
             body = dict(scroll=self.timeout, scroll_id=self.scroll_id)
-            resp = requests.get(endpoint, json=body, auth=self.auth)
+            resp = self.session.get(endpoint, json=body, auth=self.auth)
 
-        self.scroll_id = resp.json().get('_scroll_id')
-        if not self.scroll_id:
+        body = self.codec.loads(resp.content)
+        scroll_id = body.get('_scroll_id')
+        if not scroll_id:
+            # keep the last one, so it can still be cleared
             raise ValueError("No scroll_id found in {}".format(
-                json.dumps(resp.json(),
-                           indent=2)))
-        return resp.json().get('hits', {}).get('hits')
+                json.dumps(body, indent=2)))
+        self.scroll_id = scroll_id
+        return body.get('hits', {}).get('hits')
+
+    def clear(self):
+        """
+        clear frees the search context, rather than leave it to time out.
+        """
+        if not self.scroll_id:
+            return
+        endpoint = "{}{}".format(self.base_url, self.scroll_endpoint)
+        try:
+            self.session.delete(
+                endpoint, json=dict(scroll_id=[self.scroll_id]),
+                auth=self.auth
+            )
+        except Exception as e:
+            logger.warning("clearing scroll %s: %s", self.scroll_id, e)
+        self.scroll_id = None
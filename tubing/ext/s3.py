@@ -5,7 +5,7 @@ S3 Tubing extension.
 
 import boto3
 import logging
-from tubing import sources, sinks, compat
+from tubing import sources, sinks, tubes, compat, bufferpool
 
 logger = logging.getLogger('tubing.ext.s3')
 
@@ -13,20 +13,26 @@ logger = logging.getLogger('tubing.ext.s3')
 @compat.python_2_unicode_compatible
 class S3Reader(object):  # pragma: no cover
     """
-    Read file from S3. Expects AWS environmental variables to be set.
+    Read file from S3. Expects AWS environmental variables to be set. With a
+    pool, see sources.File, the body is read into pooled buffers if it
+    supports readinto.
     """
 
-    def __init__(self, bucket, key):  # pragma: no cover
+    def __init__(self, bucket, key, pool=None):  # pragma: no cover
         """
         Create an S3 Source stream.
         """
         s3 = boto3.client('s3')
         self.bucket = bucket
         self.key = key
+        self.pool = bufferpool.get(pool)
         self.response = s3.get_object(Bucket=bucket, Key=key)
 
     def read(self, amt):
-        r = self.response['Body'].read(amt)
+        if self.pool is not None:
+            r = self.pool.read(self.response['Body'], amt)
+        else:
+            r = self.response['Body'].read(amt)
         return r or b'', not r
 
     def __str__(self):
@@ -72,12 +78,16 @@ class MultipartWriter(object):  # pragma: no cover
         """
         if len(chunk):
             logger.debug("Posting %s [%d]", self.part_number, len(chunk))
+            body = chunk
+            if isinstance(chunk, tubes.Segments):
+                # boto will stream it, no need to join it first
+                body = chunk.reader()
             part = self.s3.upload_part(
                 Bucket=self.bucket,
                 Key=self.key,
                 PartNumber=self.part_number,
                 UploadId=self.upload_id,
-                Body=chunk,
+                Body=body,
             )
             self.track_part(self.part_number, part)
             self.part_number += 1
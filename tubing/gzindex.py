@@ -0,0 +1,271 @@
+"""
+gzindex builds random access indexes for gzip files, in the spirit of zlib's
+zran.c example. An index is a list of checkpoints, each recording a position
+in the compressed file, the matching position in the uncompressed data, and
+the 32KiB of uncompressed data before it, which is all inflate needs to pick
+up from there. sources.GzipRange uses them to start reading near an offset,
+instead of inflating everything before it::
+
+    from tubing import gzindex, sources, sinks
+
+    index = gzindex.build("huge.gz")  # writes huge.gz.tgzi
+    for start, end in index.shards(8):
+        sources.GzipRange("huge.gz", start, end) | ... | sinks.File(...)
+
+zran can checkpoint at any deflate block, because zlib's inflatePrime lets it
+start at any bit. Python's zlib module can't do that, so we checkpoint at
+what we can find on byte boundaries: the start of every gzip member, and
+sync flush markers (00 00 ff ff) that have been checked by inflating from
+them. pigz, tubes.ParallelGzip, bgzip and other multi-member writers produce
+plenty of those. A gzip file written in one go by gzip(1) has neither, and
+gets a single checkpoint at 0, which is still correct, just not fast.
+"""
+import bisect
+import struct
+import zlib
+
+WINDOW = 2**15
+DEFAULT_SPAN = 2**22
+SYNC = b'\x00\x00\xff\xff'
+GZIP_MAGIC = b'\x1f\x8b'
+MAGIC = b'TGZI'
+VERSION = 1
+SUFFIX = '.tgzi'
+VERIFY_SIZE = 2**14
+
+HEADER = struct.Struct('<4sBQQI')
+ENTRY = struct.Struct('<QQBBI')
+
+
+class Checkpoint(object):
+    """
+    Checkpoint is a place we can start inflating from. If member is True,
+    coffset is the start of a gzip member, otherwise it's the start of a raw
+    deflate block, bits into the byte at coffset, primed with window.
+    """
+
+    __slots__ = ('coffset', 'uoffset', 'bits', 'member', 'window')
+
+    def __init__(self, coffset, uoffset, member, window=b'', bits=0):
+        self.coffset = coffset
+        self.uoffset = uoffset
+        self.member = member
+        self.window = window
+        self.bits = bits
+
+    def __repr__(self):
+        return "<Checkpoint %d:%d>" % (self.coffset, self.uoffset)
+
+    def decompressor(self):
+        if self.member:
+            return zlib.decompressobj(32 + zlib.MAX_WBITS)
+        if self.window:
+            return zlib.decompressobj(-zlib.MAX_WBITS, zdict=self.window)
+        return zlib.decompressobj(-zlib.MAX_WBITS)
+
+
+class GzipIndex(object):
+    """
+    GzipIndex is the list of checkpoints for a gzip file, along with its
+    uncompressed length.
+    """
+
+    def __init__(self, checkpoints, length=None, span=DEFAULT_SPAN):
+        self.checkpoints = checkpoints
+        self.length = length
+        self.span = span
+        self.offsets = [c.uoffset for c in checkpoints]
+
+    def find(self, offset):
+        """
+        find returns the last checkpoint at or before uncompressed offset.
+        """
+        return self.checkpoints[bisect.bisect_right(self.offsets, offset) - 1]
+
+    def shards(self, count):
+        """
+        shards splits the uncompressed data into count (start, end) ranges
+        that each begin on a checkpoint, or fewer if we don't have enough
+        checkpoints.
+        """
+        starts = set([0])
+        for i in range(1, count):
+            starts.add(self.find(self.length * i // count).uoffset)
+        starts = sorted(starts)
+        return list(zip(starts, starts[1:] + [self.length]))
+
+    def read(self, f, start=0, end=None, read_size=2**16):
+        """
+        read is a generator of the uncompressed bytes [start, end) of the
+        gzip file f.
+        """
+        checkpoint = self.find(start)
+        skip = start - checkpoint.uoffset
+        remaining = None if end is None else end - start
+        for piece in inflate(f, checkpoint, read_size):
+            if skip:
+                if skip >= len(piece):
+                    skip -= len(piece)
+                    continue
+                piece = piece[skip:]
+                skip = 0
+            if remaining is not None:
+                piece = piece[:remaining]
+                remaining -= len(piece)
+            if piece:
+                yield piece
+            if remaining is not None and remaining <= 0:
+                return
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            f.write(
+                HEADER.pack(MAGIC, VERSION, self.span, self.length,
+                            len(self.checkpoints))
+            )
+            for c in self.checkpoints:
+                f.write(
+                    ENTRY.pack(c.coffset, c.uoffset, c.bits, c.member,
+                               len(c.window))
+                )
+                f.write(c.window)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            magic, version, span, length, count = HEADER.unpack(
+                f.read(HEADER.size)
+            )
+            if magic != MAGIC or version != VERSION:
+                raise ValueError("%s is not a gzip index" % (path))
+            checkpoints = []
+            for _ in range(count):
+                coffset, uoffset, bits, member, size = ENTRY.unpack(
+                    f.read(ENTRY.size)
+                )
+                checkpoints.append(
+                    Checkpoint(coffset, uoffset, bool(member), f.read(size),
+                               bits)
+                )
+        return cls(checkpoints, length, span)
+
+
+def inflate(f, checkpoint, read_size=2**16):
+    """
+    inflate is a generator of uncompressed data, from checkpoint to the end of
+    the gzip file f. Pieces are at most read_size bytes.
+    """
+    f.seek(checkpoint.coffset)
+    d = checkpoint.decompressor()
+    raw = not checkpoint.member
+    data = b''
+    while True:
+        if not data:
+            data = f.read(read_size)
+            if not data:
+                return
+        out = d.decompress(data, read_size)
+        data = d.unconsumed_tail
+        if out:
+            yield out
+        if d.eof:
+            rest = d.unused_data
+            if raw:
+                # the member's trailer is still ahead of us
+                rest = _fill(f, rest, 8, read_size)[8:]
+            rest = _fill(f, rest, 2, read_size)
+            if rest[:2] != GZIP_MAGIC:
+                return
+            d = zlib.decompressobj(32 + zlib.MAX_WBITS)
+            raw = False
+            data = rest
+
+
+def _fill(f, data, amt, read_size):
+    while len(data) < amt:
+        more = f.read(read_size)
+        if not more:
+            break
+        data += more
+    return data
+
+
+def _verify(f, coffset, d, window):
+    """
+    _verify checks that inflating from coffset with window gives the same
+    output as d, which is sitting at coffset, would.
+    """
+    pos = f.tell()
+    f.seek(coffset)
+    probe = f.read(VERIFY_SIZE)
+    f.seek(pos)
+    if not probe:
+        return False
+    try:
+        expected = d.copy().decompress(probe)
+        got = Checkpoint(coffset, 0, False, window).decompressor() \
+            .decompress(probe)
+    except zlib.error:
+        return False
+    return got == expected
+
+
+def build(path, span=DEFAULT_SPAN, index_path=None, read_size=2**16):
+    """
+    build inflates the whole gzip file at path once, recording a checkpoint
+    roughly every span uncompressed bytes, where one can be found. The index
+    is saved next to the file, or to index_path, and returned.
+    """
+    checkpoints = [Checkpoint(0, 0, True)]
+    last = 0
+    upos = 0
+    window = b''
+    d = zlib.decompressobj(32 + zlib.MAX_WBITS)
+    with open(path, 'rb') as f:
+        base = 0
+        buf = b''
+        while True:
+            if not buf:
+                base = f.tell()
+                buf = f.read(read_size)
+                if not buf:
+                    break
+
+            # only stop at sync markers when a checkpoint is due; markers
+            # split across reads are missed, but there's always another
+            candidate = False
+            end = len(buf)
+            if upos - last >= span:
+                i = buf.find(SYNC)
+                if i != -1:
+                    candidate = True
+                    end = i + len(SYNC)
+
+            out = d.decompress(buf[:end])
+            if out:
+                upos += len(out)
+                window = (window + out[-WINDOW:])[-WINDOW:]
+
+            if d.eof:
+                rest = d.unused_data + buf[end:]
+                base += end - len(d.unused_data)
+                rest = _fill(f, rest, 2, read_size)
+                if rest[:2] != GZIP_MAGIC:
+                    break
+                d = zlib.decompressobj(32 + zlib.MAX_WBITS)
+                window = b''
+                buf = rest
+                if upos - last >= span:
+                    checkpoints.append(Checkpoint(base, upos, True))
+                    last = upos
+                continue
+
+            base += end
+            buf = buf[end:]
+            if candidate and _verify(f, base, d, window):
+                checkpoints.append(Checkpoint(base, upos, False, window))
+                last = upos
+
+    index = GzipIndex(checkpoints, upos, span)
+    index.save(index_path or path + SUFFIX)
+    return index
@@ -0,0 +1,182 @@
+"""
+jsoncodec picks the JSON library that JSONLoads and JSONDumps use. We know
+about orjson, ujson and the standard library's json. Parsing uses the first
+one that's installed, in that order, unless $JSON_CODEC or a tube's codec
+argument names one::
+
+    tubes.JSONLoads(codec="ujson")
+
+Serializing uses the standard library unless a codec is named, because the
+others don't write the same bytes: they leave out the spaces after "," and
+":", and orjson doesn't escape non-ASCII characters. JSONDumps(codec="orjson")
+or $JSON_CODEC opts in to the faster output.
+
+Codecs parse bytes or text, and always serialize to UTF-8 bytes, so the fast
+libraries never round trip through str. The batch calls, loads_many and
+dumps_many, do a whole chunk at a time. Register other libraries with
+register(). `jsoncodec.get().name` says which one is active by default,
+and the choice each tube makes is logged at debug level.
+
+The libraries don't all agree. orjson doesn't escape non-ASCII characters,
+writes NaN as null, and only understands the sort_keys, indent=2 and default
+keyword arguments. If you pass JSONDumps options a codec can't honour, and
+didn't ask for that codec by name, the next one is used. orjson and json
+serialize any Mapping, ujson only dicts.
+"""
+import codecs
+import collections
+import functools
+import json
+import logging
+import os
+from tubing import compat
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+logger = logging.getLogger('tubing.jsoncodec')
+
+JSON_CODEC = os.environ.get("JSON_CODEC")
+
+CODECS = collections.OrderedDict()
+
+
+def register(name, factory):
+    """
+    register makes factory available as codec $name. factory is called with
+    the JSONDumps keyword arguments, and should raise TypeError if it can't
+    honour them.
+    """
+    CODECS[name] = factory
+
+
+def available():
+    return list(CODECS)
+
+
+def get(codec=None, compatible=False, **kwargs):
+    """
+    get returns a codec instance. codec may be a name, a codec instance, or
+    None for $JSON_CODEC or else the fastest one installed, or the standard
+    library's if compatible output is wanted.
+    """
+    if hasattr(codec, 'loads'):
+        return codec
+    codec = codec or JSON_CODEC or (compatible and "json")
+    if codec:
+        if codec not in CODECS:
+            raise ValueError(
+                "JSON codec %r is not available, have %s" %
+                (codec, ", ".join(CODECS))
+            )
+        r = CODECS[codec](**kwargs)
+        logger.debug("Using %r", r)
+        return r
+
+    for factory in CODECS.values():
+        try:
+            r = factory(**kwargs)
+        except TypeError:
+            continue
+        logger.debug("Using %r", r)
+        return r
+    raise TypeError("No JSON codec accepts %s" % (sorted(kwargs)))
+
+
+def is_utf8(encoding):
+    return codecs.lookup(encoding).name == 'utf-8'
+
+
+def mappings(default=None):
+    """
+    mappings returns a default hook for dumps that serializes Mappings that
+    aren't dicts, like tubes.LazyRecord, as dicts, and hands anything else to
+    default.
+    """
+
+    def hook(obj):
+        if isinstance(obj, compat.Mapping):
+            return dict(obj)
+        if default:
+            return default(obj)
+        raise TypeError("%r is not JSON serializable" % (obj,))
+
+    return hook
+
+
+class Codec(object):
+    """
+    Codec is the interface. Subclasses set name, and loads(raw) and
+    dumps(obj), which returns UTF-8 bytes.
+    """
+
+    name = None
+
+    def loads_many(self, raws):
+        loads = self.loads
+        return [loads(raw) for raw in raws]
+
+    def dumps_many(self, objs):
+        dumps = self.dumps
+        return [dumps(obj) for obj in objs]
+
+    def __repr__(self):
+        return "<tubing.jsoncodec %s>" % (self.name)
+
+
+class OrjsonCodec(Codec):
+
+    name = "orjson"
+
+    def __init__(self, sort_keys=False, indent=None, default=None):
+        option = orjson.OPT_NON_STR_KEYS
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent == 2:
+            option |= orjson.OPT_INDENT_2
+        elif indent is not None:
+            raise TypeError("orjson only supports indent=2")
+        self.loads = orjson.loads
+        self.dumps = functools.partial(
+            orjson.dumps, default=mappings(default), option=option
+        )
+
+
+class UjsonCodec(Codec):
+
+    name = "ujson"
+
+    def __init__(self, **kwargs):
+        # raises TypeError now, rather than on the first chunk
+        ujson.dumps(None, **kwargs)
+        self.loads = ujson.loads
+        self.kwargs = kwargs
+
+    def dumps(self, obj):
+        return ujson.dumps(obj, **self.kwargs).encode('utf-8')
+
+
+class StdlibCodec(Codec):
+
+    name = "json"
+
+    def __init__(self, cls=json.JSONEncoder, default=None, **kwargs):
+        self.encode = cls(default=mappings(default), **kwargs).encode
+
+    def loads(self, raw):
+        return json.loads(raw)
+
+    def dumps(self, obj):
+        return self.encode(obj).encode('utf-8')
+
+
+if orjson is not None:
+    register("orjson", OrjsonCodec)
+if ujson is not None:
+    register("ujson", UjsonCodec)
+register("json", StdlibCodec)
@@ -0,0 +1,101 @@
+"""
+kernelcopy copies between file descriptors without the bytes passing through
+Python. It tries os.copy_file_range, os.sendfile and os.splice, in that order,
+and moves on to the next whenever the platform or the descriptors involved
+don't support one. Between them they cover file to file, and pipe or socket to
+anything.
+
+Every method reads and writes at the descriptors' current offsets, and leaves
+them just past what was copied, so whatever they couldn't copy can be finished
+by ordinary reads and writes.
+"""
+import errno
+import logging
+import os
+import sys
+
+logger = logging.getLogger('tubing.kernelcopy')
+
+KERNEL_COPY = os.environ.get("KERNEL_COPY", "1") != "0"
+
+# as much as each call may copy, linux stops at 2GiB - 4KiB anyway
+BLOCK = 2**30
+PIPE_SIZE = 2**16
+
+# errors that mean a method can't be used here, rather than a real failure
+UNSUPPORTED = set(
+    getattr(errno, name) for name in (
+        'EXDEV', 'EINVAL', 'ENOSYS', 'EBADF', 'ESPIPE', 'EOPNOTSUPP',
+        'ENOTSUP', 'EAGAIN'
+    ) if hasattr(errno, name)
+)
+
+
+def copy_file_range(src, dst, pipe):
+    return os.copy_file_range(src, dst, BLOCK)
+
+
+def sendfile(src, dst, pipe):
+    return os.sendfile(dst, src, None, BLOCK)
+
+
+def splice(src, dst, pipe):
+    r, w = pipe
+    n = os.splice(src, w, PIPE_SIZE)
+    left = n
+    try:
+        while left:
+            left -= os.splice(r, dst, left)
+    except OSError as e:
+        # don't lose what's already in the pipe
+        while left:
+            data = os.read(r, left)
+            left -= len(data)
+            while data:
+                data = data[os.write(dst, data):]
+        e.copied = n
+        raise
+    return n
+
+
+METHODS = []
+if hasattr(os, 'copy_file_range'):
+    METHODS.append(copy_file_range)
+# elsewhere sendfile wants an explicit offset, and a socket to write to
+if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+    METHODS.append(sendfile)
+if hasattr(os, 'splice'):
+    METHODS.append(splice)
+
+
+def copy(src, dst):
+    """
+    copy copies from file descriptor src to dst until EOF. It returns how
+    many bytes it copied, and whether it got to EOF. If it didn't, the rest
+    is left for the caller to copy.
+    """
+    copied = 0
+    pipe = None
+    try:
+        for method in METHODS:
+            if method is splice and pipe is None:
+                pipe = os.pipe()
+            try:
+                while True:
+                    n = method(src, dst, pipe)
+                    if not n:
+                        logger.debug("%s copied %d bytes", method.__name__,
+                                     copied)
+                        return copied, True
+                    copied += n
+            except OSError as e:
+                if e.errno not in UNSUPPORTED:
+                    raise
+                copied += getattr(e, 'copied', 0)
+                logger.debug("%s failed after %d bytes: %s", method.__name__,
+                             copied, e)
+        return copied, False
+    finally:
+        if pipe is not None:
+            os.close(pipe[0])
+            os.close(pipe[1])
@@ -0,0 +1,71 @@
+"""
+sessions keeps the requests Session that HTTP sources and sinks share, so
+connections are kept alive and reused, across requests and across apparatus,
+instead of paying for a new TCP and TLS handshake every time. sources.HTTP,
+sinks.HTTPPost and the elasticsearch extension all use it, unless they're
+given a session of their own.
+
+The pool holds connections to up to $HTTP_POOL_CONNECTIONS hosts, and up to
+$HTTP_POOL_MAXSIZE connections to each, or whatever configure() says. The
+shared session never keeps cookies, so one apparatus can't leak them into
+another's requests.
+"""
+import os
+import threading
+from requests import Session
+from requests.adapters import HTTPAdapter
+try:
+    from http import cookiejar
+except ImportError:  # pragma: no cover
+    import cookielib as cookiejar
+
+POOL_CONNECTIONS = int(os.environ.get("HTTP_POOL_CONNECTIONS", 10))
+POOL_MAXSIZE = int(os.environ.get("HTTP_POOL_MAXSIZE", 16))
+
+settings = dict(
+    pool_connections=POOL_CONNECTIONS,
+    pool_maxsize=POOL_MAXSIZE,
+    max_retries=0,
+)
+lock = threading.Lock()
+shared = None
+
+
+def new(**kwargs):
+    """
+    new returns a Session with its own pool, set up like the shared one, with
+    any of configure()'s arguments overridden.
+    """
+    options = dict(settings, **kwargs)
+    s = Session()
+    s.cookies.set_policy(cookiejar.DefaultCookiePolicy(allowed_domains=[]))
+    adapter = HTTPAdapter(**options)
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+    return s
+
+
+def get():
+    """
+    get returns the shared session.
+    """
+    global shared
+    if shared is None:
+        with lock:
+            if shared is None:
+                shared = new()
+    return shared
+
+
+def configure(**kwargs):
+    """
+    configure changes the shared pool's pool_connections, pool_maxsize or
+    max_retries, see requests.adapters.HTTPAdapter. Connections already in the
+    pool are closed.
+    """
+    global shared
+    with lock:
+        settings.update(kwargs)
+        old, shared = shared, None
+    if old is not None:
+        old.close()
@@ -12,28 +12,85 @@ exception in the pipeline. Here's an example::
 
     MySink = MakeSink(MyWriter)
 """
-import requests
+import collections
 import logging
 import io
+import os
 import functools
 import hashlib
+import zlib
+try:
+    from concurrent import futures
+except ImportError:  # pragma: no cover
+    futures = None
+from tubing import tubes, kernelcopy, sessions
 
 logger = logging.getLogger('tubing.sinks')
 
+IOV_MAX = 1024
+if hasattr(os, 'sysconf'):
+    try:
+        IOV_MAX = os.sysconf('SC_IOV_MAX')
+    except (ValueError, OSError):  # pragma: no cover
+        pass
+
+
+def writev(fn, fd, parts):
+    """
+    writev writes all of parts to fd with fn, an os.writev, picking up after
+    short writes and staying under IOV_MAX buffers per call.
+    """
+    i = 0
+    while i < len(parts):
+        batch = parts[i:i + IOV_MAX]
+        total = sum(len(part) for part in batch)
+        n = fn(fd, batch)
+        i += len(batch)
+        if n < total:
+            # short write, finish this batch the slow way
+            rest = b''.join(batch)[n:]
+            while rest:
+                rest = rest[os.write(fd, rest):]
+
+
+def fileno(obj):
+    """
+    fileno returns obj's file descriptor, or None if it doesn't have one.
+    """
+    if not hasattr(obj, 'fileno'):
+        return None
+    try:
+        return obj.fileno()
+    except (IOError, ValueError):
+        # io.UnsupportedOperation, from BytesIO and friends, is both
+        return None
+
+
+def kernel_copies(obj, method):
+    """
+    kernel_copies tells if obj opts in to kernelcopy, with kernel_copy = True
+    in the class that defines its read or write method. A subclass that
+    overrides that method, to count or change what goes through it, has to
+    opt in again, or it's called as usual.
+    """
+    for klass in type(obj).__mro__:
+        if method in vars(klass):
+            return vars(klass).get('kernel_copy', False)
+    return False
+
 
 class SinkRunner(object):
 
     def __init__(self, apparatus, sink):
         self.apparatus = apparatus
-        self.source = self.apparatus.tail()
+        self.source = self.apparatus.start()
         self.apparatus.sink = self
         self.sink = sink
 
     def __call__(self):
         try:
+            eof = self.copy()
             logger.debug("reading %s", self.source)
-            chunk, eof = self.source.read()
-            self.sink.write(chunk)
             while not eof:
                 chunk, eof = self.source.read()
                 self.sink.write(chunk)
@@ -41,14 +98,44 @@ class SinkRunner(object):
             return self.sink.writer
         except:
             logger.exception("Pipe failed")
+            self.apparatus.stop()
+            reader = getattr(self.apparatus.source, 'reader', None)
+            hasattr(reader, 'abort') and reader.abort()
             hasattr(self.sink, 'abort') and self.sink.abort()
             raise
 
 
+    def copy(self):
+        """
+        copy has the kernel copy the source straight to the sink, when both
+        are file descriptors that opt in, see kernel_copies, and every tube
+        in between is transparent. It
+        returns True if that copied everything, otherwise the usual read loop
+        carries on from wherever it stopped.
+        """
+        if not kernelcopy.KERNEL_COPY or not self.apparatus.passthrough():
+            return False
+        reader = getattr(self.apparatus.source, 'reader', None)
+        writer = self.sink.writer
+        if not kernel_copies(reader, 'read') or \
+                not kernel_copies(writer, 'write'):
+            return False
+        src = fileno(reader)
+        if src is None:
+            return False
+        dst = fileno(writer)
+        if dst is None:
+            return False
+        copied, eof = kernelcopy.copy(src, dst)
+        logger.debug("kernel copied %d bytes from %s", copied, reader)
+        return eof
+
+
 class SinkWorker(object):
 
-    def __init__(self, writer):
+    def __init__(self, writer, chunk_size=None):
         self.writer = writer
+        self.chunk_size = chunk_size
 
     def write(self, chunk):
         self.writer.write(chunk)
@@ -66,14 +153,18 @@ class SinkWorker(object):
         return self.writer
 
     def receive(self, apparatus):
+        if self.chunk_size:
+            # rebuffer upstream so we're written chunk_size at a time
+            apparatus.connect(tubes.Noop(chunk_size=self.chunk_size))
         SinkRunner(apparatus, self)()
         apparatus.result = self.result()
         return apparatus
 
 
 def Sink(writer_cls, *args, **kwargs):
+    chunk_size = kwargs.pop("chunk_size", None)
     writer = writer_cls(*args, **kwargs)
-    return SinkWorker(writer)
+    return SinkWorker(writer, chunk_size)
 
 
 def MakeSinkFactory(sink_cls):
@@ -105,27 +196,64 @@ class Bytes(io.BytesIO):
     on close().
     """
 
+    # SinkFactory rebinds the name Bytes, so we can't use super() here
+
     def __init__(self, *args, **kwargs):
-        super(Bytes, self).__init__(*args, **kwargs)
+        io.BytesIO.__init__(self, *args, **kwargs)
+        self.value = None
+
+    def write(self, chunk):
+        if isinstance(chunk, tubes.Segments):
+            self.writelines(chunk)
+        else:
+            io.BytesIO.write(self, chunk)
 
     def close(self):
-        super(Bytes, self).close()
+        if self.value is None and not self.closed:
+            self.value = self.getvalue()
+        io.BytesIO.close(self)
 
     def abort(self):
-        super(Bytes, self).close()
+        io.BytesIO.close(self)
 
     def result(self):
-        return self.getvalue()
+        return self.value
 
 
 @SinkFactory()
 class File(object):
+    """
+    File writes to a file. Segments are written with os.writev() when the
+    file is binary and the platform has it.
+    """
+
+    kernel_copy = True
 
     def __init__(self, *args, **kwargs):
         self.f = open(*args, **kwargs)
+        self.writev = None
+        if hasattr(os, 'writev') and 'b' in self.f.mode:
+            self.writev = os.writev
 
     def write(self, chunk):
-        self.f.write(chunk)
+        if isinstance(chunk, tubes.Segments):
+            if self.writev:
+                self.f.flush()
+                writev(self.writev, self.f.fileno(), chunk.parts)
+            else:
+                self.f.writelines(chunk)
+        else:
+            self.f.write(chunk)
+
+    def fileno(self):
+        """
+        fileno returns the file descriptor for kernelcopy to write to, if the
+        file is binary.
+        """
+        if 'b' not in self.f.mode:
+            return None
+        self.f.flush()
+        return self.f.fileno()
 
     def close(self):
         self.f.close()
@@ -155,7 +283,11 @@ class Hash(object):
         self.hsh = hashlib.new(algorithm)
 
     def write(self, chunk):
-        self.hsh.update(chunk)
+        if isinstance(chunk, tubes.Segments):
+            for part in chunk:
+                self.hsh.update(part)
+        else:
+            self.hsh.update(chunk)
 
     def result(self):
         return self.hsh
@@ -198,10 +330,30 @@ class Stdout(object):
         print(chunk,)
 
 
+def gzipped(parts, level):
+    """
+    gzipped compresses an iterable of byte strings into a gzip stream.
+    """
+    z = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for part in parts:
+        r = z.compress(part)
+        if r:
+            yield r
+    yield z.flush()
+
+
 class HTTPPost(object):
     """
     HTTPPost doesn't support the write method, and therefore can not be used
-    with tubes.Tee.
+    with tubes.Tee. Posts go over the shared sessions pool, or session if one
+    is given.
+
+    Every post streams the next chunks_per_post chunks, so the pipeline waits
+    on the server for each one. With max_in_flight > 1, bodies are put
+    together in memory instead, and up to max_in_flight of them are posted at
+    once on a thread pool while the next is read. Responses are still handed
+    to response_handler in order. gzip=True, or a compression level, gzips
+    bodies and sends Content-Encoding: gzip.
     """
 
     def __init__(
@@ -210,26 +362,30 @@ class HTTPPost(object):
         username=None,
         password=None,
         chunks_per_post=2**10,
-        response_handler=lambda _: None
+        response_handler=lambda _: None,
+        session=None,
+        max_in_flight=1,
+        gzip=False,
     ):
         self.url = url
+        self.session = session or sessions.get()
         if username:
             self.auth = (username, password)
         else:
             self.auth = None
         self.chunks_per_post = chunks_per_post
         self.response_handler = response_handler
+        self.max_in_flight = max_in_flight
+        if max_in_flight > 1 and futures is None:  # pragma: no cover
+            raise ImportError("max_in_flight needs concurrent.futures")
+        self.gzip = 6 if gzip is True else gzip
+        self.headers = {"Content-Encoding": "gzip"} if self.gzip else None
         self.eof = False
 
-    def gen(self):
-        """
-        We have to do this goofy shit because requests.post doesn't give
-        access to the socket directly. In order to stream, we need to pass
-        a generator object to requests.
-        """
+    def parts(self):
         for _ in range(self.chunks_per_post):
             r, self.eof = self.source.read()
-            if isinstance(r, list):
+            if isinstance(r, (list, tubes.Segments)):
                 for l in r:
                     yield l
             else:
@@ -237,12 +393,57 @@ class HTTPPost(object):
             if self.eof:
                 return
 
+    def gen(self):
+        """
+        We have to do this goofy shit because requests.post doesn't give
+        access to the socket directly. In order to stream, we need to pass
+        a generator object to requests.
+        """
+        if self.gzip:
+            return gzipped(self.parts(), self.gzip)
+        return self.parts()
+
+    def post(self, data):
+        if self.gzip and isinstance(data, bytes):
+            data = b''.join(gzipped((data,), self.gzip))
+        return self.session.post(
+            self.url, data=data, auth=self.auth, headers=self.headers
+        )
+
+    def handle(self, r):
+        self.response_handler(r)
+        self.apparatus.result.append(r)
+
+    def post_in_flight(self):
+        workers = futures.ThreadPoolExecutor(self.max_in_flight)
+        pending = collections.deque()
+        try:
+            while not self.eof or pending:
+                if not self.eof:
+                    body = b''.join(self.parts())
+                    if body:
+                        pending.append(workers.submit(self.post, body))
+                while pending and (
+                    self.eof or len(pending) >= self.max_in_flight or
+                    pending[0].done()
+                ):
+                    self.handle(pending.popleft().result())
+        finally:
+            for future in pending:
+                future.cancel()
+            workers.shutdown(wait=False)
+
     def receive(self, apparatus):
-        self.source = apparatus.tail()
+        self.source = apparatus.start()
+        self.apparatus = apparatus
         apparatus.sink = self
         apparatus.result = []
-        while not self.eof:
-            r = requests.post(self.url, data=self.gen(), auth=self.auth)
-            self.response_handler(r)
-            apparatus.result.append(r)
+        try:
+            if self.max_in_flight > 1:
+                self.post_in_flight()
+            while not self.eof:
+                self.handle(self.post(self.gen()))
+        except:
+            apparatus.stop()
+            raise
         return apparatus
@@ -13,15 +13,29 @@ read. MakeSourceFactory can generate a Source from your Reader. Ex::
 The read(amt) function should return a chunk of data and a boolean indicated if
 we've reached EOF. Unlike normal python streams, it's ok to return empty sets
 and it won't close the stream. Only returning True as the second parameter
-indicates that the stream is closed.
+indicates that the stream is closed. Readers may also have an abort()
+function, which is called if the apparatus fails before they reach EOF.
 """
+import collections
+import errno
 import logging
+import mmap
+import os
 import socket
 import signal
+import struct
 import io
 import sys
-from requests import Session, Request
-from tubing import compat, apparatus
+try:
+    import selectors
+except ImportError:  # pragma: no cover
+    selectors = None
+try:
+    from concurrent import futures
+except ImportError:  # pragma: no cover
+    futures = None
+from requests import Request
+from tubing import compat, apparatus, tubes, gzindex, bufferpool, sessions
 
 logger = logging.getLogger('tubing.sources')
 
@@ -60,18 +74,22 @@ class MakeSourceFactory(object):
     MakeSourceFactory takes a reader object and returns a Source factory.
     """
 
-    def __init__(self, reader_cls, default_chunk_size=2**16):
+    def __init__(self, reader_cls, default_chunk_size=2**16, source_cls=None):
         self.reader_cls = reader_cls
         self.default_chunk_size = default_chunk_size
+        self.source_cls = source_cls or Source
 
     def __call__(self, *args, **kwargs):
         chunk_size = self.default_chunk_size
         if kwargs.get("chunk_size"):
             chunk_size = kwargs["chunk_size"]
             del kwargs["chunk_size"]
+        threaded = kwargs.pop("threaded", False)
 
+        if chunk_size == "auto":
+            chunk_size = tubes.AdaptiveChunkSize(self.default_chunk_size)
         reader = self.reader_cls(*args, **kwargs)
-        src = Source(reader, chunk_size)
+        src = self.source_cls(reader, chunk_size, threaded)
         if hasattr(reader, 'interrupt'):
             HANDLERS.append(reader.interrupt)
         return src
@@ -80,17 +98,26 @@ class MakeSourceFactory(object):
 @compat.python_2_unicode_compatible
 class Source(object):
     """
-    Source is a wrapper for Readers that allows piping.
+    Source is a wrapper for Readers that allows piping. If threaded is True,
+    the apparatus it starts runs each stage in its own thread.
     """
 
-    def __init__(self, reader, chunk_size):
+    def __init__(self, reader, chunk_size, threaded=False):
         self.reader = reader
+        self.threaded = threaded
+        self.tuner = None
+        if isinstance(chunk_size, tubes.AdaptiveChunkSize):
+            self.tuner = chunk_size
+            chunk_size = chunk_size.size
         self.chunk_size = chunk_size
         self.app = None
 
     def read(self):
         logger.debug("[%s] Reading %s", self.reader, self.chunk_size)
-        return self.reader.read(self.chunk_size)
+        r = self.reader.read(self.chunk_size)
+        if self.tuner:
+            self.chunk_size = self.tuner.tick(r[0])
+        return r
 
     def __or__(self, other):
         return self.tube(other)
@@ -98,7 +125,7 @@ class Source(object):
     def tube(self, other):
         if not self.app:
             # apparatus sets app on Source
-            apparatus.Apparatus(self)
+            apparatus.Apparatus(self, threaded=self.threaded)
         return other.receive(self.app)
 
     def __str__(self):
@@ -120,57 +147,520 @@ class Objects(object):
 
 
 @SourceFactory()
+@compat.python_2_unicode_compatible
 class File(object):
     """
-    File outputs bytes.
+    File outputs bytes. Given a bufferpool.BufferPool, or pool=True, binary
+    files are read into pooled buffers, and output as memoryviews.
     """
 
-    def __init__(self, filename, mode="rb"):
+    kernel_copy = True
+
+    def __init__(self, filename, mode="rb", pool=None):
         self.filename = filename
+        self.pool = bufferpool.get(pool)
+        if self.pool is not None and 'b' not in mode:
+            raise ValueError("File can only read binary modes into a pool")
         self.f = open(self.filename, mode)
 
     def read(self, amt=None):
-        chunk = self.f.read(amt)
-        if chunk:
-            return chunk, False
+        if self.pool is not None:
+            chunk = self.pool.read(self.f, amt)
         else:
-            return '', True
+            chunk = self.f.read(amt)
+        # an empty read is b'' or '' depending on mode
+        return chunk, not chunk
+
+    def fileno(self):
+        """
+        fileno returns the file descriptor to copy from with kernelcopy, if
+        it's binary and nothing has been read past where we are.
+        """
+        if 'b' not in self.f.mode:
+            return None
+        fd = self.f.fileno()
+        if self.f.tell() != os.lseek(fd, 0, os.SEEK_CUR):
+            return None
+        return fd
 
-    def __unicode__(self):
+    def __str__(self):
         return u"<tubing.sources.File %s>" % (self.filename)
 
+
+MADV_SEQUENTIAL = getattr(mmap, 'MADV_SEQUENTIAL', None)
+MADV_WILLNEED = getattr(mmap, 'MADV_WILLNEED', None)
+
+
+@SourceFactory()
+@compat.python_2_unicode_compatible
+class MMapFile(object):
+    """
+    MMapFile outputs memoryview slices of a memory mapped file, so pages
+    already in the page cache are never copied into bytes. The kernel is told
+    we read sequentially, and asked to read readahead bytes ahead of us.
+    Gunzip, Split, Hash and the byte sinks all take memoryviews.
+    """
+
+    readahead = 2**24
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as f:
+            self.size = os.fstat(f.fileno()).st_size
+            # mapping an empty file is an error
+            self.mm = None
+            if self.size:
+                self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mm if self.mm is not None else b'')
+        self.pos = 0
+        self.advised = 0
+        self.advise(MADV_SEQUENTIAL, 0, self.size)
+
+    def advise(self, option, start, length):
+        if option is not None and length > 0 \
+                and hasattr(self.mm, 'madvise'):
+            self.mm.madvise(option, start, length)
+
+    def read(self, amt=None):
+        start = self.pos
+        end = self.size if amt is None else min(start + amt, self.size)
+        if end > self.advised:
+            page = start - start % mmap.PAGESIZE
+            self.advised = min(end + self.readahead, self.size)
+            self.advise(MADV_WILLNEED, page, self.advised - page)
+        r = self.view[start:end]
+        self.pos = end
+        eof = end >= self.size
+        if eof:
+            self.close()
+        return r, eof
+
+    def close(self):
+        compat.release(self.view)
+        if self.mm is not None:
+            try:
+                self.mm.close()
+            except BufferError:
+                # views are still out there, it's unmapped when they're gone
+                pass
+
+    def __str__(self):
+        return u"<tubing.sources.MMapFile %s>" % (self.filename)
+
+
+@SourceFactory()
+@compat.python_2_unicode_compatible
+class GzipRange(object):
+    """
+    GzipRange outputs the uncompressed bytes [start, end) of a gzip file. It
+    starts inflating from the nearest checkpoint in the file's gzindex, which
+    is read from $filename.tgzi unless index is given. Without an index, it
+    inflates from the beginning, like File | Gunzip would.
+    """
+
+    def __init__(self, filename, start=0, end=None, index=None):
+        self.filename = filename
+        self.start = start
+        self.end = end
+        if index is None:
+            try:
+                index = gzindex.GzipIndex.load(filename + gzindex.SUFFIX)
+            except IOError:
+                index = gzindex.GzipIndex([gzindex.Checkpoint(0, 0, True)])
+        elif not isinstance(index, gzindex.GzipIndex):
+            index = gzindex.GzipIndex.load(index)
+        self.index = index
+        self.f = open(filename, "rb")
+        self.pieces = None
+
+    def read(self, amt=None):
+        if self.pieces is None:
+            self.pieces = self.index.read(
+                self.f, self.start, self.end, amt or 2**16
+            )
+        for piece in self.pieces:
+            return piece, False
+        self.f.close()
+        return b'', True
+
     def __str__(self):
-        return unicode(self).encode('utf-8')
+        return u"<tubing.sources.GzipRange %s[%s:%s]>" % (
+            self.filename, self.start, self.end
+        )
+
+
+# the biggest UDP payload is 65507 bytes
+DATAGRAM_SIZE = 2**16
+# on linux, recv with MSG_TRUNC returns the whole length of a datagram that
+# didn't fit, elsewhere it means something else
+MSG_TRUNC = 0
+if sys.platform.startswith('linux'):
+    MSG_TRUNC = getattr(socket, 'MSG_TRUNC', 0)
 
 
 @SourceFactory()
+@compat.python_2_unicode_compatible
 class Socket(object):
     """
-    Socket binds and reads from a socket.
+    Socket binds a datagram socket and reads from it. Each read waits up to
+    timeout seconds for a datagram, then drains the ones waiting behind it,
+    up to about amt bytes, into one preallocated buffer, and outputs them as a
+    single chunk. It's only empty if nothing arrived.
+
+    Datagrams are just concatenated, unless there's a separator, like
+    separator=b"\n", to follow each one that doesn't already end with it,
+    so log lines can be split again with tubes.Split. rcvbuf sets SO_RCVBUF,
+    how much the kernel queues for us before it starts dropping datagrams.
+    With a pool, see File, chunks are memoryviews of pooled buffers instead
+    of copies.
     """
 
-    def __init__(self, ip, port, *args):
-        self.sock = socket.socket(*args)
+    def __init__(self, ip, port, *args, **kwargs):
+        self.separator = kwargs.pop("separator", b"")
+        self.timeout = kwargs.pop("timeout", 0.1)
+        self.pool = bufferpool.get(kwargs.pop("pool", None))
+        rcvbuf = kwargs.pop("rcvbuf", None)
+        self.ip = ip
+        self.port = port
+        self.sock = socket.socket(*args, **kwargs)
+        if rcvbuf:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+            logger.debug("SO_RCVBUF is %d", self.sock.getsockopt(
+                socket.SOL_SOCKET, socket.SO_RCVBUF
+            ))
         self.sock.bind((ip, port))
-        self.sock.settimeout(0.1)
+        self.buffer = bytearray()
         self.eof = False
 
     def read(self, amt=None):
         if self.eof:
+            self.close()
             return b'', True
 
+        amt = amt or DATAGRAM_SIZE
+        sep = self.separator
+        width = len(sep)
+        end = bytearray(sep[-1:] or b"\0")[0]
+        size = amt + DATAGRAM_SIZE + width
+        if self.pool is not None:
+            buf = self.pool.acquire(size)
+        else:
+            if len(self.buffer) < size:
+                self.buffer = bytearray(size)
+            buf = self.buffer
+        view = memoryview(buf)
+        pos = 0
+        count = 0
+        sock = self.sock
+        recv_into = sock.recv_into
         try:
-            data, addr = self.sock.recvfrom(amt)
-            logger.debug("%s >> %s", addr, data)
-            return data, False
-        except socket.timeout:
-            return b'', False
-        except socket.error:
-            return b'', True
+            # the first datagram is waited for, the rest only drained
+            sock.settimeout(self.timeout)
+            while pos < amt:
+                try:
+                    n = recv_into(view[pos:], DATAGRAM_SIZE, MSG_TRUNC)
+                except socket.timeout:
+                    break
+                except socket.error as e:
+                    if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        raise
+                    break
+                if not count:
+                    sock.settimeout(0.0)
+                if n > DATAGRAM_SIZE:
+                    logger.warning("Truncated a %d byte datagram", n)
+                    n = DATAGRAM_SIZE
+                pos += n
+                count += 1
+                if width == 1:
+                    if not n or buf[pos - 1] != end:
+                        buf[pos] = end
+                        pos += 1
+                elif width and (n < width or view[pos - width:pos] != sep):
+                    view[pos:pos + width] = sep
+                    pos += width
+        except socket.error as e:
+            logger.debug("Socket failed, %s", e)
+            self.eof = True
+        logger.debug("[%s] Read %d datagrams, %d bytes", self, count, pos)
+
+        if self.pool is not None:
+            return view[:pos], self.eof
+        r = view[:pos].tobytes()
+        compat.release(view)
+        return r, self.eof
+
+    def interrupt(self):
+        self.eof = True
+
+    def close(self):
+        self.sock.close()
+
+    def __str__(self):
+        return u"<tubing.sources.Socket %s:%s>" % (self.ip, self.port)
+
+
+class Delimited(object):
+    """
+    Delimited frames a byte stream into records ended by delimiter. The
+    partial record is kept in pieces, and only joined once it's complete.
+    """
+
+    def __init__(self, delimiter, max_record):
+        self.delimiter = delimiter
+        self.max_record = max_record
+        self.pieces = []
+        self.size = 0
+        self.tail = b''  # last len(delimiter) - 1 bytes of pieces
+
+    def feed(self, data):
+        width = len(self.delimiter)
+        if self.delimiter not in data \
+                and (width == 1 or self.delimiter not in
+                     self.tail + data[:width - 1]):
+            self.pieces.append(data)
+            self.size += len(data)
+            if self.size > self.max_record:
+                raise ValueError("record over %d bytes" % (self.max_record))
+            if width > 1:
+                self.tail = (self.tail + data[1 - width:])[1 - width:]
+            return []
+
+        if self.pieces:
+            self.pieces.append(data)
+            data = b''.join(self.pieces)
+            self.pieces = []
+            self.tail = b''
+        records = data.split(self.delimiter)
+        partial = records.pop()
+        self.size = 0
+        if partial:
+            self.feed(partial)
+        return records
+
+    def close(self):
+        if self.pieces:
+            return [b''.join(self.pieces)]
+        return []
+
+
+class LengthPrefixed(object):
+    """
+    LengthPrefixed frames a byte stream into records that each start with
+    their length, packed with struct format header.
+    """
+
+    def __init__(self, header, max_record):
+        self.header = struct.Struct(header)
+        self.max_record = max_record
+        self.buf = bytearray()
+
+    def feed(self, data):
+        buf = self.buf
+        buf += data
+        header = self.header
+        width = header.size
+        records = []
+        pos = 0
+        view = memoryview(buf)
+        try:
+            while len(buf) - pos >= width:
+                n = header.unpack_from(buf, pos)[0]
+                if n > self.max_record:
+                    raise ValueError("record of %d bytes is over %d" %
+                                     (n, self.max_record))
+                end = pos + width + n
+                if end > len(buf):
+                    break
+                records.append(view[pos + width:end].tobytes())
+                pos = end
+        finally:
+            compat.release(view)
+        del buf[:pos]
+        return records
+
+    def close(self):
+        if self.buf:
+            logger.warning("Dropped %d bytes of an incomplete record",
+                           len(self.buf))
+        return []
+
+
+class Connection(object):
+    """
+    Connection is a TCPServer client, and the records we've read from it that
+    haven't been output yet.
+    """
+
+    def __init__(self, sock, addr, framer):
+        self.sock = sock
+        self.addr = addr
+        self.framer = framer
+        self.records = []
+        self.pending = 0
+        self.paused = False
+        self.closed = False
+
+
+# how much to recv from a connection at a time
+RECV_SIZE = 2**16
+
+
+@SourceFactory(2**10)
+@compat.python_2_unicode_compatible
+class TCPServer(object):
+    """
+    TCPServer accepts any number of TCP connections and outputs the records
+    they send, as bytes, merged into one stream. framing is the delimiter
+    records end with, or "length" for records that start with their length,
+    packed with struct format header. A client that sends a record over
+    max_record bytes is disconnected. So are clients that close with half a
+    length prefixed record sent, the half is dropped. The last delimited
+    record doesn't need its delimiter.
+
+    Everything runs on one selector, in read(). Reads wait up to timeout
+    seconds for records, and output up to amt of them, taking turns between
+    connections. Once max_pending bytes of records from a connection are
+    waiting to be output, we stop reading from it until half of them are,
+    which makes TCP hold the client back.
+
+    It runs until interrupted.
+    """
+
+    def __init__(self, host, port, framing=b"\n", header="!I",
+                 max_pending=2**20, max_record=2**24, backlog=128,
+                 timeout=1.0):
+        if selectors is None:
+            raise RuntimeError("TCPServer needs the selectors module")
+        self.framing = framing
+        self.header = header
+        self.max_pending = max_pending
+        self.max_record = max_record
+        self.timeout = timeout
+        family, kind, proto, _, addr = socket.getaddrinfo(
+            host, port, 0, socket.SOCK_STREAM, 0, socket.AI_PASSIVE
+        )[0]
+        self.server = socket.socket(family, kind, proto)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(addr)
+        self.server.listen(backlog)
+        self.server.setblocking(False)
+        self.address = self.server.getsockname()
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.server, selectors.EVENT_READ)
+        self.connections = set()
+        # connections with records to output, in turn
+        self.ready = collections.deque()
+        self.eof = False
+
+    def framer(self):
+        if self.framing == "length":
+            return LengthPrefixed(self.header, self.max_record)
+        return Delimited(self.framing, self.max_record)
+
+    def accept(self):
+        while True:
+            try:
+                sock, addr = self.server.accept()
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            logger.debug("[%s] Accepted %s", self, addr)
+            sock.setblocking(False)
+            conn = Connection(sock, addr, self.framer())
+            self.connections.add(conn)
+            self.selector.register(sock, selectors.EVENT_READ, conn)
+
+    def receive(self, conn):
+        try:
+            # never queue much more than max_pending
+            data = conn.sock.recv(
+                max(1, min(RECV_SIZE, self.max_pending - conn.pending))
+            )
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            logger.warning("[%s] %s failed, %s", self, conn.addr, e)
+            return self.disconnect(conn, False)
+        if not data:
+            return self.disconnect(conn)
+        try:
+            records = conn.framer.feed(data)
+        except ValueError as e:
+            logger.warning("[%s] Dropping %s, %s", self, conn.addr, e)
+            return self.disconnect(conn, False)
+        self.queue(conn, records)
+        if conn.pending >= self.max_pending:
+            conn.paused = True
+            self.selector.unregister(conn.sock)
+
+    def queue(self, conn, records):
+        if not records:
+            return
+        if not conn.records:
+            self.ready.append(conn)
+        conn.records.extend(records)
+        conn.pending += sum(len(record) for record in records)
+
+    def disconnect(self, conn, flush=True):
+        logger.debug("[%s] %s disconnected", self, conn.addr)
+        if not conn.paused:
+            self.selector.unregister(conn.sock)
+        conn.sock.close()
+        conn.closed = True
+        self.connections.discard(conn)
+        if flush:
+            self.queue(conn, conn.framer.close())
+
+    def take(self, amt):
+        """
+        take returns up to $amt records, taking turns between connections.
+        """
+        out = []
+        ready = self.ready
+        while ready and len(out) < amt:
+            conn = ready.popleft()
+            n = max(1, (amt - len(out)) // (len(ready) + 1))
+            records = conn.records[:n]
+            del conn.records[:n]
+            out.extend(records)
+            conn.pending -= sum(len(record) for record in records)
+            if conn.records:
+                ready.append(conn)
+            if conn.paused and not conn.closed \
+                    and conn.pending <= self.max_pending // 2:
+                conn.paused = False
+                self.selector.register(conn.sock, selectors.EVENT_READ, conn)
+        return out
+
+    def read(self, amt=None):
+        if self.eof:
+            self.close()
+            return [], True
+
+        amt = amt or 2**10
+        # don't keep records waiting, if there are some already
+        timeout = 0 if self.ready else self.timeout
+        for key, _ in self.selector.select(timeout):
+            if key.data is None:
+                self.accept()
+            else:
+                self.receive(key.data)
+        return self.take(amt), False
 
     def interrupt(self):
         self.eof = True
 
+    def close(self):
+        for conn in list(self.connections):
+            self.disconnect(conn, False)
+        self.selector.close()
+        self.server.close()
+
+    def __str__(self):
+        return u"<tubing.sources.TCPServer %s:%s>" % self.address[:2]
+
 
 @SourceFactory()
 class Bytes(object):
@@ -188,30 +678,175 @@ class Bytes(object):
 
 @SourceFactory()
 class IO(object):
+    """
+    IO reads a stream. With a pool, see File, streams with readinto are read
+    into pooled buffers.
+    """
+
+    kernel_copy = True
 
-    def __init__(self, stream):
+    def __init__(self, stream, pool=None):
         self.io = stream
+        self.pool = bufferpool.get(pool)
 
     def read(self, amt=None):
-        r = self.io.read(amt)
+        if self.pool is not None:
+            r = self.pool.read(self.io, amt)
+        else:
+            r = self.io.read(amt)
         if r:
             return r, False
         else:
             return b'', True
 
+    def fileno(self):
+        """
+        fileno returns the file descriptor to copy from with kernelcopy, for
+        unbuffered binary streams, like a socket's makefile('rb', 0).
+        """
+        if isinstance(self.io, io.RawIOBase):
+            try:
+                return self.io.fileno()
+            except (IOError, ValueError):
+                pass
+        return None
+
+
+# how much each of sources.HTTP's parallel Range requests asks for
+RANGE_SIZE = 2**23
+
 
 @SourceFactory()
 class HTTP(object):
+    """
+    HTTP streams a response body, over a kept-alive connection from the
+    shared sessions pool, or from session if one is given. With a pool, see
+    File, the body is read into pooled buffers.
+
+    With parallel_ranges=N, a GET is fetched as Range requests of range_size
+    bytes, N at a time, and put back together in order, which gets more out
+    of links a single connection can't fill. The first range tells how long
+    the body is. If the server answers it with the whole body instead, that's
+    streamed as usual. Later ranges are asked for with If-Range, and the
+    first one's strong ETag or else its Last-Modified date, so a body that
+    changes halfway fails rather than coming out mixed. Without either, or
+    with only a weak ETag, which If-Range can't use, nothing is checked.
+    """
 
     def __init__(self, method, url, *args, **kwargs):
-        s = Session()
-        s.stream = True
-        r = Request(method, url, *args, **kwargs)
-        self.stream = s.send(r.prepare()).raw
+        self.pool = bufferpool.get(kwargs.pop("pool", None))
+        self.session = kwargs.pop("session", None) or sessions.get()
+        parallel = kwargs.pop("parallel_ranges", None) or 1
+        self.range_size = kwargs.pop("range_size", RANGE_SIZE)
+        self.request = self.session.prepare_request(
+            Request(method, url, *args, **kwargs)
+        )
+        self.stream = None
+        self.pending = collections.deque()
+        self.part = b''
+        self.offset = 0
+        if parallel > 1 and self.request.method == "GET":
+            if futures is None:  # pragma: no cover
+                raise ImportError("parallel_ranges needs concurrent.futures")
+            self.start_ranges(parallel)
+        else:
+            self.stream = self.session.send(self.request, stream=True).raw
+
+    def start_ranges(self, parallel):
+        r = self.request.copy()
+        r.headers["Range"] = "bytes=0-%d" % (self.range_size - 1)
+        response = self.session.send(r, stream=True)
+        self.total = content_range_total(response)
+        if self.total is None:
+            if response.status_code != 416:
+                self.stream = response.raw
+                return
+            # the body is empty, or the server won't do ranges of it
+            response.close()
+            self.stream = self.session.send(self.request, stream=True).raw
+            return
+
+        self.part = response.raw.read()
+        validator = response.headers.get("ETag")
+        if not validator or validator.startswith("W/"):
+            validator = response.headers.get("Last-Modified")
+        if validator:
+            self.request.headers["If-Range"] = validator
+        self.next_range = len(self.part)
+        self.workers = futures.ThreadPoolExecutor(parallel)
+        for _ in range(parallel):
+            self.submit()
+
+    def submit(self):
+        if self.next_range < self.total:
+            start = self.next_range
+            self.next_range += self.range_size
+            self.pending.append(self.workers.submit(self.fetch, start))
+
+    def fetch(self, start):
+        end = min(start + self.range_size, self.total) - 1
+        r = self.request.copy()
+        r.headers["Range"] = "bytes=%d-%d" % (start, end)
+        response = self.session.send(r, stream=True)
+        if response.status_code != 206:
+            # a 200 is the whole body, because it changed, don't read it
+            response.close()
+            raise IOError("%s: bytes %d-%d got HTTP %d" % (
+                self.request.url, start, end, response.status_code
+            ))
+        data = response.raw.read()
+        if len(data) != end + 1 - start:
+            raise IOError("%s: bytes %d-%d got %d bytes" % (
+                self.request.url, start, end, len(data)
+            ))
+        return data
 
     def read(self, amt=None):
-        r = self.stream.read(amt)
-        if r:
-            return r, False
+        if self.stream is not None:
+            if self.pool is not None:
+                r = self.pool.read(self.stream, amt)
+            else:
+                r = self.stream.read(amt)
+            if r:
+                return r, False
+            else:
+                return b'', True
+
+        while self.offset >= len(self.part):
+            if not self.pending:
+                self.stop_ranges()
+                return b'', True
+            try:
+                self.part = self.pending.popleft().result()
+            except BaseException:
+                # don't leave the other ranges running, or waiting to
+                self.stop_ranges()
+                raise
+            self.offset = 0
+            self.submit()
+        if not self.offset and (amt is None or amt >= len(self.part)):
+            r = self.part
         else:
-            return b'', True
+            r = self.part[self.offset:self.offset + (amt or len(self.part))]
+        self.offset += len(r)
+        return r, False
+
+    def stop_ranges(self):
+        for future in self.pending:
+            future.cancel()
+        self.pending.clear()
+        self.workers.shutdown(wait=False)
+
+
+def content_range_total(response):
+    """
+    content_range_total returns the length of the whole body from a 206
+    response's Content-Range, or None if it doesn't say.
+    """
+    if response.status_code != 206:
+        return None
+    unit, _, spec = response.headers.get("Content-Range", "").partition(" ")
+    total = spec.rpartition("/")[2]
+    if unit != "bytes" or not total.isdigit():
+        return None
+    return int(total)
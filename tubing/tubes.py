@@ -7,19 +7,34 @@ If you don't need state, you can pass a transformer function directly to a
 ChunkMap or Map Tube.
 """
 import logging
-try:
-    import ujson as json
-except:
-    import json
+import re
 import zlib
 import gzip
+import bisect
 import functools
+import heapq
+import io
+import struct
+import itertools
+import collections
 import os
+import sys
+import time
+import multiprocessing
+try:
+    from concurrent import futures
+except ImportError:  # pragma: no cover
+    futures = None
+from tubing import compat, jsoncodec
+from tubing.apparatus import Stopped
 
 logger = logging.getLogger('tubing.tubes')
 
 OBJ_CHUNK_SIZE = int(os.environ.get("OBJ_CHUNK_SIZE", 2**3))
 BYTE_CHUNK_SIZE = int(os.environ.get("BYTE_CHUNK_SIZE", 2**18))
+AUTO_CHUNK_MEMORY = int(os.environ.get("AUTO_CHUNK_MEMORY", 2**24))
+
+clock = getattr(time, 'perf_counter', time.time)
 
 
 def TransformerTubeFactory(default_chunk_size=BYTE_CHUNK_SIZE):
@@ -51,6 +66,7 @@ class TransformerTube(object):
     """
 
     def __init__(self, transformer_cls, default_chunk_size, *args, **kwargs):
+        self.default_chunk_size = default_chunk_size
         self.chunk_size = default_chunk_size
         if kwargs.get("chunk_size"):
             self.chunk_size = kwargs["chunk_size"]
@@ -62,7 +78,548 @@ class TransformerTube(object):
 
     def receive(self, apparatus):
         transformer = self.transformer_cls(*self.args, **self.kwargs)
-        return TransformerTubeWorker(apparatus, self.chunk_size, transformer)
+        chunk_size = self.chunk_size
+        if chunk_size == "auto":
+            chunk_size = AdaptiveChunkSize(self.default_chunk_size)
+        tail = apparatus.tail()
+        if getattr(apparatus, 'fuse', False) \
+                and getattr(transformer, 'fusible', False) \
+                and isinstance(tail, TransformerTubeWorker) \
+                and tail.fusible():
+            return tail.fuse(transformer, chunk_size)
+        worker_cls = getattr(transformer, 'worker_cls', TransformerTubeWorker)
+        return worker_cls(apparatus, chunk_size, transformer)
+
+
+class AdaptiveChunkSize(object):
+    """
+    AdaptiveChunkSize tunes a stage's chunk size while the apparatus runs. It
+    is what you get when you pass chunk_size="auto" to a tube, source or
+    sink.
+
+    Every chunk the stage hands out is passed to tick(). Every $window ticks
+    we compare the throughput, in items per second, with the previous window.
+    The time covers the whole cycle between reads, so the consumer's per-call
+    overhead counts as well. While throughput holds up we keep doubling (or
+    halving) the size, and we turn around when it drops. The size stays
+    between minimum and maximum, and within $memory bytes, estimated from the
+    chunks we've seen.
+    """
+
+    tolerance = 0.05
+
+    def __init__(
+        self,
+        initial,
+        minimum=1,
+        maximum=2**24,
+        memory=AUTO_CHUNK_MEMORY,
+        window=8,
+    ):
+        self.size = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.memory = memory
+        self.window = window
+        self.grow = True
+        self.last_rate = None
+        self.item_bytes = 1
+        self.items = 0
+        self.calls = 0
+        self.started = None
+
+    def __repr__(self):
+        return "<AdaptiveChunkSize %d>" % (self.size)
+
+    def observe(self, chunk):
+        """
+        Estimate the memory used by each item in the chunk.
+        """
+        if isinstance(chunk, (bytes, bytearray, memoryview, Segments)):
+            self.item_bytes = 1
+        elif isinstance(chunk, (list, tuple)) and chunk:
+            # the item plus the list's pointer to it
+            self.item_bytes = sys.getsizeof(chunk[0]) + 8
+
+    def ceiling(self):
+        return max(self.minimum, min(self.maximum,
+                                     self.memory // self.item_bytes))
+
+    def tick(self, chunk):
+        """
+        Record a chunk handed out by the stage and return the chunk size to
+        use for the next read.
+        """
+        now = clock()
+        if self.started is None:
+            self.started = now
+        self.observe(chunk)
+        if hasattr(chunk, '__len__'):
+            self.items += len(chunk)
+        self.calls += 1
+        if self.calls >= self.window:
+            elapsed = now - self.started
+            rate = self.items / elapsed if elapsed > 0 else float("inf")
+            self.adjust(rate)
+            self.started = now
+            self.items = 0
+            self.calls = 0
+        self.size = min(self.size, self.ceiling())
+        return self.size
+
+    def adjust(self, rate):
+        if self.last_rate is not None and \
+                rate < self.last_rate * (1 - self.tolerance):
+            self.grow = not self.grow
+        self.last_rate = rate
+        if self.grow:
+            self.size = min(self.size * 2, self.ceiling())
+        else:
+            self.size = max(self.size // 2, self.minimum)
+        logger.debug("%r at %.0f items/s", self, rate)
+
+
+def make_buffer(chunk, chunk_size):
+    """
+    make_buffer picks a buffer implementation for the type of the first chunk
+    a TransformerTubeWorker sees.
+    """
+    if isinstance(chunk, memoryview):
+        return ViewBuffer()
+    if isinstance(chunk, (bytes, bytearray)):
+        return ByteBuffer(2 * max(chunk_size, len(chunk)))
+    if isinstance(chunk, Segments):
+        return SegmentBuffer()
+    if isinstance(chunk, compat.text_type):
+        return SequenceBuffer()
+    return ChunkBuffer()
+
+
+class ByteBuffer(object):
+    """
+    ByteBuffer is a growable bytearray with read and write cursors. Each byte
+    is copied in once on append and out once on shift. Space freed by shifts is
+    reclaimed by compacting the unread bytes to the front, which only happens
+    when less than half of the storage is in use, so appends are amortized
+    O(1).
+    """
+
+    def __init__(self, size=BYTE_CHUNK_SIZE):
+        self.data = bytearray(size)
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def full(self, amt):
+        return self.end - self.start >= amt
+
+    def reserve(self, amt):
+        """
+        Make room for $amt more bytes at the write cursor.
+        """
+        used = self.end - self.start
+        size = len(self.data)
+        if used + amt > size // 2:
+            while used + amt > size // 2:
+                size *= 2
+            data = bytearray(size)
+            data[:used] = self.data[self.start:self.end]
+            self.data = data
+        else:
+            self.data[:used] = self.data[self.start:self.end]
+        self.start, self.end = 0, used
+
+    def append(self, chunk):
+        amt = len(chunk)
+        if self.end + amt > len(self.data):
+            self.reserve(amt)
+        self.data[self.end:self.end + amt] = chunk
+        self.end += amt
+
+    def shift(self, amt=None):
+        """
+        Remove $amt bytes from the front of the buffer and return them as a
+        single bytes copy.
+        """
+        end = self.end
+        if amt is not None:
+            end = min(self.start + amt, end)
+        view = memoryview(self.data)
+        r = view[self.start:end].tobytes()
+        compat.release(view)
+        if end == self.end:
+            self.start = self.end = 0
+        else:
+            self.start = end
+        return r
+
+
+class Segments(object):
+    """
+    Segments is a chunk of a byte stream, made of several bytes-like parts
+    that haven't been joined. Sinks that know about it write the parts out
+    with a single writev(), or one at a time, instead of copying them into
+    one string first. len() is the number of bytes. Tubes that expect
+    bytes don't know about it, so it should go straight to a sink.
+    """
+
+    __slots__ = ('parts', 'size')
+
+    def __init__(self, parts=(), size=None):
+        self.parts = list(parts)
+        self.size = sum(len(part) for part in self.parts) \
+            if size is None else size
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        return iter(self.parts)
+
+    def __repr__(self):
+        return "<Segments %d parts, %d bytes>" % (len(self.parts), self.size)
+
+    def tobytes(self):
+        return b''.join(self.parts)
+
+    def reader(self):
+        return SegmentsReader(self)
+
+
+class SegmentsReader(io.RawIOBase):
+    """
+    SegmentsReader is a seekable file object over Segments, for APIs that
+    want a file, and may want to rewind it to retry.
+    """
+
+    def __init__(self, segments):
+        self.parts = [memoryview(part) for part in segments]
+        self.starts = []
+        size = 0
+        for part in self.parts:
+            self.starts.append(size)
+            size += len(part)
+        self.size = size
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.pos = max(0, offset)
+        return self.pos
+
+    def readinto(self, b):
+        if self.pos >= self.size:
+            return 0
+        i = bisect.bisect_right(self.starts, self.pos) - 1
+        part = self.parts[i][self.pos - self.starts[i]:]
+        n = min(len(b), len(part))
+        b[:n] = part[:n]
+        self.pos += n
+        return n
+
+
+class SegmentBuffer(object):
+    """
+    SegmentBuffer buffers Segments without copying them. Parts are only
+    split, with a memoryview, when a chunk ends in the middle of one.
+    """
+
+    def __init__(self):
+        self.parts = collections.deque()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def full(self, amt):
+        return self.size >= amt
+
+    def append(self, chunk):
+        if isinstance(chunk, Segments):
+            self.parts.extend(chunk.parts)
+        else:
+            self.parts.append(chunk)
+        self.size += len(chunk)
+
+    def shift(self, amt=None):
+        """
+        Remove $amt bytes from the front of the buffer and return them as
+        Segments.
+        """
+        parts = self.parts
+        if amt is None or amt >= self.size:
+            r = Segments(parts, self.size)
+            parts.clear()
+            self.size = 0
+            return r
+
+        r = []
+        need = amt
+        while need:
+            part = parts[0]
+            if len(part) <= need:
+                r.append(parts.popleft())
+                need -= len(part)
+            else:
+                view = memoryview(part)
+                r.append(view[:need])
+                parts[0] = view[need:]
+                need = 0
+        self.size -= amt
+        return Segments(r, amt)
+
+
+class ViewBuffer(object):
+    """
+    ViewBuffer buffers memoryviews, like the ones sources.MMapFile outputs.
+    A chunk that lies within one view is returned as a slice of it. Only
+    chunks that span views are copied, into bytes.
+    """
+
+    def __init__(self):
+        self.views = collections.deque()
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def full(self, amt):
+        return self.size >= amt
+
+    def append(self, chunk):
+        view = memoryview(chunk)
+        self.views.append(view)
+        self.size += len(view)
+
+    def shift(self, amt=None):
+        """
+        Remove $amt bytes from the front of the buffer.
+        """
+        views = self.views
+        if amt is None or amt > self.size:
+            amt = self.size
+        self.size -= amt
+        if len(views[0]) >= amt:
+            view = views.popleft()
+            if len(view) > amt:
+                views.appendleft(view[amt:])
+            return view[:amt]
+
+        r = []
+        need = amt
+        while need:
+            view = views.popleft()
+            if len(view) > need:
+                views.appendleft(view[need:])
+                view = view[:need]
+            r.append(view)
+            need -= len(view)
+        return b''.join(r)
+
+
+class SequenceBuffer(object):
+    """
+    SequenceBuffer concatenates and slices whatever sequence type it's handed.
+    It's the fallback for text and object streams.
+    """
+
+    def __init__(self):
+        self.data = None
+
+    def __len__(self):
+        return len(self.data) if self.data else 0
+
+    def full(self, amt):
+        return len(self) >= amt
+
+    def append(self, chunk):
+        if self.data and chunk:
+            self.data += chunk
+        else:
+            self.data = chunk
+
+    def shift(self, amt=None):
+        r, self.data = self.data[:amt], self.data[amt or len(self.data):]
+        return r
+
+
+class ChunkBuffer(object):
+    """
+    ChunkBuffer keeps a deque of pending chunks and an offset into the head
+    chunk, so appending and shifting only cost as much as the items handed out.
+    A new list is only built when a shift spans chunks. Lazy iterables, like
+    the map objects Map returns, are left alone until they have to be counted
+    or shifted.
+    """
+
+    def __init__(self):
+        self.chunks = collections.deque()
+        self.offset = 0
+        self.size = 0  # items in sized chunks, not counting the head offset
+
+    def __len__(self):
+        self.materialize()
+        return self.size
+
+    def materialize(self, amt=None):
+        """
+        Turn lazy chunks into lists, from the front, until we know we have at
+        least $amt items or everything has been counted.
+        """
+        for i, chunk in enumerate(self.chunks):
+            if amt is not None and self.size >= amt:
+                return
+            if not hasattr(chunk, '__len__'):
+                chunk = list(chunk)
+                self.chunks[i] = chunk
+                self.size += len(chunk)
+
+    def full(self, amt):
+        if self.size < amt:
+            self.materialize(amt)
+        return self.size >= amt
+
+    def append(self, chunk):
+        self.chunks.append(chunk)
+        if hasattr(chunk, '__len__'):
+            self.size += len(chunk)
+
+    def shift(self, amt=None):
+        """
+        Remove $amt items from the front of the buffer and return them.
+        """
+        chunks = self.chunks
+        if len(chunks) == 1 and not self.offset \
+                and hasattr(chunks[0], '__len__') \
+                and (amt is None or len(chunks[0]) <= amt):
+            # the common case, hand the chunk over as is.
+            self.size = 0
+            return chunks.popleft()
+
+        r = []
+        while chunks and (amt is None or len(r) < amt):
+            head = chunks[0]
+            need = None if amt is None else amt - len(r)
+            if hasattr(head, '__len__'):
+                end = len(head)
+                if need is not None:
+                    end = min(end, self.offset + need)
+                if isinstance(head, (list, tuple)):
+                    r.extend(head[self.offset:end])
+                else:
+                    r.extend(itertools.islice(head, self.offset, end))
+                self.size -= end - self.offset
+                if end == len(head):
+                    chunks.popleft()
+                    self.offset = 0
+                else:
+                    self.offset = end
+            else:
+                it = iter(head)
+                got = len(r)
+                r.extend(itertools.islice(it, need))
+                if need is None or len(r) - got < need:
+                    chunks.popleft()
+                else:
+                    chunks[0] = it
+        return r
+
+
+def join_chunks(chunks):
+    """
+    join_chunks concatenates chunks of the same type into one chunk.
+    """
+    if not chunks:
+        return None
+    if len(chunks) == 1:
+        return chunks[0]
+    if isinstance(chunks[0], (bytes, bytearray, memoryview)):
+        return b''.join(chunks)
+    if isinstance(chunks[0], compat.text_type):
+        return u''.join(chunks)
+    return list(itertools.chain.from_iterable(chunks))
+
+
+class FusedTransformer(object):
+    """
+    FusedTransformer runs the transformers of adjacent tubes in a single
+    worker, see TransformerTubeWorker.fuse. Each transform's output is passed
+    straight to the next transform, so the whole run shares one buffer and one
+    read loop.
+
+    close() closes each stage in order, pushing whatever it returns through the
+    stages after it, and hands each stage's result to its own worker. abort()
+    aborts the stage that failed and everything after it, which is exactly
+    what would have been on the stack without fusion.
+    """
+
+    fusible = True
+
+    def __init__(self, stages):
+        # [(worker, transformer), ...]
+        self.stages = stages
+        self.current = 0
+
+    @property
+    def transparent(self):
+        return all(
+            getattr(transformer, 'transparent', False)
+            for _, transformer in self.stages
+        )
+
+    def __repr__(self):
+        return "<FusedTransformer %s>" % (
+            " | ".join(repr(t) for _, t in self.stages)
+        )
+
+    def run(self, chunk, start):
+        for i in range(start, len(self.stages)):
+            if not chunk:
+                return None
+            self.current = i
+            chunk = self.stages[i][1].transform(chunk)
+            if not hasattr(chunk, '__len__'):
+                # evaluate lazy output, like Map's, while its stage is
+                # current, so it's the one that aborts if it fails
+                chunk = list(chunk)
+        self.current = 0
+        return chunk
+
+    def transform(self, chunk):
+        return self.run(chunk, 0)
+
+    def close(self):
+        out = []
+        for i, (worker, transformer) in enumerate(self.stages):
+            self.current = i
+            if hasattr(transformer, 'close'):
+                c = transformer.close()
+                if c:
+                    c = self.run(c, i + 1)
+                if c:
+                    out.append(c)
+            if hasattr(transformer, 'result'):
+                worker.result = transformer.result
+        self.current = 0
+        return join_chunks(out)
+
+    def abort(self):
+        for _, transformer in self.stages[self.current:]:
+            hasattr(transformer, 'abort') and transformer.abort()
 
 
 class TransformerTubeWorker(object):
@@ -78,6 +635,10 @@ class TransformerTubeWorker(object):
         self.apparatus.tubes.append(self)
         if not chunk_size:
             raise ValueError("no chunk size")
+        self.tuner = None
+        if isinstance(chunk_size, AdaptiveChunkSize):
+            self.tuner = chunk_size
+            chunk_size = chunk_size.size
         self.chunk_size = chunk_size
         self.transformer = transformer
         self.eof = False
@@ -90,28 +651,49 @@ class TransformerTubeWorker(object):
     def tube(self, other):
         return other.receive(self.apparatus)
 
+    def fusible(self):
+        """
+        We can take on more stages if our transformer allows it, and we
+        haven't started reading yet.
+        """
+        return getattr(self.transformer, 'fusible', False) \
+            and self.buffer is None and not self.eof
+
+    def fuse(self, transformer, chunk_size):
+        """
+        fuse returns a worker that runs our transformers followed by
+        $transformer, reading straight from our source. We stay in
+        apparatus.tubes so our result can still be found, but nobody reads
+        from us anymore.
+        """
+        worker_cls = getattr(transformer, 'worker_cls', TransformerTubeWorker)
+        worker = worker_cls(self.apparatus, chunk_size, transformer)
+        worker.source = self.source
+        if isinstance(self.transformer, FusedTransformer):
+            stages = self.transformer.stages
+        else:
+            stages = [(self, self.transformer)]
+        worker.transformer = FusedTransformer(stages + [(worker, transformer)])
+        return worker
+
     def read_complete(self):
         """
         read_complete tells us if the current request is fulfilled. It's fulfilled
         if we've reached the EOF in the source, or we have $amt parts. If amt is
         None, we should read to the source's EOF.
         """
-        buff_len = len(self.buffer or [])
-        logger.debug("[%s] buffer: %d of %d", self.transformer, buff_len,
-                     self.chunk_size)
-        return self.eof or (self.buffer and buff_len >= self.chunk_size)
+        if self.eof:
+            return True
+        if self.buffer is None:
+            return False
+        return self.buffer.full(self.chunk_size)
 
     def shift_buffer(self, amt):
         """
         Remove $amt data from the front of the buffer and return it.
         """
-        if self.buffer:
-            r, self.buffer = self.buffer[:amt], self.buffer[
-                amt or len(
-                    self.buffer
-                ):
-            ]
-            return r
+        if self.buffer is not None and self.buffer.full(1):
+            return self.buffer.shift(amt)
         else:
             return b''
 
@@ -119,16 +701,28 @@ class TransformerTubeWorker(object):
         """
         append to the buffer, creating it if it doesn't exist.
         """
-        if self.buffer and chunk:
-            self.buffer += chunk
-        else:
-            self.buffer = chunk
+        if self.buffer is None:
+            self.buffer = make_buffer(chunk, self.chunk_size)
+        self.buffer.append(chunk)
 
     def buffer_len(self):
         """
         buffer_len even if buffer is None.
         """
-        return self.buffer and len(self.buffer) or 0
+        return len(self.buffer) if self.buffer is not None else 0
+
+    def output(self):
+        """
+        output shifts the next chunk off the buffer, once read() has filled
+        it, and tells us if it's the last one.
+        """
+        eof = self.eof and not (self.buffer is not None
+                                and self.buffer.full(self.chunk_size + 1))
+        # if eof, we've written everything, we're done
+        r = self.shift_buffer(self.chunk_size)
+        if self.tuner:
+            self.chunk_size = self.tuner.tick(r)
+        return r, eof
 
     def read(self):
         """
@@ -143,17 +737,18 @@ class TransformerTubeWorker(object):
                     if outchunk:
                         self.append(outchunk)
                 if self.eof and hasattr(self.transformer, 'close'):
+                    # close() may depend on every item having been transformed
+                    self.buffer_len()
                     c = self.transformer.close()
                     if c:
                         self.append(c)
                     if hasattr(self.transformer, 'result'):
                         self.result = self.transformer.result
 
-            if self.eof and (self.buffer_len() <= self.chunk_size):
-                # We've written everything, we're done
-                return self.shift_buffer(self.chunk_size), True
-
-            return self.shift_buffer(self.chunk_size), False
+            return self.output()
+        except Stopped:
+            # something downstream failed, and it aborts on its own
+            raise
         except:
             logger.exception("Tube failed")
             hasattr(self.transformer, 'abort') and self.transformer.abort()
@@ -204,6 +799,8 @@ class Gunzip(object):
     Gunzip unzips a gzipped source stream.
     """
 
+    fusible = True
+
     def __init__(self):
         self.dec = zlib.decompressobj(32 + zlib.MAX_WBITS)
 
@@ -217,66 +814,504 @@ class Gzip(object):
     Gzip Gzips the binary input.
     """
 
+    fusible = True
+
     def __init__(self, compression=9):
-        self.buffer = b''
+        self.buffer = []
         self.zipfile = gzip.GzipFile("", 'wb', compression, self)
 
     def write(self, b):
-        self.buffer += b
+        self.buffer.append(b)
+
+    def drain(self):
+        r = b''.join(self.buffer)
+        self.buffer = []
+        return r
 
     def transform(self, chunk):
         self.zipfile.write(chunk)
-        r = self.buffer
-        self.buffer = b''
-        return r
+        return self.drain()
 
     def close(self):
         self.zipfile.close()
-        return self.buffer
+        return self.drain()
+
+
+GZIP_WINDOW = 2**15
+
+
+def deflate_block(block, zdict, level, last):
+    """
+    deflate_block compresses one ParallelGzip block to raw deflate data,
+    primed with the 32KiB of input before it. Blocks end on a byte boundary,
+    so they can be concatenated.
+    """
+    if zdict:
+        comp = zlib.compressobj(
+            level, zlib.DEFLATED, -zlib.MAX_WBITS, 8, zlib.Z_DEFAULT_STRATEGY,
+            zdict
+        )
+    else:
+        comp = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return comp.compress(block) + \
+        comp.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+@TransformerTubeFactory()
+class ParallelGzip(object):
+    """
+    ParallelGzip gzips the binary input like pigz does. The input is cut into
+    blocks of block_size bytes, which are compressed on a pool of $workers
+    threads. zlib releases the GIL, so this uses as many cores as you give
+    it. Each block is primed with the last 32KiB of the block before it and
+    ends with a sync flush, so together they make up a single gzip member
+    that any gunzip can read, only slightly larger than Gzip's.
+
+    At most $in_flight blocks (2 * workers by default) are outstanding. The
+    CRC is computed as blocks are handed out.
+    """
+
+    def __init__(self, level=9, block_size=2**17, workers=None,
+                 in_flight=None):
+        if futures is None:  # pragma: no cover
+            raise ImportError("ParallelGzip needs concurrent.futures")
+        self.level = level
+        self.block_size = block_size
+        self.workers = workers or multiprocessing.cpu_count()
+        self.in_flight = in_flight or 2 * self.workers
+        self.pool = futures.ThreadPoolExecutor(self.workers)
+        self.pending = collections.deque()
+        self.input = ByteBuffer(2 * block_size)
+        self.zdict = b''
+        self.crc = 0
+        self.size = 0
+        self.started = False
+
+    def header(self):
+        if self.level == 9:
+            xfl = 2
+        elif self.level == 1:
+            xfl = 4
+        else:
+            xfl = 0
+        return struct.pack("<BBBBIBB", 0x1f, 0x8b, 8, 0, 0, xfl, 255)
+
+    def submit(self, block, last):
+        self.crc = zlib.crc32(block, self.crc)
+        self.size += len(block)
+        self.pending.append(
+            self.pool.submit(deflate_block, block, self.zdict, self.level,
+                             last)
+        )
+        if len(block) >= GZIP_WINDOW:
+            self.zdict = block[-GZIP_WINDOW:]
+        else:
+            self.zdict = (self.zdict + block)[-GZIP_WINDOW:]
+
+    def collect(self, everything=False):
+        r = []
+        if not self.started:
+            self.started = True
+            r.append(self.header())
+        limit = 0 if everything else self.in_flight
+        while self.pending and \
+                (len(self.pending) > limit or self.pending[0].done()):
+            r.append(self.pending.popleft().result())
+        return b''.join(r)
+
+    def transform(self, chunk):
+        self.input.append(chunk)
+        while len(self.input) >= self.block_size:
+            self.submit(self.input.shift(self.block_size), False)
+        return self.collect()
+
+    def close(self):
+        self.submit(self.input.shift(), True)
+        r = self.collect(everything=True)
+        self.pool.shutdown(wait=True)
+        return r + struct.pack(
+            "<II", self.crc & 0xffffffff, self.size & 0xffffffff
+        )
+
+    def abort(self):
+        for future in self.pending:
+            future.cancel()
+        self.pool.shutdown(wait=False)
 
 
 @TransformerTubeFactory()
 class Split(object):
     """
-    Split splits source data on a delimiter.
+    Split splits source data on a delimiter. The delimiter, `on`, may be
+    bytes or text of any length, or a compiled regular expression. With
+    keep_delimiter=True, each record keeps the delimiter that ended it.
+
+    Each chunk is only scanned once. The partial record after the last
+    delimiter is kept as a list of pieces, and joined once its delimiter shows
+    up. Regular expressions are the exception: the partial record is scanned
+    again with each chunk, and the last match found waits for the next chunk,
+    in case more data would make it match differently.
     """
 
-    def __init__(self, on=b'\n'):
+    fusible = True
+
+    def __init__(self, on=b'\n', keep_delimiter=False):
         self.on = on
-        self.buffer = b''  # read buffer
+        self.keep = keep_delimiter
+        self.regex = hasattr(on, 'finditer')
+        self.empty = (on.pattern if self.regex else on)[:0]
+        self.width = 0 if self.regex else len(on)
+        self.pending = []  # pieces of the partial record
+        self.pending_len = 0
+        self.tail = self.empty  # last width - 1 items of pending
+
+    def hold(self, piece):
+        self.pending.append(piece)
+        self.pending_len += len(piece)
+        if self.width > 1:
+            self.tail = (self.tail + piece[1 - self.width:])[1 - self.width:]
+
+    def take(self, chunk):
+        """
+        take returns the partial record joined with chunk, and forgets it.
+        """
+        if self.pending:
+            self.pending.append(chunk)
+            chunk = self.empty.join(self.pending)
+        self.pending = []
+        self.pending_len = 0
+        self.tail = self.empty
+        return chunk
 
     def transform(self, chunk):
         """
         We go through all this hoopla because returning nothing signals EOF.
         We keep reading chunks until real EOF or we get at least one part.
         """
+        if isinstance(chunk, memoryview):
+            # find and `in` don't work on memoryviews, and records are copied
+            # out anyway
+            chunk = chunk.tobytes()
+        if self.regex:
+            return self.split_regex(chunk, False)
+
+        on = self.on
+        width = self.width
+        # a delimiter can straddle the partial record and the chunk
+        start = max(0, self.pending_len - width + 1)
+        if self.pending and on not in chunk \
+                and (width == 1 or on not in self.tail + chunk[:width - 1]):
+            self.hold(chunk)
+            return []
+
+        data = self.take(chunk)
+        r = []
+        pos = 0
+        find = data.find
+        i = find(on, start)
+        while i != -1:
+            end = i + width
+            r.append(data[pos:end if self.keep else i])
+            pos = end
+            i = find(on, pos)
+        if pos < len(data):
+            self.hold(data[pos:])
+        return r
+
+    def split_regex(self, chunk, final):
+        data = self.take(chunk)
+        spans = [m.span() for m in self.on.finditer(data) if m.end() > m.start()]
+        if not final:
+            spans = spans[:-1]
         r = []
-        self.buffer += chunk
-        while self.on in self.buffer:
-            out, self.buffer = self.buffer.split(self.on, 1)
-            r.append(out)
+        pos = 0
+        for start, end in spans:
+            r.append(data[pos:end if self.keep else start])
+            pos = end
+        if pos < len(data):
+            self.hold(data[pos:])
         return r
 
     def close(self):
-        return [self.buffer]
+        r = []
+        if self.regex:
+            r = self.split_regex(self.empty, True)
+        r.append(self.take(self.empty))
+        return r
 
 
 @TransformerTubeFactory()
 class Joined(object):
     """
-    Joined does single level flattening of streams.
+    Joined does single level flattening of streams. With vectored=True, a
+    byte stream is output as Segments, which sinks.File, sinks.Hash,
+    sinks.Bytes and the S3 sink write without joining, and which are passed
+    along without being copied into and out of a buffer on the way. Chunks
+    of small items are still joined, into a single part.
     """
 
-    def __init__(self, by=b""):
+    fusible = True
+
+    def __init__(self, by=b"", vectored=False):
         self.by = by
         self.first = True
+        self.vectored = vectored
 
     def transform(self, chunk):
+        if self.vectored:
+            return self.segments(chunk)
+        return self.join(chunk)
+
+    def join(self, chunk):
         if self.first:
             self.first = False
             return self.by.join(chunk)
         else:
-            return self.by + self.by.join(chunk)
+            # one join, rather than joining and then prepending by
+            return self.by.join(itertools.chain((self.by[:0],), chunk))
+
+    # items smaller than this on average are joined, since copying them is
+    # cheaper than handling them one at a time
+    min_part = 2**12
+
+    def segments(self, chunk):
+        chunk = list(chunk)
+        size = sum(len(item) for item in chunk)
+        if size < self.min_part * len(chunk):
+            part = self.join(chunk)
+            return Segments([part], len(part))
+        if not self.by:
+            self.first = False
+            return Segments(chunk, size)
+        parts = [self.by] * (2 * len(chunk))
+        parts[1::2] = chunk
+        if self.first:
+            self.first = False
+            del parts[0]
+        return Segments(parts)
+
+
+JSON_STRING = br'"[^"\\]*(?:\\.[^"\\]*)*"'
+JSON_SCALAR = br'[^\s,\]}\[{"]+'
+
+
+def json_container_re(depth):
+    """
+    json_container_re returns a regular expression matching a whole JSON
+    array or object, nested up to depth deep. It matches one character at a
+    time, rather than runs, so it can't backtrack badly on an incomplete one.
+    """
+    body = br'(?:[^\[\]{}"]|' + JSON_STRING + br')*'
+    for _ in range(depth):
+        container = br'[\[{]' + body + br'[\]}]'
+        body = br'(?:[^\[\]{}"]|' + JSON_STRING + br'|' + container + br')*'
+    return re.compile(container, re.S)
+
+
+class LazyRecord(compat.Mapping):
+    """
+    LazyRecord is a read-only JSON object that has only decoded some of its
+    fields. Reading any other field decodes the whole object, once. The raw
+    JSON is kept, and JSONDumps writes it out untouched.
+    """
+
+    __slots__ = ('raw', 'start', 'end', 'values', 'codec', 'obj')
+
+    # a field we looked for and know isn't there
+    missing = object()
+
+    def __init__(self, raw, start, end, values, codec):
+        self.raw = raw
+        self.start = start
+        self.end = end
+        self.values = values
+        self.codec = codec
+        self.obj = None
+
+    def json(self):
+        return self.raw[self.start:self.end]
+
+    def materialize(self):
+        if self.obj is None:
+            self.obj = self.codec.loads(self.json())
+        return self.obj
+
+    def __getitem__(self, key):
+        values = self.values
+        if key in values:
+            value = values[key]
+            if value is self.missing:
+                raise KeyError(key)
+            return value
+        return self.materialize()[key]
+
+    def __contains__(self, key):
+        values = self.values
+        if key in values:
+            return values[key] is not self.missing
+        return key in self.materialize()
+
+    def __iter__(self):
+        return iter(self.materialize())
+
+    def __len__(self):
+        return len(self.materialize())
+
+    def __repr__(self):
+        return "<LazyRecord %r>" % (dict(
+            (k, v) for k, v in self.values.items() if v is not self.missing
+        ))
+
+
+class Projection(object):
+    """
+    Projection decodes a few fields of raw JSON objects into LazyRecords.
+    Fields are keys, or dotted paths of keys into nested objects.
+
+    We search for the keys we want, and then check they belong to the object
+    we're in, and not something nested in it, by walking the brackets in
+    between, if there are any. A quoted key followed by a colon, that doesn't
+    start with an escaped quote, can't be inside a string, so that's all the
+    parsing we do, and most of it is plain substring searches.
+
+    Objects we can't project, because they have values nested too deeply or
+    aren't objects at all, are decoded in full. Keys written with escapes
+    aren't recognized, and if a key is repeated, the first one may win.
+    """
+
+    def __init__(self, fields, codec):
+        self.codec = codec
+        tree = {}
+        for field in fields:
+            node = tree
+            names = field.split(".")
+            for name in names[:-1]:
+                if node.get(name, {}) is None:
+                    # already decoding the whole thing
+                    break
+                node = node.setdefault(name, {})
+            else:
+                node[names[-1]] = None
+        self.root = self.compile(tree)
+
+    open = re.compile(br'\s*{')
+    colon = re.compile(br'\s*:\s*')
+    # everything up to the next bracket that isn't in a string
+    body = re.compile(br'(?:[^\[\]{}"]+|' + JSON_STRING + br')*', re.S)
+    value = re.compile(
+        b'|'.join([JSON_STRING, json_container_re(4).pattern, JSON_SCALAR]),
+        re.S
+    )
+
+    def compile(self, tree):
+        return [
+            (b'"' + name.encode('utf-8') + b'"', name,
+             None if subtree is None else self.compile(subtree))
+            for name, subtree in tree.items()
+        ]
+
+    def __call__(self, raw):
+        values = self.project(self.root, raw, 0, len(raw))
+        if values is None:
+            return self.codec.loads(raw)
+        return LazyRecord(raw, 0, len(raw), values, self.codec)
+
+    def locate(self, raw, key, pos, end):
+        """
+        locate finds the next place key is used as a key, and returns where
+        it is and where its value starts, or None.
+        """
+        while True:
+            k = raw.find(key, pos, end)
+            if k == -1:
+                return None
+            if raw[k - 1:k] != b'\\':
+                m = self.colon.match(raw, k + len(key), end)
+                if m:
+                    return k, m.end()
+            pos = k + 1
+
+    def brackets(self, raw, pos, limit):
+        # find is much faster than searching for a character class
+        for c in (b'{', b'}', b'[', b']'):
+            if raw.find(c, pos, limit) != -1:
+                return True
+        return False
+
+    def walk(self, raw, pos, limit, depth):
+        """
+        walk follows the brackets from pos to limit, and returns the depth
+        there, or 0 if the object closes first, or None if a string runs past
+        limit.
+        """
+        while True:
+            pos = self.body.match(raw, pos, limit).end()
+            if pos >= limit:
+                return depth, pos
+            c = raw[pos:pos + 1]
+            if c == b'"':
+                return None, pos
+            depth += 1 if c in b'[{' else -1
+            pos += 1
+            if depth == 0:
+                return depth, pos
+
+    def project(self, node, raw, start, end):
+        """
+        project returns the fields of the object in raw[start:end], or None
+        if we can't tell what they are.
+        """
+        m = self.open.match(raw, start, end)
+        if not m:
+            return None
+        pos = m.end()
+        depth = 1
+        values = {}
+        found = []
+        for key, name, child in node:
+            at = self.locate(raw, key, pos, end)
+            if at:
+                found.append(at + (key, name, child))
+        heapq.heapify(found)
+
+        while found:
+            k, vstart, key, name, child = heapq.heappop(found)
+            if k < pos:
+                # it was in a value we've skipped
+                at = self.locate(raw, key, pos, end)
+                if at:
+                    heapq.heappush(found, at + (key, name, child))
+                continue
+            # once pos is inside something nested, keys are only ours again
+            # after brackets that close it
+            if depth != 1 or self.brackets(raw, pos, k):
+                depth, pos = self.walk(raw, pos, k, depth)
+                if depth is None:
+                    return None
+                if not depth:
+                    break
+                if depth > 1:
+                    # it belongs to something nested
+                    at = self.locate(raw, key, k + 1, end)
+                    if at:
+                        heapq.heappush(found, at + (key, name, child))
+                    continue
+
+            v = self.value.match(raw, vstart, end)
+            if not v:
+                return None
+            pos = v.end()
+            sub = None
+            if child is not None:
+                sub = self.project(child, raw, vstart, pos)
+            if sub is None:
+                values[name] = self.codec.loads(raw[vstart:pos])
+            else:
+                values[name] = LazyRecord(raw, vstart, pos, sub, self.codec)
+
+        for key, name, child in node:
+            values.setdefault(name, LazyRecord.missing)
+        return values
 
 
 @TransformerTubeFactory(OBJ_CHUNK_SIZE)
@@ -284,38 +1319,276 @@ class JSONLoads(object):
     """
     JSONLoads is not very smart. It expects a stream of complete raw
     JSON byte strings and works well with Delimiter for source files with one
-    JSON object per line.
+    JSON object per line. codec picks the JSON library, see jsoncodec.
+
+    If you only need a few fields of big objects, list them, or dotted paths
+    to them, in fields. JSONLoads will then output LazyRecords, which only
+    decode the whole object if some other field is read. See Projection.
     """
 
-    def __init__(self, encoding='utf-8'):
+    fusible = True
+
+    def __init__(self, encoding='utf-8', codec=None, fields=None):
         self.encoding = encoding
+        self.codec = jsoncodec.get(codec)
+        # codecs read UTF-8 bytes themselves
+        self.decode = not jsoncodec.is_utf8(encoding)
+        self.project = fields and Projection(fields, self.codec)
 
     def transform(self, chunk):
-        raws = filter(None, chunk)
-        return [json.loads(raw.decode(self.encoding)) for raw in raws]
+        raws = [raw for raw in chunk if raw]
+        if self.decode:
+            raws = [raw.decode(self.encoding) for raw in raws]
+            if self.project:
+                raws = [raw.encode('utf-8') for raw in raws]
+        if self.project:
+            project = self.project
+            return [project(raw) for raw in raws]
+        return self.codec.loads_many(raws)
 
 
 @TransformerTubeFactory(OBJ_CHUNK_SIZE)
 class JSONDumps(object):
     """
     JSONDumps takes an object stream and serializes it to an
-    array of json byte strings.
+    array of json byte strings. codec picks the JSON library, see jsoncodec,
+    and kwargs are passed on to it. Unless codec or $JSON_CODEC names a
+    faster one, that's the standard library, and the output is what
+    json.dumps writes. LazyRecords from JSONLoads are written out as they
+    were read, unless kwargs are given.
     """
 
-    def __init__(self, delimiter=u"\n", encoding="utf-8", **kwargs):
+    fusible = True
+
+    def __init__(self, delimiter=u"\n", encoding="utf-8", codec=None,
+                 **kwargs):
         self.delimiter = delimiter
         self.encoding = encoding
         self.json_kwargs = kwargs
+        self.codec = jsoncodec.get(codec, compatible=True, **kwargs)
+        self.encode = not jsoncodec.is_utf8(encoding)
+        # LazyRecords are written out as they were read, unless formatting
+        # options say otherwise
+        self.passthrough = not kwargs
 
     def transform(self, chunk):
-        r = []
-        for obj in chunk:
-            line = json.dumps(obj, **self.json_kwargs)
-            raw = line.encode(self.encoding)
-            r.append(raw)
+        if self.passthrough:
+            dumps = self.codec.dumps
+            r = [
+                obj.json() if type(obj) is LazyRecord else dumps(obj)
+                for obj in chunk
+            ]
+        else:
+            r = self.codec.dumps_many(chunk)
+        if self.encode:
+            r = [raw.decode('utf-8').encode(self.encoding) for raw in r]
         return r
 
 
+@TransformerTubeFactory(OBJ_CHUNK_SIZE)
+class JSONStream(object):
+    """
+    JSONStream parses JSON documents that are too big to load whole, like a
+    multi-GB top level array, and outputs the values found at path as soon
+    as each one is complete. Paths work like ijson's prefixes: "item" is each
+    element of a top level array, "hits.hits.item" is each element of the
+    array at ["hits"]["hits"], and "" is each top level document.
+
+    Only the value being read is kept in memory, so memory is bounded by the
+    largest element. Everything else is skipped over as it goes by, with
+    regular expressions doing the scanning, and the values themselves are
+    decoded by codec, see jsoncodec.
+    """
+
+    fusible = True
+
+    VALUE, KEY, COLON, AFTER = range(4)
+    SKIP, DESCEND, EMIT = range(3)
+
+    space = re.compile(br'[^ \t\r\n]')
+    string = re.compile(JSON_STRING, re.S)
+    scalar_end = re.compile(br'[,\]} \t\r\n]')
+    # everything up to the next bracket that isn't in a string
+    container_body = re.compile(
+        br'(?:[^\[\]{}"]+|' + JSON_STRING + br')*', re.S
+    )
+    container = json_container_re(4)
+
+    def __init__(self, path="item", codec=None):
+        self.target = path.split(".") if path else []
+        self.codec = jsoncodec.get(codec)
+        self.buf = bytearray()
+        self.pos = 0
+        self.stack = []  # [bracket, key] for each container we're in
+        self.expect = self.VALUE
+        self.value = None  # [start, pos, depth, emit] of a container
+
+    def transform(self, chunk):
+        self.buf += chunk
+        return self.scan(False)
+
+    def close(self):
+        out = self.scan(True)
+        if self.stack or self.value or self.space.search(self.buf, self.pos):
+            raise ValueError("JSONStream: truncated JSON document")
+        return out
+
+    def error(self, pos):
+        return ValueError(
+            "JSONStream: unexpected %r" % (bytes(self.buf[pos:pos + 20]))
+        )
+
+    def where(self):
+        """
+        where says what to do with the value about to start.
+        """
+        if len(self.stack) > len(self.target):
+            return self.SKIP
+        for (bracket, key), name in zip(self.stack, self.target):
+            if bracket == b'[':
+                if name != "item":
+                    return self.SKIP
+            elif key != name:
+                return self.SKIP
+        if len(self.stack) == len(self.target):
+            return self.EMIT
+        return self.DESCEND
+
+    def pop(self, pos, c):
+        if not self.stack or (self.stack[-1][0] == b'[') != (c == b']'):
+            raise self.error(pos)
+        self.stack.pop()
+        self.expect = self.AFTER
+        return pos + 1
+
+    def decode(self, start, end):
+        return self.codec.loads(bytes(self.buf[start:end]))
+
+    def read_container(self, out):
+        """
+        read_container reads on through the container in self.value, as far
+        as the buffer goes, and returns where it stopped.
+        """
+        buf = self.buf
+        start, pos, depth, emit = self.value
+        if pos == start:
+            # most containers are small enough to match in one go
+            m = self.container.match(buf, pos)
+            if m:
+                if emit:
+                    out.append(self.decode(start, m.end()))
+                self.value = None
+                self.expect = self.AFTER
+                return m.end()
+        while True:
+            pos = self.container_body.match(buf, pos).end()
+            c = buf[pos:pos + 1]
+            if not c or c == b'"':
+                # out of data, possibly in the middle of a string
+                self.value = [start, pos, depth, emit]
+                return pos
+            depth += 1 if c in b'[{' else -1
+            pos += 1
+            if depth == 0:
+                if emit:
+                    out.append(self.decode(start, pos))
+                self.value = None
+                self.expect = self.AFTER
+                return pos
+
+    def scan(self, final):
+        buf = self.buf
+        pos = self.pos
+        out = []
+        while True:
+            if self.value:
+                pos = self.read_container(out)
+                if self.value:
+                    break
+                continue
+
+            m = self.space.search(buf, pos)
+            if not m:
+                pos = len(buf)
+                break
+            pos = m.start()
+            c = buf[pos:pos + 1]
+            expect = self.expect
+
+            if expect == self.AFTER:
+                if c == b',' and self.stack:
+                    pos += 1
+                    self.expect = self.KEY if self.stack[-1][0] == b'{' \
+                        else self.VALUE
+                elif c in b']}':
+                    pos = self.pop(pos, c)
+                elif not self.stack:
+                    # another top level document
+                    self.expect = self.VALUE
+                else:
+                    raise self.error(pos)
+
+            elif expect == self.COLON:
+                if c != b':':
+                    raise self.error(pos)
+                pos += 1
+                self.expect = self.VALUE
+
+            elif expect == self.KEY:
+                if c == b'}':
+                    pos = self.pop(pos, c)
+                elif c == b'"':
+                    m = self.string.match(buf, pos)
+                    if not m:
+                        break
+                    self.stack[-1][1] = self.decode(pos, m.end())
+                    pos = m.end()
+                    self.expect = self.COLON
+                else:
+                    raise self.error(pos)
+
+            elif c == b']':
+                pos = self.pop(pos, c)
+
+            else:
+                where = self.where()
+                if c in b'[{':
+                    if where == self.DESCEND:
+                        self.stack.append([c, None])
+                        pos += 1
+                        self.expect = self.KEY if c == b'{' else self.VALUE
+                    else:
+                        self.value = [pos, pos, 0, where == self.EMIT]
+                    continue
+
+                if c == b'"':
+                    m = self.string.match(buf, pos)
+                    if not m:
+                        break
+                    end = m.end()
+                else:
+                    m = self.scalar_end.search(buf, pos)
+                    if m:
+                        end = m.start()
+                    elif final:
+                        end = len(buf)
+                    else:
+                        break
+                if where == self.EMIT:
+                    out.append(self.decode(pos, end))
+                pos = end
+                self.expect = self.AFTER
+
+        # forget everything we're done with
+        keep = self.value[0] if self.value else pos
+        del buf[:keep]
+        self.pos = pos - keep
+        if self.value:
+            self.value[0] -= keep
+            self.value[1] -= keep
+        return out
+
+
 @TransformerTubeFactory(OBJ_CHUNK_SIZE)
 class ChunkMap(object):
     """
@@ -344,6 +1617,8 @@ class Map(object):
     element of the chunk. It's the easiest way to make a transformer.
     """
 
+    fusible = True
+
     def __init__(self, fn, close_fn=None, abort_fn=None):
         self.fn = fn
         self.close_fn = close_fn
@@ -359,6 +1634,107 @@ class Map(object):
         return self.abort_fn and self.abort_fn()
 
 
+def map_chunk(fn, chunk):
+    """
+    map_chunk is what ParallelMap runs in the pool. It lives at module level
+    so process pools can pickle it.
+    """
+    return [fn(x) for x in chunk]
+
+
+@TransformerTubeFactory(OBJ_CHUNK_SIZE)
+class ParallelMap(object):
+    """
+    ParallelMap applies fn to each element, like Map, but ships each chunk to
+    a concurrent.futures pool of $workers processes, or threads if
+    executor="thread". You can also pass your own Executor, which we won't
+    shut down.
+
+    At most $in_flight chunks (2 * workers by default) are outstanding, after
+    that transform() waits for one to finish. With ordered=True results come
+    out in input order, otherwise they come out as they finish. Each chunk is
+    one task, so raise the upstream chunk_size if fn is cheap. With process
+    pools, fn and the elements must be picklable.
+    """
+
+    def __init__(
+        self,
+        fn,
+        workers=None,
+        ordered=True,
+        executor="process",
+        in_flight=None,
+        close_fn=None,
+        abort_fn=None,
+    ):
+        if futures is None:  # pragma: no cover
+            raise ImportError("ParallelMap needs concurrent.futures")
+        self.fn = fn
+        self.workers = workers or multiprocessing.cpu_count()
+        self.ordered = ordered
+        self.executor = executor
+        self.in_flight = in_flight or 2 * self.workers
+        self.close_fn = close_fn
+        self.abort_fn = abort_fn
+        self.pool = None
+        self.pending = collections.deque() if ordered else set()
+
+    def start(self):
+        if self.executor == "process":
+            self.pool = futures.ProcessPoolExecutor(self.workers)
+        elif self.executor == "thread":
+            self.pool = futures.ThreadPoolExecutor(self.workers)
+        else:
+            self.pool = self.executor
+
+    def shutdown(self, wait):
+        if self.pool and self.pool is not self.executor:
+            self.pool.shutdown(wait=wait)
+
+    def collect(self, everything=False):
+        """
+        Return the results that are ready, waiting until we're back under our
+        in flight limit, or for everything if $everything.
+        """
+        r = []
+        limit = 0 if everything else self.in_flight
+        if self.ordered:
+            while self.pending and \
+                    (len(self.pending) > limit or self.pending[0].done()):
+                r.extend(self.pending.popleft().result())
+        else:
+            if everything:
+                futures.wait(self.pending)
+            elif len(self.pending) > limit:
+                futures.wait(self.pending, return_when=futures.FIRST_COMPLETED)
+            for future in [f for f in self.pending if f.done()]:
+                self.pending.remove(future)
+                r.extend(future.result())
+        return r
+
+    def transform(self, chunk):
+        if self.pool is None:
+            self.start()
+        future = self.pool.submit(map_chunk, self.fn, list(chunk))
+        if self.ordered:
+            self.pending.append(future)
+        else:
+            self.pending.add(future)
+        return self.collect()
+
+    def close(self):
+        r = self.collect(everything=True)
+        self.shutdown(wait=True)
+        c = self.close_fn and self.close_fn()
+        return r + c if c else r
+
+    def abort(self):
+        for future in self.pending:
+            future.cancel()
+        self.shutdown(wait=False)
+        return self.abort_fn and self.abort_fn()
+
+
 @TransformerTubeFactory()
 class Tee(object):
     """
@@ -366,6 +1742,8 @@ class Tee(object):
     the apparatus.
     """
 
+    fusible = True
+
     def __init__(self, sink):
         self.sink = sink
         self.result = None
@@ -385,6 +1763,8 @@ class Filter(object):
     built-in for each chunk.
     """
 
+    fusible = True
+
     def __init__(self, fn):
         self.fn = fn
 
@@ -396,7 +1776,129 @@ class Filter(object):
 class Noop(object):
     """
     Noop is useful for buffering. Set chunksize for upstream
-    sinks.
+    sinks. It's transparent: it doesn't change the bytes, so it doesn't stop
+    the apparatus from having the kernel copy a file, see sinks.SinkRunner.
     """
+
+    fusible = True
+    transparent = True
+
     def transform(self, chunk):
         return chunk
+
+
+class BatchWorker(TransformerTubeWorker):
+    """
+    BatchWorker reads for a Batch, which may have been fused onto the end of
+    other tubes. It's done reading as soon as the batch is due, rather than
+    once chunk_size items are in, and outputs exactly one batch. Nothing fuses
+    onto it, since that would lose the batching.
+    """
+
+    def __init__(self, apparatus, chunk_size, batch):
+        TransformerTubeWorker.__init__(
+            self, apparatus, batch.max_items, batch
+        )
+        self.batch = batch
+        self.idle_timeout = None
+
+    def fusible(self):
+        return False
+
+    def read_complete(self):
+        if self.eof:
+            return True
+        if self.batch.due():
+            return True
+        self.wait_until(self.batch.deadline)
+        return False
+
+    def wait_until(self, deadline):
+        """
+        wait_until has a source that waits for data with a timeout, like
+        Socket or TCPServer, give up on it no later than deadline, so its idle
+        tick comes in time to flush.
+        """
+        reader = getattr(self.source, 'reader', None)
+        if not hasattr(reader, 'timeout'):
+            return
+        if self.idle_timeout is None:
+            self.idle_timeout = reader.timeout
+        if deadline is None:
+            reader.timeout = self.idle_timeout
+        else:
+            reader.timeout = max(0, min(self.idle_timeout, deadline - clock()))
+
+    def output(self):
+        n = self.batch.take()
+        eof = self.eof and self.buffer_len() <= n
+        return self.shift_buffer(n), eof
+
+
+@TransformerTubeFactory(OBJ_CHUNK_SIZE)
+class Batch(object):
+    """
+    Batch outputs each batch of items as one chunk, as soon as it has
+    max_items items, or max_bytes bytes, counting len() of each item, or its
+    oldest item has waited max_latency_ms, whichever comes first. Items over
+    max_bytes are batched on their own.
+
+    The latency is checked whenever a chunk arrives, including the empty ones
+    that Socket and TCPServer tick with when they're idle, and their timeout
+    is shortened so the tick comes when a batch is due. Batch fuses with the
+    tubes before it, so they don't hold items back, but any other tube in
+    between will, until it has its chunk_size.
+    """
+
+    fusible = True
+    worker_cls = BatchWorker
+
+    def __init__(self, max_items=1000, max_bytes=None, max_latency_ms=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.max_latency = None
+        if max_latency_ms is not None:
+            self.max_latency = max_latency_ms / 1000.0
+        self.count = 0
+        self.size = 0
+        self.sizes = collections.deque()
+        self.deadline = None
+
+    def transform(self, chunk):
+        chunk = list(chunk)
+        if chunk and not self.count and self.max_latency is not None:
+            self.deadline = clock() + self.max_latency
+        self.count += len(chunk)
+        if self.max_bytes is not None:
+            sizes = [len(item) for item in chunk]
+            self.sizes.extend(sizes)
+            self.size += sum(sizes)
+        return chunk
+
+    def due(self):
+        if not self.count:
+            return False
+        return self.count >= self.max_items \
+            or (self.max_bytes is not None and self.size >= self.max_bytes) \
+            or (self.deadline is not None and clock() >= self.deadline)
+
+    def take(self):
+        """
+        take returns how many items go in the next batch, and forgets them.
+        """
+        n = min(self.count, self.max_items)
+        if self.max_bytes is not None:
+            sizes = self.sizes
+            total = sizes.popleft() if n else 0
+            for i in range(1, n):
+                if total + sizes[0] > self.max_bytes:
+                    n = i
+                    break
+                total += sizes.popleft()
+            self.size -= total
+        self.count -= n
+        if not self.count:
+            # leftovers keep the deadline of the oldest, which errs early
+            self.deadline = None
+        return n
+